@@ -1,32 +1,88 @@
 import os
 import sys
 import argparse
-import numpy as np
-import dearpygui.dearpygui as dpg
 
 sys.path.append("src/")
 sys.dont_write_bytecode = True
 
-import ui.radiopy_ui as ui
-
-from spectral_line import runObservation
+# NOTE - UI and observation modules are imported in main() so background
+# observation processes spawned by the UI do not import the UI again
 
 
 def main():
     parser = argparse.ArgumentParser(prog="radiopy.py", description="The python solution for radio astronomy with an SDR")
     parser.add_argument("-s", help="Quick run spectral line observation", action="store_true", dest="run_line")
     parser.add_argument("-p", help="Quick run pulsar observation", action="store_true", dest="run_pulsar")
-    # parser.add_argument("-d", help="List available drivers", action="store_true", dest="list_drivers")
+    parser.add_argument("-r", help="Quick run total power radiometer observation", action="store_true", dest="run_radiometer")
+    parser.add_argument("-f", help="Fit Gaussian model to all observations in the given directory", default="none", type=str, dest="fit_dir")
+    parser.add_argument("-d", help="Search the given filterbank file for dispersed pulses over trial DMs", default="none", type=str, dest="search_path")
+    parser.add_argument("--dm-max", help="Highest trial DM of the search (pc/cm^3)", default=500.0, type=float, dest="dm_max")
+    parser.add_argument("--benchmark", help="Time the search dedispersion against brute force dedispersion instead of searching", action="store_true", dest="benchmark")
+    parser.add_argument("-a", help="Allan variance stability analysis of a filterbank (.fil), radiometer (.npz) or .npy capture", default="none", type=str, dest="allan_path")
+    parser.add_argument("--tsamp", help="Sample time in seconds of .npy captures for -a", default=0.0, type=float, dest="tsamp")
+    parser.add_argument("-x", help="Export an observation, or all observations in a directory, to an SDFITS file", default="none", type=str, dest="export_path")
+    parser.add_argument("--out", help="Output file of -x. Defaults to next to the observations", default="none", type=str, dest="out_path")
+    parser.add_argument("-m", help="Migrate the observations in the given directory to the compressed archive format", default="none", type=str, dest="migrate_path")
+    parser.add_argument("--precision", help="Largest error of archived data in dB for -m (0 is lossless)", default=0.001, type=float, dest="precision")
+    parser.add_argument("--codec", help="Compression of the archive for -m (zlib or lzma)", default="zlib", type=str, dest="codec")
+    parser.add_argument("--keep", help="Keep the original files after migrating with -m", action="store_true", dest="keep")
+    parser.add_argument("--serve", help="Run the local control and spectrum streaming server", action="store_true", dest="serve")
+    parser.add_argument("--host", help="Address the server listens on", default="127.0.0.1", type=str, dest="host")
+    parser.add_argument("--port", help="Port the server listens on", default=8765, type=int, dest="port")
+    parser.add_argument("--seed", help="Saved model (npz) to use as initial guess when fitting. Lines are detected automatically if left out", default="none", type=str, dest="seed")
+    parser.add_argument("-b", help="Measure and cache the bandpass of the SDR from an off-source integration", action="store_true", dest="measure_bandpass")
+    parser.add_argument("--bandpass-ffts", help="Number of FFTs averaged into the bandpass", default=20000, type=int, dest="bandpass_ffts")
+    parser.add_argument("--import-budget", help="Check the import time of every entry point against its budget", action="store_true", dest="import_budget")
+    parser.add_argument("--server-smoke", help="Check that the server streams spectra of the simulated SDR", action="store_true", dest="server_smoke")
     # parser.add_argument("-l", help="Load, and plot, data from a given file path (csv or json)", default="none", type=str, dest="load_data")
-    # parser.add_argument("-p", help="Run in pulsar mode at given frequency (in Hz)", default=0, type=int, dest="pulsar")
     args = parser.parse_args()
 
     if args.run_line:
+        from spectral_line import runObservation
         print("Running spectral line observation from config settings...")
         runObservation()
     elif args.run_pulsar:
-        print("Running pulsar observation")
+        from pulsar import runPulsarObservation
+        print("Running pulsar observation from config settings...")
+        runPulsarObservation()
+    elif args.run_radiometer:
+        from radiometer import runRadiometerObservation
+        print("Running total power observation from config settings...")
+        runRadiometerObservation()
+    elif args.measure_bandpass:
+        from spectral_line import measureBandpass
+        measureBandpass(n_ffts = args.bandpass_ffts)
+    elif args.search_path != "none":
+        from dm_search import searchFilterbank, benchmarkDedispersion
+        if args.benchmark:
+            benchmarkDedispersion(path = args.search_path, dm_max = args.dm_max)
+        else:
+            searchFilterbank(path = args.search_path, dm_max = args.dm_max)
+    elif args.allan_path != "none":
+        from allan import analyzeStability
+        analyzeStability(path = args.allan_path, tsamp = args.tsamp)
+    elif args.export_path != "none":
+        from export import exportSDFITS
+        exportSDFITS(path = args.export_path, out_path = args.out_path)
+    elif args.migrate_path != "none":
+        from migrate import migrateObservations
+        migrateObservations(path = args.migrate_path, precision = args.precision, codec = args.codec, keep = args.keep)
+    elif args.serve:
+        from server import runServer
+        runServer(host = args.host, port = args.port)
+    elif args.import_budget:
+        from import_budget import checkImportBudget
+        if not checkImportBudget():
+            sys.exit(1)
+    elif args.server_smoke:
+        from server_smoke import checkServerSmoke
+        if not checkServerSmoke():
+            sys.exit(1)
+    elif args.fit_dir != "none":
+        from model_fitting import fitObservations
+        fitObservations(path = args.fit_dir, seed_path = args.seed)
     else:
+        import ui.radiopy_ui as ui
         ui.runUI()
     quit()
 
@@ -0,0 +1,195 @@
+import os
+import numpy as np
+import pandas as pd
+
+from core.pulsar import readFilterbank, closeFilterbank
+
+# Time samples read from a capture at a time. A power of 2, so the averaging blocks of every octave up to it align with the chunks
+ALLAN_CHUNK = 2**14
+
+# Factor the Allan variance may exceed the white noise (radiometer equation) prediction before drifts are taken to dominate
+ALLAN_DRIFT_FACTOR = 2.0
+
+# Differences an octave needs before its Allan variance is used to find the optimal times, as fewer give too noisy estimates
+ALLAN_MIN_DIFFERENCES = 8
+
+
+def loadCapture(path: str, tsamp: float = 0.0) -> tuple:
+    '''
+    Open a capture as a (time samples, channels) array and its sample time in seconds
+
+    Filterbank files (.fil) and .npy arrays are memory mapped, so multi-GB captures are never loaded at once.
+    Total power observations (observation_radiometer.npz) are small enough to be loaded.
+    Archives (.rpa) are decompressed a chunk at a time. The sample time of a .npy array has to be given as tsamp
+    '''
+    if path.endswith(".rpa"):
+        from core.archive import ArchiveReader
+        with ArchiveReader(path) as archive:
+            names = archive.names()
+            if "filterbank" not in names and "radiometer/power" in names:
+                power, times = archive["radiometer/power"].read(), archive["radiometer/time"].read()
+        if "filterbank" in names:
+            header, data = readFilterbank(path)
+            return data, header["tsamp"]
+        if "radiometer/power" not in names:
+            raise ValueError(f"{path} holds no filterbank or total power data")
+        tsamp = float(np.median(np.diff(times)))*86400 if times.size > 1 else tsamp
+        return power.reshape(power.shape[0], -1), tsamp
+    if path.endswith(".fil"):
+        header, data = readFilterbank(path)
+        return data, header["tsamp"]
+    if path.endswith(".npz"):
+        with np.load(path) as f:
+            power = f["power"]
+            times = f["time"]
+        tsamp = float(np.median(np.diff(times)))*86400 if times.size > 1 else tsamp
+        return power.reshape(power.shape[0], -1), tsamp
+    if path.endswith(".npy"):
+        data = np.load(path, mmap_mode="r")
+        if tsamp <= 0:
+            raise ValueError("Please give the sample time of .npy captures with --tsamp")
+        return data.reshape(data.shape[0], -1), tsamp
+    raise ValueError(f"Unsupported capture {path}. Must be a filterbank (.fil), radiometer (.npz) or .npy file")
+
+
+def allanVariance(data: np.ndarray, chunk: int = ALLAN_CHUNK) -> tuple:
+    '''
+    Non-overlapping Allan variance of every channel and of the total power, at octave spaced averaging times
+
+    The averages over 2^k samples are built as a pyramid, each octave the pairwise mean of the one below, and the
+    squared differences of consecutive averages are summed for all channels at once. Octaves shorter than a chunk are
+    computed chunk by chunk, carrying the last average of each octave over to the next chunk. The averages of
+    a whole chunk are kept, and the longer octaves computed from them afterwards.
+
+    Returns tuple of the averaging times in samples, the Allan variance of each channel relative to its mean
+    squared, shaped (octaves, channels), the relative Allan variance of the total power and the number of
+    differences behind each octave
+    '''
+    n_samples, n_channels = data.shape
+    n_octaves = int(np.log2(n_samples//2)) + 1 if n_samples >= 2 else 0
+    chunk_octaves = int(np.log2(chunk))
+
+    # Total power is added as an extra channel
+    sums = np.zeros((n_octaves, n_channels+1))
+    counts = np.zeros(n_octaves)
+    last = [None]*n_octaves
+    channel_sum = np.zeros(n_channels+1)
+    reduced = []
+
+    def addDifferences(octave: int, means: np.ndarray, previous: np.ndarray = None) -> None:
+        if previous is not None:
+            means = np.concatenate((previous[None], means))
+        if means.shape[0] < 2:
+            return
+        diffs = means[1:] - means[:-1]
+        sums[octave] += np.einsum("ij,ij->j", diffs, diffs)
+        counts[octave] += diffs.shape[0]
+
+    for start in range(0, n_samples, chunk):
+        block = np.asarray(data[start:start+chunk], dtype=np.float64)
+        means = np.empty((block.shape[0], n_channels+1))
+        means[:, :n_channels] = block
+        means[:, n_channels] = block.sum(axis=1)
+        channel_sum += means.sum(axis=0)
+
+        for octave in range(min(chunk_octaves, n_octaves)):
+            if means.shape[0] == 0:
+                break
+            addDifferences(octave, means, last[octave])
+            last[octave] = means[-1].copy()
+            pairs = means.shape[0]//2
+            means = 0.5*(means[0:2*pairs:2] + means[1:2*pairs:2])
+        reduced.append(means)
+
+    # Octaves longer than a chunk, from the averages over whole chunks
+    means = np.concatenate(reduced) if reduced else np.zeros((0, n_channels+1))
+    for octave in range(chunk_octaves, n_octaves):
+        addDifferences(octave, means)
+        pairs = means.shape[0]//2
+        means = 0.5*(means[0:2*pairs:2] + means[1:2*pairs:2])
+
+    valid = counts > 0
+    mean_power = channel_sum/max(n_samples, 1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        avar = 0.5*sums[valid]/counts[valid][:, None]/mean_power**2
+    taus = 2**np.arange(n_octaves)[valid]
+    return taus, avar[:, :n_channels], avar[:, n_channels], counts[valid]
+
+
+def stabilityTimes(taus: np.ndarray, avar: np.ndarray) -> tuple:
+    '''
+    Return the averaging time with the lowest Allan variance, and the longest averaging time where it is within
+    ALLAN_DRIFT_FACTOR of the white noise prediction avar[0]*taus[0]/taus (the Allan time), both in samples
+    '''
+    finite = np.isfinite(avar)
+    if not np.any(finite):
+        return taus[-1], taus[-1]
+    optimal = taus[finite][np.argmin(avar[finite])]
+
+    white = avar[0]*taus[0]/taus
+    within = avar <= ALLAN_DRIFT_FACTOR*white
+    # The Allan time is where the variance first leaves the white noise line
+    allan_time = taus[-1] if np.all(within) else taus[max(np.argmin(within) - 1, 0)]
+    return optimal, allan_time
+
+
+def analyzeStability(path: str, tsamp: float = 0.0) -> None:
+    '''
+    Compute the Allan variance of a capture, report the optimal integration and switching times, and save them next to it
+    '''
+    data, tsamp = loadCapture(path, tsamp)
+    print(f"Computing Allan variance of {data.shape[0]} samples of {data.shape[1]} channels ({round(data.shape[0]*tsamp, 1)} s)...")
+    taus, channel_avar, total_avar, n_differences = allanVariance(data)
+    closeFilterbank(data)
+    if taus.size == 0:
+        print("Too few samples for an Allan variance")
+        return
+
+    with np.errstate(invalid="ignore"):
+        median_avar = np.nanmedian(channel_avar, axis=1)
+    reliable = n_differences >= min(ALLAN_MIN_DIFFERENCES, n_differences.max())
+    total_optimal, total_allan = stabilityTimes(taus[reliable], total_avar[reliable])
+    channel_optimal, channel_allan = stabilityTimes(taus[reliable], median_avar[reliable])
+
+    print(f"Total power:  lowest Allan variance at {round(total_optimal*tsamp, 4)} s, drifts dominate after {round(total_allan*tsamp, 4)} s")
+    print(f"Per channel:  lowest Allan variance at {round(channel_optimal*tsamp, 4)} s, drifts dominate after {round(channel_allan*tsamp, 4)} s")
+    if total_optimal == taus[reliable][-1] or channel_optimal == taus[reliable][-1]:
+        print("The Allan variance was still falling at the longest averaging time, so the capture is too short to find the minimum")
+    print(f"Integrate spectra for at most {round(channel_optimal*tsamp, 4)} s between calibrations, "
+          f"and switch on/off source at least every {round(min(total_allan, channel_allan)*tsamp, 4)} s")
+
+    result = pd.DataFrame({
+        "Tau": taus*tsamp,
+        "Total power": total_avar,
+        "Median channel": median_avar,
+        "Radiometer equation": median_avar[0]*taus[0]/taus,
+        "Differences": n_differences.astype(int)
+    })
+    out_path = os.path.splitext(path)[0]+"_allan"
+    result.to_csv(out_path+".csv", index=False)
+    np.save(out_path+"_channels.npy", channel_avar.astype(np.float32))
+    plotAllanVariance(result, out_path+".png")
+    print(f"Saved Allan variance to {out_path}.csv")
+
+
+def plotAllanVariance(result: "pd.DataFrame", path: str) -> None:
+    '''
+    Plot and save the Allan variance against averaging time on log-log axes
+    '''
+    import matplotlib.pyplot as plt
+    FS_label = 16
+    FS_ticks = 12
+
+    fig, ax = plt.subplots(1, 1, figsize=(9,6))
+    ax.loglog(result["Tau"], result["Total power"], color = "b", marker = "o", linewidth = 1, label = "Total power")
+    ax.loglog(result["Tau"], result["Median channel"], color = "r", marker = "o", linewidth = 1, label = "Median channel")
+    ax.loglog(result["Tau"], result["Radiometer equation"], color = "k", linestyle = "--", linewidth = 1, label = "Radiometer equation")
+    ax.set_xlabel(r"Averaging time $\tau$ [$s$]", fontsize = FS_label)
+    ax.set_ylabel(r"Relative Allan variance", fontsize = FS_label)
+    ax.tick_params(labelsize=FS_ticks)
+    ax.grid(alpha=0.5, which="both")
+    ax.legend()
+    plt.tight_layout()
+
+    plt.savefig(path, dpi = 200)
+    plt.close(fig)
@@ -0,0 +1,227 @@
+import numpy as np
+from numpy.polynomial import polynomial
+from scipy.special import ndtr, ndtri
+
+# Spectra per batch of the running statistics, and batches needed before the noise estimate is trusted
+ADAPTIVE_BATCH = 64
+ADAPTIVE_MIN_BATCHES = 8
+
+RMS_UNITS = ("dB", "K")
+
+# Order of the baseline fitted before the line SNR is measured, clipping passes of the fit and their threshold (in noise)
+ADAPTIVE_BASELINE_ORDER = 3
+ADAPTIVE_BASELINE_CLIPS = 3
+ADAPTIVE_CLIP_SIGMA = 3.0
+# Smallest fraction of the band outside the line window to fit the baseline on, otherwise the whole band is used
+ADAPTIVE_MIN_BASELINE_FRACTION = 0.2
+
+
+class AdaptiveIntegration:
+    '''
+    Stopping rule for integrations that run until a target noise level or line SNR is reached
+
+    Power spectra are summed in batches of batch spectra. Once a batch is complete, its mean updates running
+    per channel sums of the batch means and their squares, so the noise of the average in every channel follows from
+    the scatter of the batch means at a cost of a few operations per channel and batch. The median over the channels
+    is robust to lines and RFI.
+
+    For Gaussian noise the radiometer equation predicts a relative rms of 1/sqrt(N) after N spectra. The measured noise
+    is compared against it, as excess noise points at RFI or gain drifts.
+
+    Targets (0 is off):
+     - target_rms     rms of the average spectrum, in dB or in K (from tsys, the system temperature in K)
+     - target_snr     peak SNR within line_range, the lowest and highest frequency of the line in Hz (whole band if None)
+
+    The line SNR is measured on the bandpass corrected spectrum, so target_snr needs a bandpass. What is left of the
+    baseline is removed by a low order fit outside the line window with outliers clipped, and the
+    channels next to the DC of the SDR are left out. The peak is given as the significance of a single channel,
+    corrected for the number of channels searched, so the largest of many noise channels does not count as a line.
+    '''
+    def __init__(self, n_bins: int, target_rms: float = 0.0, rms_unit: str = "dB", tsys: float = 0.0, target_snr: float = 0.0,
+                 line_range: tuple = None, batch: int = ADAPTIVE_BATCH, bandpass: np.ndarray = None) -> None:
+        if rms_unit not in RMS_UNITS:
+            print(f"Unknown rms unit {rms_unit}... using dB")
+            rms_unit = "dB"
+        if rms_unit == "K" and tsys <= 0:
+            print("A system temperature is needed for a target rms in K... ignoring target rms")
+            target_rms = 0.0
+        if target_snr > 0 and bandpass is None:
+            print("A measured bandpass is needed for a target line SNR, as the band edges would count as line... ignoring target SNR")
+            target_snr = 0.0
+        self.target_rms = target_rms
+        self.rms_unit = rms_unit
+        self.tsys = tsys
+        self.target_snr = target_snr
+        self.batch = max(int(batch), 1)
+        self.bandpass = bandpass
+        self.line_range = line_range
+        self.line_mask = None
+        self.dc_mask = None
+
+        self.current = np.zeros(n_bins)
+        self.count = 0
+        self.S1 = np.zeros(n_bins)
+        self.S2 = np.zeros(n_bins)
+        self.n_batches = 0
+
+    def setFrequencies(self, freqs: np.ndarray, dc_freq: float = None) -> None:
+        '''
+        Set the channel frequencies, selecting the channels within line_range the line SNR is measured in,
+        and the channels within a channel and a half of dc_freq (the frequency the SDR is tuned to), which are left out
+        '''
+        if self.line_range is not None:
+            self.line_mask = (freqs >= min(self.line_range)) & (freqs <= max(self.line_range))
+        if dc_freq is not None and freqs.size > 1:
+            self.dc_mask = np.abs(freqs - dc_freq) <= 1.5*abs(freqs[1] - freqs[0])
+
+    def add(self, psd: np.ndarray) -> bool:
+        '''
+        Add a power spectrum. Returns True if it completed a batch, after which the targets should be checked
+        '''
+        self.current += psd
+        self.count += 1
+        if self.count < self.batch:
+            return False
+
+        mean = self.current/self.count
+        if self.bandpass is not None:
+            mean /= self.bandpass
+        self.S1 += mean
+        self.S2 += mean*mean
+        self.n_batches += 1
+        self.current[:] = 0
+        self.count = 0
+        return True
+
+    def getSpectrum(self) -> np.ndarray:
+        '''
+        Return average of the completed batches
+        '''
+        return self.S1/max(self.n_batches, 1)
+
+    def getChannelNoise(self) -> np.ndarray:
+        '''
+        Return the standard deviation of the average in every channel, from the scatter of the batch means
+        '''
+        n = self.n_batches
+        if n < 2:
+            return np.full(self.S1.size, np.inf)
+        mean = self.S1/n
+        variance = np.maximum(self.S2/n - mean*mean, 0)*n/(n - 1)
+        return np.sqrt(variance/n)
+
+    def getRelativeNoise(self) -> float:
+        '''
+        Return the measured relative rms of the average spectrum (median over the channels)
+        '''
+        if self.n_batches < 2:
+            return np.inf
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return float(np.nanmedian(self.getChannelNoise()/self.getSpectrum()))
+
+    def getExpectedNoise(self) -> float:
+        '''
+        Return the relative rms predicted by the radiometer equation for the spectra added so far
+        '''
+        n_spectra = self.n_batches*self.batch
+        return 1/np.sqrt(n_spectra) if n_spectra > 0 else np.inf
+
+    def getRMS(self) -> float:
+        '''
+        Return the measured rms in the unit of the target
+        '''
+        relative = self.getRelativeNoise()
+        if self.rms_unit == "K":
+            return self.tsys*relative
+        return 10*np.log10(1 + relative)
+
+    def getBaseline(self, spectrum: np.ndarray, noise: np.ndarray, usable: np.ndarray) -> np.ndarray:
+        '''
+        Fit a baseline of ADAPTIVE_BASELINE_ORDER to the usable channels, outside the line window if enough are left,
+        iteratively leaving out channels that deviate by more than ADAPTIVE_CLIP_SIGMA
+        '''
+        x = np.linspace(-1, 1, spectrum.size)
+        fit = usable.copy()
+        if self.line_mask is not None and np.count_nonzero(fit & ~self.line_mask) >= ADAPTIVE_MIN_BASELINE_FRACTION*spectrum.size:
+            fit &= ~self.line_mask
+
+        baseline = np.full(spectrum.size, np.median(spectrum[usable]))
+        for _ in range(ADAPTIVE_BASELINE_CLIPS):
+            if np.count_nonzero(fit) <= ADAPTIVE_BASELINE_ORDER + 1:
+                break
+            coefs = polynomial.polyfit(x[fit], spectrum[fit], ADAPTIVE_BASELINE_ORDER, w=1/noise[fit])
+            baseline = polynomial.polyval(x, coefs)
+            clipped = fit & (np.abs(spectrum - baseline) <= ADAPTIVE_CLIP_SIGMA*noise)
+            if np.array_equal(clipped, fit):
+                break
+            fit = clipped
+        return baseline
+
+    def getSNR(self) -> float:
+        '''
+        Return the peak SNR of the average spectrum above its baseline within the line channels,
+        corrected for the number of channels searched
+        '''
+        if self.n_batches < 2:
+            return 0.0
+        # Noise is proportional to the power, by the median relative noise of the channels. The noise of single channels
+        # from a few batches scatters too much, and the channels where it comes out low would be taken for lines
+        spectrum = self.getSpectrum()
+        noise = self.getRelativeNoise()*np.abs(spectrum)
+        usable = np.isfinite(spectrum) & np.isfinite(noise) & (noise > 0)
+        if self.dc_mask is not None:
+            usable &= ~self.dc_mask
+        line = usable if self.line_mask is None else usable & self.line_mask
+        if not np.any(line):
+            return 0.0
+
+        snr = (spectrum[line] - self.getBaseline(spectrum, noise, usable)[line])/noise[line]
+        peak = float(np.max(snr))
+
+        # Chance that the largest of the searched noise channels is as high, as the equivalent single channel significance
+        p_trials = -np.expm1(snr.size*np.log1p(-ndtr(-peak)))
+        return max(float(-ndtri(p_trials)), 0.0) if p_trials > 0 else peak
+
+    def done(self) -> bool:
+        '''
+        Return True once any target is reached
+        '''
+        if self.n_batches < ADAPTIVE_MIN_BATCHES:
+            return False
+        if self.target_rms > 0 and self.getRMS() <= self.target_rms:
+            return True
+        if self.target_snr > 0 and self.getSNR() >= self.target_snr:
+            return True
+        return False
+
+    def estimateTotal(self, maximum: int) -> int:
+        '''
+        Estimate the number of spectra needed to reach the targets, at most maximum
+
+        Noise falls as 1/sqrt(N) and SNR grows as sqrt(N), so both are extrapolated from the current values
+        '''
+        n_spectra = self.n_batches*self.batch
+        if self.n_batches < 2:
+            return maximum
+        estimates = []
+        if self.target_rms > 0:
+            estimates.append(n_spectra*(self.getRMS()/self.target_rms)**2)
+        snr = self.getSNR()
+        if self.target_snr > 0 and snr > 0:
+            estimates.append(n_spectra*(self.target_snr/snr)**2)
+        if not estimates:
+            return maximum
+        return int(min(max(min(estimates), n_spectra), maximum))
+
+
+def expectedSpectra(target_rms: float, rms_unit: str = "dB", tsys: float = 0.0) -> float:
+    '''
+    Number of spectra the radiometer equation predicts for a target rms, or 0 if it cannot be predicted
+    '''
+    if target_rms <= 0:
+        return 0
+    if rms_unit == "K":
+        relative = target_rms/tsys if tsys > 0 else 0
+    else:
+        relative = 10**(target_rms/10) - 1
+    return 1/relative**2 if relative > 0 else 0
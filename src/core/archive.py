@@ -0,0 +1,311 @@
+import os
+import json
+import lzma
+import zlib
+import struct
+import numpy as np
+
+# Archive file of an observation directory, holding all of its data arrays
+ARCHIVE_NAME = "observation_archive.rpa"
+ARCHIVE_MAGIC = b"RPYARC1\n"
+ARCHIVE_VERSION = 1
+ARCHIVE_CODECS = ("zlib", "lzma")
+
+# Chunk shape (time samples, channels). Reading any slice decompresses only the chunks it overlaps
+ARCHIVE_CHUNK_ROWS = 256
+ARCHIVE_CHUNK_CHANNELS = 1024
+
+# Signed integer types quantized values are narrowed to
+QUANTIZED_DTYPES = (np.int8, np.int16, np.int32, np.int64)
+
+
+def compress(raw: bytes, codec: str) -> bytes:
+    if codec == "lzma":
+        return lzma.compress(raw, preset=6)
+    return zlib.compress(raw, 6)
+
+
+def decompress(raw: bytes, codec: str) -> bytes:
+    if codec == "lzma":
+        return lzma.decompress(raw)
+    return zlib.decompress(raw)
+
+
+def shuffleBytes(values: np.ndarray) -> bytes:
+    '''
+    Group the bytes of every value by significance, so the mostly constant high bytes compress into long runs
+    '''
+    return np.ascontiguousarray(values).view(np.uint8).reshape(-1, values.itemsize).T.tobytes()
+
+
+def unshuffleBytes(raw: bytes, dtype: np.dtype, shape: tuple) -> np.ndarray:
+    itemsize = np.dtype(dtype).itemsize
+    return np.frombuffer(raw, dtype=np.uint8).reshape(itemsize, -1).T.copy().view(dtype).reshape(shape)
+
+
+def encodeChunk(block: np.ndarray, precision: float, relative: bool, codec: str) -> tuple:
+    '''
+    Encode a (rows, channels) block
+
+    With a precision, floats are quantized to steps of 2*precision (relative to the mean absolute value of the block
+    if relative), so no value is off by more than precision. Consecutive values are then differenced along the axis
+    that leaves the smallest values, or not at all for white noise, and narrowed to the smallest integer type that holds them.
+    Without a precision, or for blocks with non-finite values, floats are stored losslessly as the XOR of consecutive bit
+    patterns and integers as wrapping differences.
+
+    Returns the compressed bytes and the chunk info needed to decode them
+    '''
+    info = {"shape": list(block.shape)}
+    is_float = np.issubdtype(block.dtype, np.floating)
+    step = 0.0
+    if is_float and precision > 0 and np.all(np.isfinite(block)):
+        scale = float(np.mean(np.abs(block))) if relative else 1.0
+        step = 2*precision*scale
+    if step > 0:
+        values = np.rint(block/step).astype(np.int64)
+        candidates = [(values, -1)]
+        for axis in (0, 1):
+            if values.shape[axis] > 1:
+                candidates.append((np.concatenate((values.take([0], axis), np.diff(values, axis=axis)), axis=axis), axis))
+        values, axis = min(candidates, key=lambda c: np.abs(c[0]).sum())
+        low, high = (values.min(), values.max()) if values.size > 0 else (0, 0)
+        dtype = next(t for t in QUANTIZED_DTYPES if np.iinfo(t).min <= low and high <= np.iinfo(t).max)
+        values = values.astype(dtype)
+        info.update(mode="quantized", step=step)
+    else:
+        axis = 0 if block.shape[0] > 1 else 1
+        values = block.view(f"u{block.itemsize}") if is_float else block.astype(np.uint8) if block.dtype == bool else block
+        if values.shape[axis] > 1:
+            if is_float:
+                values = np.concatenate((values.take([0], axis), np.bitwise_xor(values.take(np.arange(1, values.shape[axis]), axis),
+                                                                                values.take(np.arange(values.shape[axis] - 1), axis))), axis=axis)
+            else:
+                values = np.concatenate((values.take([0], axis), np.diff(values, axis=axis)), axis=axis)
+        else:
+            axis = -1
+        dtype = values.dtype
+        info.update(mode="lossless")
+
+    info.update(dtype=np.dtype(dtype).str, axis=int(axis))
+    return compress(shuffleBytes(values), codec), info
+
+
+def decodeChunk(raw: bytes, info: dict, dtype: np.dtype, codec: str) -> np.ndarray:
+    '''
+    Decode a block encoded by encodeChunk to its original dtype
+    '''
+    values = unshuffleBytes(decompress(raw, codec), info["dtype"], tuple(info["shape"]))
+    axis = info["axis"]
+    if info["mode"] == "quantized":
+        if axis >= 0:
+            values = np.cumsum(values, axis=axis, dtype=np.int64)
+        return (values*info["step"]).astype(dtype)
+
+    is_float = np.issubdtype(dtype, np.floating)
+    if axis >= 0:
+        values = np.bitwise_xor.accumulate(values, axis=axis) if is_float else np.cumsum(values, axis=axis, dtype=values.dtype)
+    return values.view(dtype) if is_float else values.astype(dtype)
+
+
+class ArchiveWriter:
+    '''
+    Writes data arrays to a chunked, compressed archive file
+
+    Chunks are appended as they are encoded, so arrays larger than memory (e.g. memory mapped filterbank files)
+    are archived a chunk of rows at a time. The index of all arrays is written at the end on close, and the file only
+    replaces path once complete
+    '''
+    def __init__(self, path: str, codec: str = "zlib") -> None:
+        if codec not in ARCHIVE_CODECS:
+            print(f"Unknown archive codec {codec}... using zlib")
+            codec = "zlib"
+        self.path = path
+        self.codec = codec
+        self.file = open(path+".tmp", "wb")
+        self.file.write(ARCHIVE_MAGIC)
+        self.arrays = {}
+
+    def addArray(self, name: str, array: np.ndarray, precision: float = 0.0, relative: bool = False, attrs: dict = None,
+                 chunk: tuple = (ARCHIVE_CHUNK_ROWS, ARCHIVE_CHUNK_CHANNELS)) -> None:
+        '''
+        Add a 1D or 2D (time samples, channels) array. 1D arrays are stored as a single row
+
+        precision is the largest error of any value (0 is lossless), or with relative the error relative to the values
+        '''
+        shape = tuple(array.shape)
+        if len(shape) > 2:
+            raise ValueError(f"Only 1D and 2D arrays can be archived, {name} has shape {shape}")
+        rows, channels = (1, shape[0] if shape else 1) if len(shape) <= 1 else shape
+        chunks = []
+        for row in range(0, rows, chunk[0]):
+            block = np.asarray(array[row:row+chunk[0]]) if len(shape) == 2 else np.reshape(array, (1, -1))
+            for col in range(0, channels, chunk[1]):
+                raw, info = encodeChunk(np.ascontiguousarray(block[:, col:col+chunk[1]]), precision, relative, self.codec)
+                info.update(row=row, col=col, offset=self.file.tell(), length=len(raw))
+                self.file.write(raw)
+                chunks.append(info)
+
+        self.arrays[name] = {"shape": list(shape), "dtype": np.dtype(array.dtype).str, "rows": rows, "channels": channels,
+                             "chunk": list(chunk), "precision": precision, "relative": relative, "attrs": attrs or {}, "chunks": chunks}
+
+    def copyArray(self, reader: "ArchiveReader", name: str) -> None:
+        '''
+        Copy an array of another archive without decoding it
+        '''
+        entry = json.loads(json.dumps(reader.arrays[name]))
+        for info in entry["chunks"]:
+            raw = reader.readRaw(info)
+            info["offset"] = self.file.tell()
+            self.file.write(raw)
+        self.arrays[name] = entry
+
+    def close(self) -> None:
+        index = json.dumps({"version": ARCHIVE_VERSION, "codec": self.codec, "arrays": self.arrays}).encode()
+        self.file.write(index)
+        self.file.write(struct.pack("<Q", len(index)))
+        self.file.close()
+        os.replace(self.path+".tmp", self.path)
+
+    def __enter__(self) -> "ArchiveWriter":
+        return self
+
+    def __exit__(self, exc_type, *args) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+            os.remove(self.path+".tmp")
+
+
+class ArchiveReader:
+    '''
+    Reads arrays of an archive file. Indexing by name returns an ArchivedArray, which decodes slices on demand
+    '''
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.file = open(path, "rb")
+        if self.file.read(len(ARCHIVE_MAGIC)) != ARCHIVE_MAGIC:
+            self.file.close()
+            raise ValueError(f"{path} is not an archive file")
+        self.file.seek(-8, os.SEEK_END)
+        index_length = struct.unpack("<Q", self.file.read(8))[0]
+        self.file.seek(-8 - index_length, os.SEEK_END)
+        index = json.loads(self.file.read(index_length))
+        if index["version"] != ARCHIVE_VERSION:
+            self.file.close()
+            raise ValueError(f"Unsupported archive version {index['version']} of {path}")
+        self.codec = index["codec"]
+        self.arrays = index["arrays"]
+
+    def names(self) -> list:
+        return list(self.arrays)
+
+    def getAttrs(self, name: str) -> dict:
+        return self.arrays[name]["attrs"]
+
+    def readRaw(self, info: dict) -> bytes:
+        self.file.seek(info["offset"])
+        return self.file.read(info["length"])
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.arrays
+
+    def __getitem__(self, name: str) -> "ArchivedArray":
+        return ArchivedArray(self, name)
+
+    def close(self) -> None:
+        self.file.close()
+
+    def __enter__(self) -> "ArchiveReader":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+class ArchivedArray:
+    '''
+    Array in an archive, sliced like a numpy array with integers and slices
+
+    Only the chunks a slice overlaps are read and decompressed
+    '''
+    def __init__(self, reader: ArchiveReader, name: str) -> None:
+        self.reader = reader
+        self.entry = reader.arrays[name]
+        self.shape = tuple(self.entry["shape"])
+        self.dtype = np.dtype(self.entry["dtype"])
+        self.ndim = len(self.shape)
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def read(self) -> np.ndarray:
+        '''
+        Decode the whole array
+        '''
+        return self[...]
+
+    def close(self) -> None:
+        '''
+        Close the archive the array is read from
+        '''
+        self.reader.close()
+
+    def __getitem__(self, key) -> np.ndarray:
+        key = () if key is Ellipsis else key if isinstance(key, tuple) else (key,)
+        # 1D arrays are stored as a single row
+        if self.ndim <= 1:
+            key = (0,) + key
+        row_key, col_key = key + (slice(None),)*(2 - len(key))
+
+        block = self.decodeRange(self.indexRange(row_key, self.entry["rows"]), self.indexRange(col_key, self.entry["channels"]))
+        return block[0 if isinstance(row_key, (int, np.integer)) else slice(None), 0 if isinstance(col_key, (int, np.integer)) else slice(None)]
+
+    @staticmethod
+    def indexRange(key, size: int) -> range:
+        if isinstance(key, (int, np.integer)):
+            index = range(size)[key]
+            return range(index, index+1)
+        return range(size)[key]
+
+    def decodeRange(self, row_range: range, col_range: range) -> np.ndarray:
+        '''
+        Decode the rows and channels of two ranges into a (rows, channels) array
+        '''
+        out = np.empty((len(row_range), len(col_range)), dtype=self.dtype)
+        if out.size == 0:
+            return out
+        row_lo, row_hi = min(row_range[0], row_range[-1]), max(row_range[0], row_range[-1]) + 1
+        col_lo, col_hi = min(col_range[0], col_range[-1]), max(col_range[0], col_range[-1]) + 1
+
+        dense = np.empty((row_hi - row_lo, col_hi - col_lo), dtype=self.dtype)
+        for info in self.entry["chunks"]:
+            r0, c0 = info["row"], info["col"]
+            r1, c1 = r0 + info["shape"][0], c0 + info["shape"][1]
+            if r1 <= row_lo or r0 >= row_hi or c1 <= col_lo or c0 >= col_hi:
+                continue
+            chunk = decodeChunk(self.reader.readRaw(info), info, self.dtype, self.reader.codec)
+            rs, re = max(r0, row_lo), min(r1, row_hi)
+            cs, ce = max(c0, col_lo), min(c1, col_hi)
+            dense[rs-row_lo:re-row_lo, cs-col_lo:ce-col_lo] = chunk[rs-r0:re-r0, cs-c0:ce-c0]
+
+        out[:] = dense[np.asarray(row_range) - row_lo][:, np.asarray(col_range) - col_lo]
+        return out
+
+    def verify(self, original: np.ndarray) -> bool:
+        '''
+        Check every chunk against the original array, within the error bound it was encoded with
+        '''
+        original_2d = original if original.ndim == 2 else np.reshape(original, (1, -1))
+        for info in self.entry["chunks"]:
+            r0, c0 = info["row"], info["col"]
+            block = np.asarray(original_2d[r0:r0+info["shape"][0], c0:c0+info["shape"][1]])
+            decoded = decodeChunk(self.reader.readRaw(info), info, self.dtype, self.reader.codec)
+            if info["mode"] == "lossless":
+                if not np.array_equal(decoded, block, equal_nan=np.issubdtype(self.dtype, np.floating)):
+                    return False
+            else:
+                tolerance = info["step"]/2 + np.finfo(self.dtype).eps*np.abs(block.astype(np.float64))*4
+                if np.any(np.abs(decoded.astype(np.float64) - block) > tolerance):
+                    return False
+        return True
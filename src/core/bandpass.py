@@ -0,0 +1,84 @@
+import os
+import json
+import time
+import numpy as np
+
+from core.device_cache import deviceKey
+
+# Cached reference bandpasses, next to config.ini. Every bandpass is a .npy file listed in the index
+BANDPASS_DIR = "bandpass/"
+BANDPASS_INDEX = "bandpass_index.json"
+BANDPASS_VERSION = 1
+
+
+def bandpassKey(driver: str, serial: str, sample_rate: int, bins: int, gain: str, zoom: "ZoomFFT" = None) -> str:
+    '''
+    Key of a bandpass in the cache
+
+    The bandpass is the shape of the analog and digital filters of the SDR, so it depends on the device,
+    sample rate, number of bins and gain, but not on the center frequency. Zoomed spectra cover a window
+    of the band and are cached separately for every decimation and offset
+    '''
+    key = f"{deviceKey(driver, serial)},sample_rate={int(sample_rate)},bins={int(bins)},gain={gain}"
+    if zoom is not None:
+        key += f",zoom={zoom.decimation}@{int(zoom.offset)}"
+    return key
+
+
+def loadBandpassIndex() -> dict:
+    '''
+    Load the bandpass index. A missing, unreadable or outdated index is returned empty
+    '''
+    path = BANDPASS_DIR+BANDPASS_INDEX
+    empty = {"version": BANDPASS_VERSION, "bandpasses": {}}
+    if not os.path.isfile(path):
+        return empty
+    try:
+        with open(path, "r") as index_file:
+            index = json.load(index_file)
+    except (OSError, ValueError):
+        return empty
+    if index.get("version") != BANDPASS_VERSION:
+        return empty
+    return index
+
+
+def saveBandpassIndex(index: dict) -> None:
+    '''
+    Save the bandpass index, replacing the file in one step so readers never see a partial index
+    '''
+    path = BANDPASS_DIR+BANDPASS_INDEX
+    with open(path+".tmp", "w") as index_file:
+        json.dump(index, index_file, indent=4)
+    os.replace(path+".tmp", path)
+
+
+def loadBandpass(key: str) -> "np.ndarray | None":
+    '''
+    Return the cached bandpass of the given key, memory mapped, or None if there is none
+    '''
+    entry = loadBandpassIndex()["bandpasses"].get(key)
+    if entry is None or not os.path.isfile(BANDPASS_DIR+entry["file"]):
+        return None
+    return np.load(BANDPASS_DIR+entry["file"], mmap_mode="r")
+
+
+def saveBandpass(key: str, spectrum: np.ndarray, n_ffts: int) -> np.ndarray:
+    '''
+    Normalize an averaged linear power spectrum to a mean of 1 and cache it as the bandpass of the given key
+
+    Returns the normalized bandpass
+    '''
+    os.makedirs(BANDPASS_DIR, exist_ok=True)
+    bandpass = (spectrum/np.mean(spectrum)).astype(np.float32)
+
+    # The file name only has to be unique, the key is kept in the index
+    index = loadBandpassIndex()
+    entry = index["bandpasses"].get(key)
+    file_name = entry["file"] if entry is not None else f"bandpass_{len(index['bandpasses'])}_{int(time.time())}.npy"
+    np.save(BANDPASS_DIR+file_name+".tmp.npy", bandpass)
+    os.replace(BANDPASS_DIR+file_name+".tmp.npy", BANDPASS_DIR+file_name)
+
+    index["bandpasses"][key] = {"file": file_name, "created": time.strftime("%Y-%m-%d %H:%M:%S"), "ffts": int(n_ffts)}
+    saveBandpassIndex(index)
+    return bandpass
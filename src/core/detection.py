@@ -0,0 +1,145 @@
+import numpy as np
+from scipy.ndimage import maximum_filter1d
+
+from core.fitting import GaussianModel
+
+# Standard deviations (in channels) of the Gaussian matched filters
+DEFAULT_WIDTHS = (2, 4, 8, 16, 32)
+# Spectra searched at once, which bounds the (n_widths, n_spectra, n_fft) intermediates of the matched filter
+SEARCH_CHUNK = 64
+
+
+def maskedMedian(data: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    '''
+    Median of each row of a (n_spectra, n_channels) array, leaving out channels where mask is True
+    '''
+    count = np.maximum(np.sum(~mask, axis=1), 1)
+    ordered = np.sort(np.where(mask, np.inf, data), axis=1)
+    lower = np.take_along_axis(ordered, ((count - 1)//2)[:, None], axis=1)[:, 0]
+    upper = np.take_along_axis(ordered, (count//2)[:, None], axis=1)[:, 0]
+    return 0.5*(lower + upper)
+
+
+def estimateNoise(data: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    '''
+    Robust estimate of the noise standard deviation of each row from the median absolute deviation
+    '''
+    med = maskedMedian(data, mask)
+    return 1.4826*maskedMedian(np.abs(data - med[:, None]), mask)
+
+
+def removeBaseline(data: np.ndarray, mask: np.ndarray = None) -> np.ndarray:
+    '''
+    Subtract a linear baseline from each spectrum in a (n_spectra, n_channels) array
+
+    Channels where mask is True (e.g. line channels) are left out of the baseline fit
+    '''
+    X = np.arange(data.shape[-1], dtype=np.float64)
+    w = np.ones(data.shape) if mask is None else (~mask).astype(np.float64)
+
+    # Weighted least squares line fit of all spectra at once from the normal equations
+    S0, S1, S2 = np.sum(w, axis=1), w @ X, w @ X**2
+    T0, T1 = np.sum(w*data, axis=1), np.sum(w*data*X, axis=1)
+    det = S0*S2 - S1**2
+    det[det == 0] = np.inf
+    slope = (S0*T1 - S1*T0)/det
+    intersect = (T0 - slope*S1)/np.maximum(S0, 1)
+
+    return data - (intersect[:, None] + slope[:, None]*X[None, :])
+
+
+def matchedFilter(data: np.ndarray, widths: tuple) -> tuple:
+    '''
+    Filter each spectrum of a (n_spectra, n_channels) array with Gaussians of the given widths (in channels)
+
+    All spectra and widths are filtered at once with FFTs, so large surveys should be passed in chunks
+    Returns the amplitude estimates and the filter norms, as (n_widths, n_spectra, n_channels) and (n_widths,) arrays
+    '''
+    n = data.shape[-1]
+    n_fft = 1 << int(np.ceil(np.log2(n + 6*max(widths))))
+    # Kernels centered on index 0, wrapping around, so the convolution is not shifted
+    idx = np.fft.fftfreq(n_fft, 1/n_fft)
+    kernels = np.exp(-0.5*(idx[None, :]/np.asarray(widths, dtype=float)[:, None])**2)
+    norms = np.sum(kernels**2, axis=1)
+
+    # Zero padding keeps the edges from wrapping into each other, as the spectra are expected to be baseline removed
+    spectra = np.fft.rfft(data, n=n_fft, axis=-1)
+    filtered = np.fft.irfft(spectra[None, :, :]*np.fft.rfft(kernels, axis=-1)[:, None, :], n=n_fft, axis=-1)[..., :n]
+
+    return filtered/norms[:, None, None], np.sqrt(norms)
+
+
+def searchPeaks(flat: np.ndarray, noise: np.ndarray, widths: tuple, threshold: float, max_lines: int) -> tuple:
+    '''
+    Find the strongest matched filter peaks of each baseline removed spectrum in a (n_spectra, n_channels) array
+
+    Spectra are searched SEARCH_CHUNK at a time, so memory use does not grow with the number of spectra.
+    Returns channels, amplitudes, widths (in channels) and validity of up to max_lines peaks per spectrum,
+    each as a (n_spectra, max_lines) array
+    '''
+    chunks = [searchChunk(flat[i:i+SEARCH_CHUNK], noise[i:i+SEARCH_CHUNK], widths, threshold, max_lines)
+              for i in range(0, flat.shape[0], SEARCH_CHUNK)]
+    return tuple(np.concatenate(result) for result in zip(*chunks))
+
+
+def searchChunk(flat: np.ndarray, noise: np.ndarray, widths: tuple, threshold: float, max_lines: int) -> tuple:
+    '''
+    Matched filter peak search of a chunk of spectra, see searchPeaks
+    '''
+    # Signal to noise ratio of each filter. Best scale per channel is the one with highest SNR
+    amplitudes, norms = matchedFilter(flat, widths)
+    snr = np.abs(amplitudes)*norms[:, None, None]/noise[None, :, None]
+    best_scale = np.argmax(snr, axis=0)
+    best_snr = np.take_along_axis(snr, best_scale[None], axis=0)[0]
+    best_amp = np.take_along_axis(amplitudes, best_scale[None], axis=0)[0]
+
+    # Peaks are channels above threshold that are the highest within two standard deviations of their best filter
+    local_max = np.stack([maximum_filter1d(best_snr, size=4*w+1, axis=1, mode="nearest") for w in widths])
+    is_peak = (best_snr == np.take_along_axis(local_max, best_scale[None], axis=0)[0]) & (best_snr > threshold)
+    score = np.where(is_peak, best_snr, -np.inf)
+
+    top = np.argsort(-score, axis=1)[:, :min(max_lines, flat.shape[1])]
+    valid = np.take_along_axis(score, top, axis=1) > threshold
+    rows = np.arange(flat.shape[0])[:, None]
+
+    return top, best_amp[rows, top], np.asarray(widths)[best_scale[rows, top]], valid
+
+
+def detectLines(vel: np.ndarray, data: np.ndarray, widths: tuple = DEFAULT_WIDTHS, threshold: float = 5.0, max_lines: int = 5):
+    '''
+    Find spectral line candidates with a multi-scale matched filter search and return them as initial guesses for fitting
+
+    vel and data are either single spectra or (n_spectra, n_channels) arrays with one spectrum per row.
+    A linear baseline is removed before searching. Candidates are peaks where the matched filter
+    signal to noise ratio exceeds threshold, keeping the max_lines strongest per spectrum.
+    The search is done twice, the second time with the baseline and noise estimated without the channels of the first candidates.
+
+    Returns a GaussianModel for a single spectrum or a list of GaussianModels
+    '''
+    single = np.ndim(data) == 1
+    data = np.atleast_2d(np.asarray(data, dtype=np.float64))
+    vel = np.broadcast_to(np.atleast_2d(np.asarray(vel, dtype=np.float64)), data.shape)
+    n_spec, n = data.shape
+
+    mask = np.zeros(data.shape, dtype=bool)
+    for _ in range(2):
+        flat = removeBaseline(data, mask)
+        flat -= maskedMedian(flat, mask)[:, None]
+        noise = estimateNoise(flat, mask)
+        noise[~(noise > 0)] = np.inf
+
+        channels, A, STD, valid = searchPeaks(flat, noise, widths, threshold, max_lines)
+
+        # Mask three standard deviations around each candidate
+        mask = np.zeros(data.shape, dtype=bool)
+        for k in range(channels.shape[1]):
+            mask |= (np.abs(np.arange(n)[None, :] - channels[:, k, None]) <= 3*STD[:, k, None]) & valid[:, k, None]
+
+    continuum = np.median(data - flat, axis=1)
+    rows = np.arange(n_spec)[:, None]
+    channel_width = np.median(np.abs(np.diff(vel, axis=1)), axis=1)
+    MU = vel[rows, channels]
+    STD = STD*channel_width[:, None]
+
+    models = [GaussianModel(C=float(continuum[i]), A=A[i][valid[i]], MU=MU[i][valid[i]], STD=STD[i][valid[i]]) for i in range(n_spec)]
+    return models[0] if single else models
@@ -0,0 +1,83 @@
+import os
+import json
+from dataclasses import dataclass, asdict
+
+# Cache of discovered devices and their capabilities, next to config.ini
+DEVICE_CACHE_PATH = "device_cache.json"
+DEVICE_CACHE_VERSION = 1
+
+
+@dataclass
+class DeviceCapabilities:
+    '''
+    Capabilities of an SDR as probed from the device
+     - frequency_range      Lowest and highest tunable frequency in Hz
+     - sample_rates         Supported sample rates in Hz
+     - bandwidths           Supported analog bandwidths in Hz
+     - tunable_elements     Tunable elements, e.g. RF and CORR for PPM correction
+    '''
+    frequency_range: list
+    sample_rates: list
+    bandwidths: list
+    tunable_elements: list
+
+    def toDict(self) -> dict:
+        '''
+        Return capabilities as a json serializable dictionary
+        '''
+        return asdict(self)
+
+    @classmethod
+    def fromDict(cls, capabilities: dict) -> "DeviceCapabilities":
+        '''
+        Create capabilities from a dictionary as returned by toDict
+        '''
+        return cls(**{key: list(capabilities[key]) for key in ("frequency_range", "sample_rates", "bandwidths", "tunable_elements")})
+
+
+def deviceKey(driver: str, serial: str = "") -> str:
+    '''
+    Key of a device in the cache
+    '''
+    return f"driver={driver},serial={serial}"
+
+
+def emptyDeviceCache() -> dict:
+    '''
+    Return a cache without any devices
+    '''
+    return {"version": DEVICE_CACHE_VERSION, "devices": None, "capabilities": {}}
+
+
+def loadDeviceCache() -> dict:
+    '''
+    Load the device cache. A missing, unreadable or outdated cache is returned empty
+    '''
+    if not os.path.isfile(DEVICE_CACHE_PATH):
+        return emptyDeviceCache()
+    try:
+        with open(DEVICE_CACHE_PATH, "r") as cache_file:
+            cache = json.load(cache_file)
+    except (OSError, ValueError):
+        return emptyDeviceCache()
+    if cache.get("version") != DEVICE_CACHE_VERSION:
+        return emptyDeviceCache()
+    return cache
+
+
+def saveDeviceCache(cache: dict) -> None:
+    '''
+    Save the device cache, replacing the file in one step so readers never see a partial cache
+    '''
+    tmp_path = DEVICE_CACHE_PATH+".tmp"
+    with open(tmp_path, "w") as cache_file:
+        json.dump(cache, cache_file, indent=4)
+    os.replace(tmp_path, DEVICE_CACHE_PATH)
+
+
+def invalidateDeviceCache() -> None:
+    '''
+    Forget all cached devices and capabilities, so they are probed again when next needed
+    '''
+    if os.path.isfile(DEVICE_CACHE_PATH):
+        os.remove(DEVICE_CACHE_PATH)
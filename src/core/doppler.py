@@ -0,0 +1,110 @@
+import time
+import numpy as np
+from astropy.time import Time
+
+import core.dsp as DSP
+
+
+class DopplerTracker:
+    '''
+    Doppler tracked integration onto a fixed LSR velocity grid
+
+    Power spectra are summed into sub-integrations of interval seconds, each timestamped with its mid time.
+    At the end the LSR corrections of all sub-integrations are computed in one vectorized transformation,
+    and every sub-integration is shifted by the fractional number of channels its correction differs from the
+    mean correction before they are summed. Over long integrations this keeps the rotation and orbit of the
+    Earth from smearing lines across channels.
+
+    The LSR velocity changes by much less than a channel within a minute, so sub-integrations can be long and
+    the shifting costs a few operations per channel and sub-integration, next to nothing compared with the FFTs.
+    '''
+    def __init__(self, n_bins: int, ground_station: "GroundStation", antenna: "Antenna", rest_freq: float, interval: float = 60.0) -> None:
+        self.ground_station = ground_station
+        self.antenna = antenna
+        self.rest_freq = rest_freq
+        self.interval = interval
+
+        # Current sub-integration, summed per channel with the number of spectra in each channel
+        self.total = np.zeros(n_bins)
+        self.weights = np.zeros(n_bins)
+        self.start = None
+
+        # Completed sub-integrations
+        self.subints = []
+        self.subint_weights = []
+        self.times = []
+
+        self.corrections = np.zeros(0)
+        self.reference_correction = 0.0
+
+    def add(self, psd: np.ndarray, weights: "np.ndarray | float" = 1) -> None:
+        '''
+        Add a power spectrum, or a sum of spectra with the number of spectra per channel as weights
+        '''
+        now = time.time()
+        if self.start is None:
+            self.start = now
+        self.total += psd
+        self.weights += weights
+        if now - self.start >= self.interval:
+            self.flush(now)
+
+    def flush(self, now: float = None) -> None:
+        '''
+        Complete the current sub-integration
+        '''
+        if self.start is None:
+            return
+        now = time.time() if now is None else now
+        self.subints.append(self.total.copy())
+        self.subint_weights.append(self.weights.copy())
+        self.times.append((self.start + now)/2)
+        self.total[:] = 0
+        self.weights[:] = 0
+        self.start = None
+
+    def getSpectrum(self, freqs: np.ndarray, bandpass: np.ndarray = None) -> np.ndarray:
+        '''
+        Flush the current sub-integration and return the average spectrum on the velocity grid of the mean LSR correction
+
+        freqs are the topocentric channel frequencies. The mean correction is kept in reference_correction,
+        so the velocity axis of the spectrum is freqToVel(freqs) - reference_correction.
+        A bandpass is fixed to the channels of the SDR, so it is divided out of every sub-integration before shifting
+        '''
+        self.flush()
+        if not self.subints:
+            return np.full(freqs.size, np.nan)
+
+        times = Time(np.array(self.times), format="unix")
+        coords = self.antenna.getCoordinatesAt(self.ground_station, times)
+        self.corrections = np.atleast_1d(self.ground_station.getLSRCorrectionsAt(ra = coords["ra"], dec = coords["dec"], times = times))
+        self.reference_correction = float(np.mean(self.corrections))
+
+        # The radio velocity is linear in frequency, so a velocity correction is the same shift for every channel
+        velocities = self.ground_station.freqToVel(rest_freq = self.rest_freq, freq = freqs)
+        channel_width = (velocities[-1] - velocities[0])/(velocities.size - 1)
+        shifts = (self.corrections - self.reference_correction)/channel_width
+
+        total = np.zeros(freqs.size)
+        weights = np.zeros(freqs.size)
+        for subint, subint_weights, shift in zip(self.subints, self.subint_weights, shifts):
+            if bandpass is not None:
+                subint = subint/bandpass
+            total += DSP.fractionalShift(subint, shift)
+            weights += DSP.fractionalShift(subint_weights, shift)
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            spectrum = total/weights
+
+        # Edge channels only covered by shifted-out data are filled from their neighbours
+        bad = weights == 0
+        if np.any(bad) and not np.all(bad):
+            idx = np.arange(spectrum.size)
+            spectrum[bad] = np.interp(idx[bad], idx[~bad], spectrum[~bad])
+        return spectrum
+
+    def getMaxShift(self) -> float:
+        '''
+        Return the largest LSR velocity change over the integration in km/s
+        '''
+        return float(np.ptp(self.corrections)) if self.corrections.size > 0 else 0.0
@@ -1,39 +1,309 @@
+from dataclasses import dataclass
 import numpy as np
+from scipy.ndimage import median_filter, gaussian_filter1d, convolve1d
+from scipy.signal import savgol_filter, firwin
 
 def doFFT(bins, n_bins: int):
     '''
     Perform FFT on the given bins
+
+    Stacks of blocks, shaped (n_blocks, n_bins), are transformed block by block in one call
     '''
-    PSD = (np.abs(np.fft.fft(bins))/n_bins)**2
-    fft_bins = np.fft.fftshift(PSD)
+    PSD = (np.abs(np.fft.fft(bins, axis=-1))/n_bins)**2
+    fft_bins = np.fft.fftshift(PSD, axes=-1)
     return fft_bins
 
 
+def nativeToComplex(raw: np.ndarray, full_scale: float, out: np.ndarray) -> np.ndarray:
+    '''
+    Convert interleaved integer I/Q samples (CS16 or CS8) to complex64 samples in [-1, 1]
+
+    The samples are scaled straight into the preallocated complex64 array out, viewed as interleaved float32,
+    so the conversion is a single pass without temporary arrays and out can be passed to the FFT as is
+    '''
+    np.multiply(raw, np.float32(1/full_scale), out=out.view(np.float32), casting="unsafe")
+    return out
+
+
+def fractionalShift(bins: np.ndarray, shift: float) -> np.ndarray:
+    '''
+    Return bins shifted by a fractional number of bins, so that out[k] = bins[k + shift]
+
+    Values between bins are linearly interpolated, and bins shifted in from outside the array are 0
+    '''
+    offset = int(np.floor(shift))
+    frac = shift - offset
+    n = bins.size
+    out = np.zeros(n, dtype=np.float64)
+
+    # Range of output bins where both neighbours bins[k+offset] and bins[k+offset+1] exist
+    lo = max(0, -offset)
+    hi = min(n, n - offset - (1 if frac > 0 else 0))
+    if hi <= lo:
+        return out
+    out[lo:hi] = bins[lo+offset:hi+offset]
+    if frac > 0:
+        out[lo:hi] *= 1 - frac
+        out[lo:hi] += frac*bins[lo+offset+1:hi+offset+1]
+    return out
+
+
+def bandPower(samples: np.ndarray, n_subbands: int = 1) -> np.ndarray:
+    '''
+    Mean power |x|^2 of a block of samples, as an array with one value per sub-band
+
+    The full band is reduced with a single dot product. Sub-bands are the bins of short FFTs of n_subbands samples,
+    averaged over the block, so the sub-band powers add up to the power of the full band
+    '''
+    if n_subbands <= 1:
+        return np.array([np.vdot(samples, samples).real/samples.size])
+    n_ffts = samples.size//n_subbands
+    return doFFT(bins = samples[:n_ffts*n_subbands].reshape(n_ffts, n_subbands), n_bins = n_subbands).mean(axis=0)
+
+
+# Taps per polyphase branch of the zoom FFT decimation filter, and the part of the decimated band it passes
+ZOOM_TAPS_PER_PHASE = 32
+ZOOM_PASSBAND = 0.9
+
+class ZoomFFT:
+    '''
+    High resolution spectrum of a narrow window of the band, by digital downconversion before a small FFT
+
+    Each block of samples is mixed by a numerically controlled oscillator (NCO) so the window at offset Hz from
+    the center frequency is moved to 0 Hz, low pass filtered and decimated by a polyphase FIR filter, and the
+    decimated samples are transformed in FFTs of n_bins. The NCO phase and the filter history carry over between
+    blocks, so a stream is processed as if it was one long signal.
+
+    The channels are decimation times narrower than those of an FFT of n_bins over the whole band, while the work per
+    sample is a fixed number of filter taps instead of growing with the FFT size, and only n_bins channels are kept.
+    The outer (1 - ZOOM_PASSBAND) of the window is in the roll-off of the filter.
+    '''
+    def __init__(self, sample_rate: float, offset: float, decimation: int, n_bins: int, taps_per_phase: int = ZOOM_TAPS_PER_PHASE) -> None:
+        self.sample_rate = sample_rate
+        self.offset = offset
+        self.decimation = int(decimation)
+        self.n_bins = n_bins
+        self.taps_per_phase = taps_per_phase
+
+        # Polyphase branches, row j holding taps j*decimation ... (j+1)*decimation-1 reversed
+        taps = firwin(taps_per_phase*self.decimation, ZOOM_PASSBAND/self.decimation)
+        self.branches = np.ascontiguousarray(taps.reshape(taps_per_phase, self.decimation)[:, ::-1]).astype(np.complex64)
+
+        self.nco = None
+        self.cycles = 0.0
+        self.history = np.zeros(((taps_per_phase-1)*self.decimation), dtype=np.complex64)
+        self.buffer = None
+        self.pending = np.zeros(0, dtype=np.complex64)
+
+    def getFrequencies(self, center_freq: float) -> np.ndarray:
+        '''
+        Return the frequency of each channel of the zoomed spectrum for an SDR tuned to center_freq
+        '''
+        return center_freq + self.offset + np.fft.fftshift(np.fft.fftfreq(self.n_bins, self.decimation/self.sample_rate))
+
+    def isInBand(self) -> bool:
+        '''
+        Return True if the whole window lies within the sampled band. Otherwise part of it is aliased from outside the band
+        '''
+        return abs(self.offset) + self.sample_rate/(2*self.decimation) <= self.sample_rate/2
+
+    def process(self, samples: np.ndarray) -> np.ndarray:
+        '''
+        Downconvert and decimate a block of samples, whose length must be a multiple of decimation
+
+        Returns the power spectra of all FFTs completed by the block, shaped (n_spectra, n_bins)
+        '''
+        n = samples.size
+        D, P = self.decimation, self.taps_per_phase
+        if n % D != 0:
+            raise ValueError(f"Block of {n} samples is not a multiple of the decimation {D}")
+
+        # Preallocated filter input: the filter history followed by the mixed block, one row per output sample
+        if self.buffer is None or self.buffer.shape[0] != P-1 + n//D:
+            self.buffer = np.zeros((P-1 + n//D, D), dtype=np.complex64)
+            self.nco = np.exp(-2j*np.pi*self.offset/self.sample_rate*np.arange(n)).astype(np.complex64)
+        flat = self.buffer.reshape(-1)
+        flat[:self.history.size] = self.history
+
+        # NCO mix, continuing the phase of the previous block
+        mixed = flat[self.history.size:]
+        np.multiply(samples, self.nco, out=mixed)
+        mixed *= np.complex64(np.exp(-2j*np.pi*self.cycles))
+        self.cycles = (self.cycles + self.offset/self.sample_rate*n) % 1.0
+        self.history[:] = flat[flat.size-self.history.size:]
+
+        # Polyphase decimation, one matrix-vector product per branch over contiguous rows
+        M = n//D
+        decimated = self.buffer[P-1:P-1+M] @ self.branches[0]
+        for j in range(1, P):
+            decimated += self.buffer[P-1-j:P-1-j+M] @ self.branches[j]
+
+        # FFTs of n_bins over the decimated samples, keeping what is left for the next block
+        if self.pending.size > 0:
+            decimated = np.concatenate((self.pending, decimated))
+        n_ffts = decimated.size//self.n_bins
+        self.pending = decimated[n_ffts*self.n_bins:].copy()
+        return doFFT(bins = decimated[:n_ffts*self.n_bins].reshape(n_ffts, self.n_bins), n_bins = self.n_bins)
+
+
+# Shortest run of zero samples counted as dropped in native (integer) streams, where quiet samples can quantize to exactly 0
+NATIVE_MIN_DROPOUT_RUN = 16
+
+
+@dataclass
+class DropoutStats:
+    '''
+    Statistics of dropped samples during an observation
+     - blocks           Number of blocks checked
+     - dropped_samples  Total number of dropped samples
+     - runs             Number of runs of consecutive dropped samples
+     - longest_run      Length of the longest run
+     - empty_blocks     Number of blocks where every sample was dropped (not integrated)
+    '''
+    blocks: int = 0
+    dropped_samples: int = 0
+    runs: int = 0
+    longest_run: int = 0
+    empty_blocks: int = 0
+
+
+class DropoutRepair:
+    '''
+    Repairs runs of dropped (zero) samples in blocks of IQ samples, in place and before the FFT
+
+    mode is either "interpolate", linearly interpolating across each run, or "blank",
+    leaving the run at zero and rescaling the block to make up for the lost power.
+    Only runs of at least min_run zero samples are dropouts, so legitimate zeros of integer streams are kept
+    (see NATIVE_MIN_DROPOUT_RUN and minDropoutRun).
+    Blocks without dropouts cost one comparison into a preallocated mask and a count.
+    '''
+    MODES = ("interpolate", "blank")
+
+    def __init__(self, n_samples: int, mode: str = "interpolate", min_run: int = 1) -> None:
+        if mode not in self.MODES:
+            print(f"Unknown dropout repair mode {mode}... using interpolate")
+            mode = "interpolate"
+        self.mode = mode
+        self.min_run = max(int(min_run), 1)
+        self.mask = np.empty(n_samples, dtype=bool)
+        self.stats = DropoutStats()
+
+    def __call__(self, samples: np.ndarray) -> bool:
+        '''
+        Repair block of samples in place
+
+        Returns False if every sample was dropped and the block should be skipped
+        '''
+        self.stats.blocks += 1
+        mask = self.mask[:samples.size]
+        np.equal(samples, 0, out=mask)
+        n_dropped = int(np.count_nonzero(mask))
+        if n_dropped == 0:
+            return True
+
+        # Run lengths from the edges of the mask
+        edges = np.diff(mask.view(np.int8), prepend=np.int8(0), append=np.int8(0))
+        starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+        run_lengths = ends - starts
+        if self.min_run > 1 and run_lengths.min() < self.min_run:
+            # Clear the short runs from the mask
+            short = run_lengths < self.min_run
+            marks = np.zeros(samples.size + 1, dtype=np.int32)
+            np.add.at(marks, starts[short], 1)
+            np.add.at(marks, ends[short], -1)
+            mask &= np.cumsum(marks[:-1]) == 0
+            run_lengths = run_lengths[~short]
+            n_dropped = int(run_lengths.sum())
+            if n_dropped == 0:
+                return True
+
+        self.stats.dropped_samples += n_dropped
+        self.stats.runs += run_lengths.size
+        self.stats.longest_run = max(self.stats.longest_run, int(run_lengths.max()))
+
+        if n_dropped == samples.size:
+            self.stats.empty_blocks += 1
+            return False
+
+        if self.mode == "interpolate":
+            bad = np.flatnonzero(mask)
+            good = np.flatnonzero(~mask)
+            samples.real[bad] = np.interp(bad, good, samples.real[good])
+            if np.iscomplexobj(samples):
+                samples.imag[bad] = np.interp(bad, good, samples.imag[good])
+        else:
+            # Amplitude scale, so the mean power of the block is preserved
+            samples *= np.sqrt(samples.size/(samples.size - n_dropped))
+
+        return True
+
+
+def minDropoutRun(stream_format: str) -> int:
+    '''
+    Shortest run of zero samples that is a dropout for the [SDR] stream_format (cf32 or native)
+    '''
+    return NATIVE_MIN_DROPOUT_RUN if stream_format == "native" else 1
+
+
 def checkForZero(bins):
     '''
-    Replace dropped samples with mean of neighbors
+    Replace dropped samples by interpolating between neighbors
     '''
-    index = np.array(np.where(bins == 0))
-    if index.size == 0:
-        return bins
-    print('Dropped sample was recovered!')
-    bins[index] = np.mean(bins[index+1]+bins[index-1])
-    
+    DropoutRepair(bins.size)(bins)
     return bins
 
 
-def applySmoothing(bins, num: int = 15):
-    '''
-    Perform median smoothing on the given bins
+SMOOTHING_METHODS = ("boxcar", "median", "gaussian", "hanning", "savgol")
 
-    Smoothing factor must be odd number for padding to work
+def applySmoothing(bins, num: int = 15, method: str = "boxcar", axis: int = -1):
     '''
-    if num%2==0:
-        print("Smoothing factor must be odd!")
-        return bins
+    Smooth the given bins with a window of num bins along axis
 
-    padded = np.pad(bins, pad_width=int((num-1)/2), mode="reflect")
-    return np.convolve(padded, np.ones(num)/num, "valid")
+    Methods:
+     - boxcar       Running mean, from cumulative sums so the cost does not depend on num
+     - median       Running median, using the O(n log num) sliding window of scipy for each spectrum
+     - gaussian     Gaussian kernel with a FWHM of num bins
+     - hanning      Hanning window kernel of num bins
+     - savgol       Savitzky-Golay filter of second order (num is rounded up to an odd number)
+    
+    Any width is allowed. Edges are handled by reflection. Works on single spectra and on stacks of spectra
+    '''
+    bins = np.asarray(bins, dtype=np.float64)
+    num = int(num)
+    if num <= 1 or bins.shape[axis] < 2:
+        return bins.copy()
+    
+    if method == "boxcar":
+        # Window of bins [i - num//2, i + num - num//2 - 1] from differences of the cumulative sum
+        padded = np.pad(np.moveaxis(bins, axis, -1), [(0, 0)]*(bins.ndim-1) + [(num//2, num - 1 - num//2)], mode="reflect")
+        cumsum = np.cumsum(padded, axis=-1)
+        smoothed = np.empty(cumsum.shape[:-1] + (cumsum.shape[-1] - num + 1,))
+        smoothed[..., 0] = cumsum[..., num-1]
+        smoothed[..., 1:] = cumsum[..., num:] - cumsum[..., :-num]
+        return np.moveaxis(smoothed/num, -1, axis)
+    
+    elif method == "median":
+        # The 1D filter of scipy is O(n log num), while a multi-dimensional window is not, so filter one spectrum at a time
+        moved = np.moveaxis(bins, axis, -1)
+        rows = moved.reshape(-1, moved.shape[-1])
+        smoothed = np.empty_like(rows)
+        for i in range(rows.shape[0]):
+            smoothed[i] = median_filter(rows[i], size=num, mode="reflect")
+        return np.moveaxis(smoothed.reshape(moved.shape), -1, axis)
+    
+    elif method == "gaussian":
+        return gaussian_filter1d(bins, sigma=num/(2*np.sqrt(2*np.log(2))), axis=axis, mode="reflect")
+    
+    elif method == "hanning":
+        kernel = np.hanning(num + 2)[1:-1]
+        return convolve1d(bins, kernel/np.sum(kernel), axis=axis, mode="reflect")
+    
+    elif method == "savgol":
+        window = min(num + 1 - num%2, bins.shape[axis] - 1 + bins.shape[axis]%2)
+        return savgol_filter(bins, window_length=window, polyorder=min(2, window-1), axis=axis, mode="interp")
+    
+    print(f"Unknown smoothing method {method}!!")
+    return bins
 
 
 def correctSlant(bins):
@@ -42,8 +312,7 @@ def correctSlant(bins):
     '''
     X = np.linspace(0,len(bins) - 1, len(bins))
     slope, intersect = np.polyfit(X, bins, 1)
-    bins = np.array([bins[i] - (intersect + i * slope) for i in range(len(X))])
-    return bins
+    return bins - (intersect + X * slope)
 
 
 def shiftNoiseFloor(bins):
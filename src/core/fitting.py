@@ -0,0 +1,143 @@
+from dataclasses import dataclass, field
+import numpy as np
+from scipy.optimize import least_squares
+
+
+@dataclass
+class GaussianModel:
+    '''
+    Continuum level plus a sum of Gaussian profiles in velocity space
+     - C                Continuum level
+     - A                Amplitudes of the Gaussians
+     - MU               Means of the Gaussians (km/s)
+     - STD              Standard deviations of the Gaussians (km/s)
+    The *_ERR fields hold the one sigma uncertainties after a fit
+    '''
+    C: float
+    A: np.ndarray
+    MU: np.ndarray
+    STD: np.ndarray
+    C_ERR: float = 0.0
+    A_ERR: np.ndarray = field(default_factory=lambda: np.zeros(0))
+    MU_ERR: np.ndarray = field(default_factory=lambda: np.zeros(0))
+    STD_ERR: np.ndarray = field(default_factory=lambda: np.zeros(0))
+    RMS: float = 0.0
+    SUCCESS: bool = False
+
+    def __post_init__(self) -> None:
+        self.A = np.atleast_1d(np.asarray(self.A, dtype=np.float64))
+        self.MU = np.atleast_1d(np.asarray(self.MU, dtype=np.float64))
+        self.STD = np.atleast_1d(np.asarray(self.STD, dtype=np.float64))
+
+    def getParameters(self) -> np.ndarray:
+        '''
+        Return parameter vector [C, A_1..A_N, MU_1..MU_N, STD_1..STD_N]
+        '''
+        return np.concatenate([[self.C], self.A, self.MU, self.STD])
+
+    def evaluate(self, vel: np.ndarray) -> np.ndarray:
+        '''
+        Evaluate model at the given velocities
+        '''
+        return evaluateGaussians(self.getParameters(), vel)
+
+    def toDict(self) -> dict:
+        '''
+        Return model as a dictionary of arrays, e.g. for saving with np.savez
+        '''
+        return {
+            "C": self.C, "A": self.A, "MU": self.MU, "STD": self.STD,
+            "C_ERR": self.C_ERR, "A_ERR": self.A_ERR, "MU_ERR": self.MU_ERR, "STD_ERR": self.STD_ERR,
+            "RMS": self.RMS, "SUCCESS": self.SUCCESS
+        }
+
+    @classmethod
+    def fromDict(cls, model: dict) -> "GaussianModel":
+        '''
+        Create model from a dictionary as returned by toDict (or a loaded npz file)
+        '''
+        return cls(**{k: np.asarray(model[k]).item() if np.ndim(model[k]) == 0 else np.array(model[k]) for k in model.keys()})
+
+    @classmethod
+    def fromParameters(cls, params: np.ndarray) -> "GaussianModel":
+        '''
+        Create model from parameter vector [C, A_1..A_N, MU_1..MU_N, STD_1..STD_N]
+        '''
+        A, MU, STD = np.split(np.asarray(params[1:], dtype=np.float64), 3)
+        return cls(C=float(params[0]), A=A, MU=MU, STD=STD)
+
+
+def evaluateGaussians(params: np.ndarray, vel: np.ndarray) -> np.ndarray:
+    '''
+    Evaluate continuum plus N Gaussians for the parameter vector [C, A_1..A_N, MU_1..MU_N, STD_1..STD_N]
+
+    All Gaussians are evaluated at once as a (N, len(vel)) array
+    '''
+    A, MU, STD = np.split(np.asarray(params[1:]), 3)
+    z = (vel[None, :] - MU[:, None])/STD[:, None]
+    return params[0] + np.sum(A[:, None]*np.exp(-0.5*z**2), axis=0)
+
+
+def gaussianJacobian(params: np.ndarray, vel: np.ndarray) -> np.ndarray:
+    '''
+    Analytic Jacobian of evaluateGaussians with respect to the parameter vector
+
+    Returns (len(vel), 1+3N) array
+    '''
+    A, MU, STD = np.split(np.asarray(params[1:]), 3)
+    dv = vel[None, :] - MU[:, None]
+    e = np.exp(-0.5*(dv/STD[:, None])**2)
+    d_mu = A[:, None]*e*dv/STD[:, None]**2
+    d_std = d_mu*dv/STD[:, None]
+
+    return np.hstack([np.ones((vel.size, 1)), e.T, d_mu.T, d_std.T])
+
+
+def fitGaussians(vel: np.ndarray, data: np.ndarray, guess: GaussianModel) -> GaussianModel:
+    '''
+    Fit continuum plus Gaussians to data in velocity space starting from the initial guess
+
+    Returns a new GaussianModel with fitted parameters and their uncertainties
+    '''
+    vel = np.asarray(vel, dtype=np.float64)
+    data = np.asarray(data, dtype=np.float64)
+    good = np.isfinite(data)
+    vel, data = vel[good], data[good]
+
+    p0 = guess.getParameters()
+    n = guess.A.size
+    if data.size <= p0.size:
+        print("Not enough data points to fit model!!")
+        return guess
+
+    try:
+        res = least_squares(lambda p: evaluateGaussians(p, vel) - data, p0,
+                            jac=lambda p: gaussianJacobian(p, vel), method="lm")
+    except (ValueError, np.linalg.LinAlgError) as e:
+        print(f"Fitting failed: {e}")
+        return guess
+
+    model = GaussianModel.fromParameters(res.x)
+    model.STD = np.abs(model.STD)
+
+    # Uncertainties from the covariance estimate (J^T J)^-1 scaled with the residual variance
+    dof = data.size - p0.size
+    residual_var = np.sum(res.fun**2)/dof
+    try:
+        cov = np.linalg.inv(res.jac.T @ res.jac)*residual_var
+        err = np.sqrt(np.abs(np.diag(cov)))
+    except np.linalg.LinAlgError:
+        err = np.full(p0.size, np.inf)
+
+    model.C_ERR = float(err[0])
+    model.A_ERR, model.MU_ERR, model.STD_ERR = err[1:n+1], err[n+1:2*n+1], err[2*n+1:]
+    model.RMS = float(np.sqrt(residual_var))
+    model.SUCCESS = bool(res.success)
+    return model
+
+
+def fitBatch(jobs: list) -> list:
+    '''
+    Fit a list of (vel, data, guess) tuples. Used to hand chunks of spectra to worker processes
+    '''
+    return [fitGaussians(vel, data, guess) for vel, data, guess in jobs]
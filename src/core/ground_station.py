@@ -85,6 +85,31 @@ class Antenna:
 
         return gal_coord.l.degree, gal_coord.b.degree
 
+    def getCoordinatesAt(self, GS, times: Time) -> dict:
+        '''
+        Return horizontal, equatorial and galactic coordinates of antenna direction at each of the given times
+
+        Takes the respective ground station (instance of GroundStation) and an array valued astropy Time.
+        All times are converted in one transformation per frame
+
+        Returns dictionary of arrays az, alt, ra, dec, lon and lat
+        '''
+        altaz = AltAz(obstime = times, location = GS.QTH, pressure = 0*u.bar)
+        if self.use_eq_coords:
+            eq_coord = SkyCoord(ra = np.full(times.shape, self.RA)*u.degree, dec = np.full(times.shape, self.DEC)*u.degree, frame = "icrs")
+            horizontal_coord = eq_coord.transform_to(altaz)
+        else:
+            horizontal_coord = SkyCoord(AltAz(alt = np.full(times.shape, self.ALT)*u.degree, az = np.full(times.shape, self.AZ)*u.degree,
+                                              pressure = 0*u.bar, obstime = times, location = GS.QTH))
+            eq_coord = horizontal_coord.transform_to(ICRS())
+        gal_coord = eq_coord.transform_to(Galactic())
+
+        return {
+            "az": horizontal_coord.az.degree, "alt": horizontal_coord.alt.degree,
+            "ra": eq_coord.ra.degree, "dec": eq_coord.dec.degree,
+            "lon": gal_coord.l.degree, "lat": gal_coord.b.degree
+        }
+
 
 class GroundStation:
     def __init__(self, lat: float, lon: float, elev: float, time, lsr_correct: bool, antenna: Antenna):
@@ -135,9 +160,21 @@ class GroundStation:
         if not self.lsr_correct:
             return 0
         
+        return self.getLSRCorrectionsAt(ra = ra, dec = dec, times = self.TIME)
+
+    def getLSRCorrectionsAt(self, ra, dec, times: Time) -> "np.ndarray | float":
+        '''
+        Compute the velocity correction for LSR reference frame at each of the given times
+
+        ra and dec are in degrees and may be arrays matching an array valued astropy Time, e.g. the pointing
+        of an antenna fixed in alt/az. All times are corrected in one transformation
+        '''
+        if not self.lsr_correct:
+            return np.zeros(np.shape(times))
+
         sky_coord = SkyCoord(ra=ra*u.degree, dec=dec*u.degree, frame="icrs")
         # Correction wrt. barycenter
-        bary_corr = sky_coord.radial_velocity_correction(obstime = self.TIME, location = self.QTH)
+        bary_corr = sky_coord.radial_velocity_correction(obstime = times, location = self.QTH)
         # Transform to km/s
         bary_corr = bary_corr.to(u.km/u.s)
         # Finally, correction wrt. LSR
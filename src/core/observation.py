@@ -2,8 +2,11 @@ from __future__ import annotations
 
 import os
 import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
+
+from core.archive import ARCHIVE_NAME
+
+# NOTE - pandas and matplotlib are imported in the methods using them, as they are slow
+# to import and only needed once an observation is saved, read or plotted
 
 class Observation:
     def __init__(self, dir: str) -> None:
@@ -11,26 +14,31 @@ class Observation:
         if not os.path.isdir(dir):
             os.mkdir(dir)
         
-        self.DIR = dir.strip("/")+"/"
+        self.DIR = dir.rstrip("/")+"/"
 
         self.FREQUENCY = None
         self.RADIAL_VELOCITY = None
         self.DATA = None
     
     def readInfo(self) -> dict:
-        info = np.load(self.DIR+"observation_info.npz", allow_pickle=True)
-        return info
+        with np.load(self.DIR+"observation_info.npz", allow_pickle=True) as info:
+            return {key: info[key] for key in info.files}
 
-    def writeInfo(self, ground_station: "GroundStation", antenna: "Antenna", sdr: "SDR") -> None:
+    def writeInfo(self, ground_station: "GroundStation", antenna: "Antenna", sdr: "SDR", dropouts: "DropoutStats" = None,
+                  lsr_correction: float = None) -> None:
         '''
         Write observation info to readable txt file and npz file
+
+        Optionally includes dropped sample statistics (instance of DropoutStats)
+        lsr_correction is the correction (km/s) applied to the velocity axis, by default the one at the start of the observation
         '''
         az, alt = antenna.getHorizontalCoordinates(GS=ground_station)
         ra, dec = antenna.getEquatorialCoordinates(GS=ground_station)
         lon, lat = antenna.getGalacticCoordinates(GS=ground_station)
 
         time = ground_station.TIME
-        lsr_correction = ground_station.getLSRCorrection(ra=ra, dec=dec)
+        if lsr_correction is None:
+            lsr_correction = ground_station.getLSRCorrection(ra=ra, dec=dec)
 
         lines = [
             f"Observation time (UTC): {time}",
@@ -39,31 +47,64 @@ class Observation:
             f"Galactic coordinates (lon,lat): {lon}, {lat}",
             f"LSR correction applied (km/s): {lsr_correction}"
         ]
+        dropout_info = {}
+        if dropouts is not None:
+            lines.append(f"Dropped samples (samples, runs, longest run, empty blocks, blocks): {dropouts.dropped_samples}, {dropouts.runs}, {dropouts.longest_run}, {dropouts.empty_blocks}, {dropouts.blocks}")
+            dropout_info["dropouts"] = np.array([dropouts.dropped_samples, dropouts.runs, dropouts.longest_run, dropouts.empty_blocks, dropouts.blocks])
 
         with open(self.DIR+"observation_info.txt", "w") as info_file:
             for line in lines:
                 info_file.write(line+"\n")
         
         np.savez(self.DIR+"observation_info.npz", time = time, horizontal_coords = np.array([az, alt]),
-                equatorial_coords = np.array([ra, dec]), galactic_coords = np.array([lon, lat]), lsr_cor = lsr_correction)
+                equatorial_coords = np.array([ra, dec]), galactic_coords = np.array([lon, lat]), lsr_cor = lsr_correction, **dropout_info)
+
+    @staticmethod
+    def hasData(dir: str) -> bool:
+        '''
+        Return True if dir holds spectral line data, as csv or archive
+        '''
+        dir = dir.rstrip("/")+"/"
+        if os.path.isfile(dir+"observation_data.csv"):
+            return True
+        if not os.path.isfile(dir+ARCHIVE_NAME):
+            return False
+        from core.archive import ArchiveReader
+        with ArchiveReader(dir+ARCHIVE_NAME) as archive:
+            return "data" in archive
 
     def readData(self) -> tuple:
         '''
-        Return tuple of frequency, radial velocity and data
+        Return tuple of frequency, radial velocity and data, from the csv file or else the archive
         '''
+        if not os.path.isfile(self.DIR+"observation_data.csv") and os.path.isfile(self.DIR+ARCHIVE_NAME):
+            from core.archive import ArchiveReader
+            with ArchiveReader(self.DIR+ARCHIVE_NAME) as archive:
+                return archive["frequency"].read(), archive["radial_velocity"].read(), archive["data"].read()
+
+        import pandas as pd
         df = pd.read_csv(self.DIR+"observation_data.csv")
         freqs, radial_vel, data = df["Frequency"], df["Radial velocity"], df["Data"]
 
         return np.ravel(freqs), np.ravel(radial_vel), np.ravel(data)
 
-    def writeData(self, frequency: np.ndarray, radial_velocity: np.ndarray, data: np.ndarray) -> None:
+    def writeData(self, frequency: np.ndarray, radial_velocity: np.ndarray, data: np.ndarray, archive: bool = False,
+                  precision: float = 0.0, codec: str = "zlib") -> None:
         '''
-        Write data to csv file
+        Write data to csv file, or to the compressed archive with data (in dB) off by at most precision
         '''
         self.FREQUENCY = frequency
         self.RADIAL_VELOCITY = radial_velocity
         self.DATA = data
+        if archive:
+            from core.archive import ArchiveWriter
+            with ArchiveWriter(self.DIR+ARCHIVE_NAME, codec) as writer:
+                writer.addArray("frequency", np.asarray(frequency, dtype=np.float64))
+                writer.addArray("radial_velocity", np.asarray(radial_velocity, dtype=np.float64))
+                writer.addArray("data", np.asarray(data, dtype=np.float64), precision=precision)
+            return
 
+        import pandas as pd
         obs_data = {
             "Frequency": frequency,
             "Radial velocity": radial_velocity,
@@ -73,10 +114,145 @@ class Observation:
 
         df.to_csv(self.DIR+"observation_data.csv", encoding="utf-8", index=False)
     
+    def writeSDFITS(self, path: str = None) -> None:
+        '''
+        Write spectrum and info to an SDFITS file, observation_data.fits in the observation directory by default
+        '''
+        from core.sdfits import writeSDFITS
+        writeSDFITS(self.DIR+"observation_data.fits" if path is None else path, [self])
+
+    def writeFlags(self, flags: np.ndarray) -> None:
+        '''
+        Write RFI flag mask (sub-integrations x channels) to npz file
+        '''
+        np.savez_compressed(self.DIR+"observation_flags.npz", flags=np.packbits(flags, axis=1), shape=flags.shape)
+
+    def readFlags(self) -> np.ndarray:
+        '''
+        Return RFI flag mask (sub-integrations x channels)
+        '''
+        with np.load(self.DIR+"observation_flags.npz") as f:
+            return np.unpackbits(f["flags"], axis=1, count=int(f["shape"][1])).astype(bool)
+
+    def writeModel(self, name: str, model: "GaussianModel") -> None:
+        '''
+        Write fitted model to npz file in the observation directory
+        '''
+        np.savez(self.DIR+f"model_{name}.npz", **model.toDict())
+
+    def readModel(self, name: str) -> "GaussianModel":
+        '''
+        Read model with the given name from the observation directory
+        '''
+        from core.fitting import GaussianModel
+        with np.load(self.DIR+f"model_{name}.npz") as model:
+            return GaussianModel.fromDict(model)
+
+    def listModels(self) -> list:
+        '''
+        Return names of models saved with the observation
+        '''
+        return [f[6:-4] for f in sorted(os.listdir(self.DIR)) if f.startswith("model_") and f.endswith(".npz")]
+
+    def writeTimeSeries(self, series: np.ndarray, tsamp: float, dm: float) -> None:
+        '''
+        Write dedispersed time series of a pulsar observation to npy file, with its sample time and DM
+        '''
+        np.save(self.DIR+"observation_series.npy", series.astype(np.float32))
+        np.savez(self.DIR+"observation_series_info.npz", tsamp=tsamp, dm=dm)
+
+    def writeRadiometerData(self, times: np.ndarray, power: np.ndarray, coords: dict, subband_freqs: np.ndarray) -> None:
+        '''
+        Write total power time series to npz file
+
+        times are MJDs, power is a (time samples, sub-bands) array and coords a dictionary of coordinate arrays, one value per time sample
+        '''
+        self.TIMES = times
+        self.POWER = power
+
+        np.savez(self.DIR+"observation_radiometer.npz", time=times, power=power.astype(np.float32),
+                 subband_freqs=subband_freqs, **{key: value.astype(np.float32) for key, value in coords.items()})
+
+    def readRadiometerData(self) -> dict:
+        '''
+        Return dictionary with times (MJD), power, sub-band frequencies and sky coordinates of a total power observation
+        '''
+        if not os.path.isfile(self.DIR+"observation_radiometer.npz") and os.path.isfile(self.DIR+ARCHIVE_NAME):
+            from core.archive import ArchiveReader
+            with ArchiveReader(self.DIR+ARCHIVE_NAME) as archive:
+                return {name[11:]: archive[name].read() for name in archive.names() if name.startswith("radiometer/")}
+        with np.load(self.DIR+"observation_radiometer.npz") as f:
+            return {key: f[key] for key in f.files}
+
+    def plotRadiometerData(self) -> None:
+        '''
+        Plot and save figure of total power against time
+        '''
+        import matplotlib.pyplot as plt
+        FS_label = 16
+        FS_ticks = 12
+
+        fig, ax = plt.subplots(1, 1, figsize=(9,6))
+        t = (self.TIMES - self.TIMES[0])*86400
+        ax.plot(t, 10*np.log10(np.sum(self.POWER, axis=1)), color = "b", linewidth = 0.75)
+        ax.set(xlim=(t[0], t[-1]))
+        ax.set_xlabel(r"Time [$s$]", fontsize = FS_label)
+        ax.set_ylabel(r"Power [$dB$]", fontsize = FS_label)
+        ax.minorticks_on()
+        ax.tick_params(labelsize=FS_ticks)
+        ax.grid(alpha=0.5)
+        plt.tight_layout()
+
+        plt.savefig(self.DIR+"observation_radiometer.png", dpi = 200)
+        plt.close(fig)
+
+    def writeProfile(self, profile: np.ndarray, period: float, dm: float) -> None:
+        '''
+        Write folded pulse profile to csv file
+        '''
+        import pandas as pd
+        self.PROFILE = profile
+        self.PERIOD = period
+
+        df = pd.DataFrame(data={"Phase": np.arange(profile.size)/profile.size, "Profile": profile})
+        df.to_csv(self.DIR+"observation_profile.csv", encoding="utf-8", index=False)
+        np.savez(self.DIR+"observation_profile_info.npz", period=period, dm=dm)
+
+    def readProfile(self) -> tuple:
+        '''
+        Return tuple of phase and folded pulse profile
+        '''
+        import pandas as pd
+        df = pd.read_csv(self.DIR+"observation_profile.csv")
+        return np.ravel(df["Phase"]), np.ravel(df["Profile"])
+
+    def plotProfile(self) -> None:
+        '''
+        Plot and save figure of folded pulse profile, shown over two periods
+        '''
+        import matplotlib.pyplot as plt
+        FS_label = 16
+        FS_ticks = 12
+
+        fig, ax = plt.subplots(1, 1, figsize=(9,6))
+        phase = np.arange(2*self.PROFILE.size)/self.PROFILE.size
+        ax.step(phase, np.tile(self.PROFILE, 2), color = "b", linewidth = 0.75, where = "post")
+        ax.set(xlim=(0, 2))
+        ax.set_xlabel(f"Pulse phase (period {self.PERIOD} s)", fontsize = FS_label)
+        ax.set_ylabel("Intensity", fontsize = FS_label)
+        ax.minorticks_on()
+        ax.tick_params(labelsize=FS_ticks)
+        ax.grid(alpha=0.5)
+        plt.tight_layout()
+
+        plt.savefig(self.DIR+"observation_profile.png", dpi = 200)
+        plt.close(fig)
+
     def plotData(self, plot_limits: tuple) -> None:
         '''
         Plot and save figure of data
         '''
+        import matplotlib.pyplot as plt
         FS_label = 16
         FS_ticks = 12
         FS_title = 18
@@ -115,3 +291,4 @@ class Observation:
         # Save
         file_path = self.DIR+"observation_plot.png"
         plt.savefig(file_path, dpi = 200)
+        plt.close(fig)
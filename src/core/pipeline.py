@@ -0,0 +1,61 @@
+class Pipeline:
+    '''
+    Chain of processing stages where the output of each stage is cached
+
+    Each stage is a function taking the output of the previous stage (None for the first stage) and its parameters as keyword arguments.
+    Changing the parameters of a stage only recomputes that stage and the stages after it.
+    '''
+    def __init__(self) -> None:
+        self.names = []
+        self.funcs = []
+        self.params = []
+        self.outputs = []
+
+        # Index of the first stage whose output is out of date
+        self.dirty = 0
+
+    def addStage(self, name: str, func, **params) -> None:
+        '''
+        Append a stage to the end of the pipeline
+        '''
+        self.names.append(name)
+        self.funcs.append(func)
+        self.params.append(params)
+        self.outputs.append(None)
+
+    def setParams(self, name: str, **params) -> None:
+        '''
+        Update parameters of a stage. The stage is only invalidated if a parameter actually changed
+        '''
+        idx = self.names.index(name)
+        if any(self.params[idx].get(k) != v for k, v in params.items()):
+            self.params[idx].update(params)
+            self.dirty = min(self.dirty, idx)
+
+    def invalidate(self, name: str) -> None:
+        '''
+        Force recomputation of a stage and all stages after it
+        '''
+        self.dirty = min(self.dirty, self.names.index(name))
+
+    def getOutput(self, name: str):
+        '''
+        Return the cached output of a stage
+        '''
+        return self.outputs[self.names.index(name)]
+
+    def run(self):
+        '''
+        Recompute out of date stages and return the output of the last stage
+
+        If a stage returns None, the stages after it are not run and None is returned
+        '''
+        for i in range(self.dirty, len(self.funcs)):
+            previous = self.outputs[i-1] if i > 0 else None
+            self.outputs[i] = self.funcs[i](previous, **self.params[i])
+            if self.outputs[i] is None:
+                self.dirty = i
+                return None
+
+        self.dirty = len(self.funcs)
+        return self.outputs[-1]
@@ -0,0 +1,296 @@
+import struct
+import numpy as np
+
+# Dispersion constant in s MHz^2 pc^-1 cm^3
+K_DM = 4.148808e3
+
+# Types of the SIGPROC filterbank header keys
+HEADER_INTS = ("telescope_id", "machine_id", "data_type", "barycentric", "pulsarcentric", "nchans", "nbits", "nifs", "nbeams", "ibeam")
+HEADER_DOUBLES = ("fch1", "foff", "tstart", "tsamp", "src_raj", "src_dej", "az_start", "za_start", "refdm")
+HEADER_STRINGS = ("rawdatafile", "source_name")
+
+
+def dispersionDelays(freqs: np.ndarray, dm: float, ref_freq: float = None) -> np.ndarray:
+    '''
+    Dispersion delay in seconds of each frequency (in Hz) relative to ref_freq (highest frequency by default)
+    '''
+    f_mhz = np.asarray(freqs, dtype=np.float64)/10**6
+    ref_mhz = np.max(f_mhz) if ref_freq is None else ref_freq/10**6
+    return K_DM*dm*(f_mhz**-2 - ref_mhz**-2)
+
+
+def delayTable(freqs: np.ndarray, dm: float, tsamp: float) -> np.ndarray:
+    '''
+    Dispersion delay of each channel in whole samples
+    '''
+    return np.round(dispersionDelays(freqs, dm)/tsamp).astype(np.int64)
+
+
+def degreesToSigproc(angle: float, hours: bool = False) -> float:
+    '''
+    Convert angle in degrees to the ddmmss.s (or hhmmss.s) format of SIGPROC headers
+    '''
+    value = abs(angle)/15 if hours else abs(angle)
+    d = int(value)
+    m = int((value - d)*60)
+    s = (value - d - m/60)*3600
+    return np.sign(angle or 1)*(d*10000 + m*100 + s)
+
+
+class FilterbankWriter:
+    '''
+    Writes a SIGPROC filterbank file of 32 bit floats, one spectrum per time sample
+    '''
+    def __init__(self, path: str, header: dict) -> None:
+        self.path = path
+        self.file = open(path, "wb")
+        self.n_samples = 0
+        self.writeHeader(header)
+
+    @staticmethod
+    def packString(string: str) -> bytes:
+        '''
+        Pack string as its length followed by its characters
+        '''
+        return struct.pack("<i", len(string)) + string.encode()
+
+    def writeHeader(self, header: dict) -> None:
+        '''
+        Write header with the keys in header. Keys must be known SIGPROC header keys
+        '''
+        data = self.packString("HEADER_START")
+        for key, value in header.items():
+            if key in HEADER_INTS:
+                data += self.packString(key) + struct.pack("<i", int(value))
+            elif key in HEADER_DOUBLES:
+                data += self.packString(key) + struct.pack("<d", float(value))
+            elif key in HEADER_STRINGS:
+                data += self.packString(key) + self.packString(str(value))
+            else:
+                print(f"Unknown filterbank header key {key}... skipping")
+        data += self.packString("HEADER_END")
+        self.file.write(data)
+
+    def write(self, spectra: np.ndarray) -> None:
+        '''
+        Append (time samples, channels) array of spectra
+        '''
+        self.file.write(np.ascontiguousarray(spectra, dtype=np.float32).tobytes())
+        self.n_samples += spectra.shape[0]
+
+    def close(self) -> None:
+        '''
+        Close the file
+        '''
+        self.file.close()
+
+
+def readFilterbank(path: str) -> tuple:
+    '''
+    Read SIGPROC filterbank file of 32 bit floats
+
+    Returns header dictionary and a read-only memory map of the data, shaped (time samples, channels),
+    so long recordings are never loaded into memory at once. Filterbank files migrated to an archive (.rpa) are
+    returned as an ArchivedArray, which decompresses the time samples it is sliced for and keeps the archive open
+    until it is passed to closeFilterbank
+    '''
+    if path.endswith(".rpa"):
+        from core.archive import ArchiveReader
+        archive = ArchiveReader(path)
+        if "filterbank" not in archive:
+            archive.close()
+            raise ValueError(f"{path} holds no filterbank data")
+        return dict(archive.getAttrs("filterbank")), archive["filterbank"]
+
+    header = {}
+    with open(path, "rb") as f:
+        def readString() -> str:
+            length = struct.unpack("<i", f.read(4))[0]
+            return f.read(length).decode()
+
+        if readString() != "HEADER_START":
+            raise ValueError(f"{path} is not a filterbank file")
+        while True:
+            key = readString()
+            if key == "HEADER_END":
+                break
+            if key in HEADER_INTS:
+                header[key] = struct.unpack("<i", f.read(4))[0]
+            elif key in HEADER_DOUBLES:
+                header[key] = struct.unpack("<d", f.read(8))[0]
+            else:
+                header[key] = readString()
+        offset = f.tell()
+
+    if header.get("nbits", 32) != 32:
+        raise ValueError("Only 32 bit filterbank files are supported")
+    data = np.memmap(path, dtype=np.float32, mode="r", offset=offset)
+    return header, data.reshape(-1, header["nchans"])
+
+
+def closeFilterbank(data) -> None:
+    '''
+    Close the archive of data returned by readFilterbank. Memory maps are released once they are no longer referenced
+    '''
+    if not isinstance(data, np.ndarray):
+        data.close()
+
+
+class StreamingDedisperser:
+    '''
+    Incoherent dedispersion of a stream of spectra with a precomputed per channel delay table
+
+    Spectra arrive in blocks of (time samples, channels). The last max(delays) samples are kept between blocks,
+    so a sample of the dedispersed time series is output once its most delayed channel has arrived.
+    '''
+    def __init__(self, delays: np.ndarray) -> None:
+        self.delays = np.asarray(delays, dtype=np.int64)
+        self.max_delay = int(self.delays.max()) if self.delays.size else 0
+        self.n_chans = self.delays.size
+        self.history = np.zeros((0, self.n_chans), dtype=np.float32)
+
+        # Channels grouped by delay, so each group is summed as one slice
+        channels = np.arange(self.n_chans)
+        self.groups = [(int(delay), channels[self.delays == delay]) for delay in np.unique(self.delays)]
+
+    def process(self, spectra: np.ndarray) -> np.ndarray:
+        '''
+        Add block of spectra and return the dedispersed samples completed by it
+        '''
+        buffer = np.concatenate([self.history, spectra.astype(np.float32, copy=False)])
+        n_out = buffer.shape[0] - self.max_delay
+        if n_out <= 0:
+            self.history = buffer
+            return np.zeros(0, dtype=np.float32)
+
+        # Sum over channels of buffer[t + delay, channel] for every output sample t
+        out = np.zeros(n_out, dtype=np.float32)
+        for delay, chans in self.groups:
+            out += buffer[delay:delay+n_out, chans].sum(axis=1)
+
+        self.history = buffer[n_out:]
+        return out
+
+
+class Folder:
+    '''
+    Folds a time series at a given period into a pulse profile with phase_bins bins
+    '''
+    def __init__(self, period: float, tsamp: float, phase_bins: int = 128) -> None:
+        self.period = period
+        self.tsamp = tsamp
+        self.phase_bins = phase_bins
+        self.profile = np.zeros(phase_bins)
+        self.counts = np.zeros(phase_bins)
+        self.n_samples = 0
+
+    def add(self, series: np.ndarray) -> None:
+        '''
+        Add the next samples of the time series
+        '''
+        t = (self.n_samples + np.arange(series.size))*self.tsamp
+        idx = (np.mod(t/self.period, 1.0)*self.phase_bins).astype(np.int64) % self.phase_bins
+        self.profile += np.bincount(idx, weights=series, minlength=self.phase_bins)
+        self.counts += np.bincount(idx, minlength=self.phase_bins)
+        self.n_samples += series.size
+
+    def getProfile(self) -> np.ndarray:
+        '''
+        Return the mean value in each phase bin
+        '''
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return self.profile/self.counts
+
+
+def delaySpan(f_low: float, f_high: float) -> float:
+    '''
+    Frequency dependence f_low^-2 - f_high^-2 of the dispersion delay between two frequencies (in MHz)
+    '''
+    return f_low**-2 - f_high**-2
+
+
+def dmFromDelay(delay: np.ndarray, f_min: float, f_max: float, tsamp: float) -> np.ndarray:
+    '''
+    DM giving a dispersion delay of delay samples between the frequencies f_min and f_max (in Hz)
+    '''
+    return np.asarray(delay)*tsamp/(K_DM*delaySpan(f_min/10**6, f_max/10**6))
+
+
+def delayFromDM(dm: float, f_min: float, f_max: float, tsamp: float) -> int:
+    '''
+    Dispersion delay between the frequencies f_min and f_max (in Hz) in whole samples, rounded up
+    '''
+    return int(np.ceil(K_DM*dm*delaySpan(f_min/10**6, f_max/10**6)/tsamp))
+
+
+def fdmt(data: np.ndarray, freqs: np.ndarray, max_delay: int) -> np.ndarray:
+    '''
+    Fast dispersion measure transform of a (channels, time samples) block with channel frequencies freqs (in Hz, increasing)
+
+    Returns a (max_delay, time samples) array where row d is the block dedispersed for a delay of d samples
+    between the lowest and highest channel, referenced to the highest channel.
+    Neighbouring subbands are merged pairwise, and each merged delay reuses the dedispersed subband series,
+    so the cost is O(max_delay x time samples x log2(channels)) instead of O(max_delay x time samples x channels).
+    Samples whose delayed data lies beyond the block are partial sums.
+    '''
+    n_chans, T = data.shape
+    f_mhz = np.asarray(freqs, dtype=np.float64)/10**6
+    total = delaySpan(f_mhz[0], f_mhz[-1])
+
+    def nDelays(f_low: float, f_high: float) -> int:
+        return min(int(np.ceil((max_delay-1)*delaySpan(f_low, f_high)/total)) + 1, max_delay)
+
+    # Subbands as (lowest channel frequency, highest channel frequency, dedispersed series)
+    subbands = [(f, f, data[c:c+1].astype(np.float32)) for c, f in enumerate(f_mhz)]
+    while len(subbands) > 1:
+        merged = [mergeSubbands(subbands[i], subbands[i+1], nDelays) for i in range(0, len(subbands)-1, 2)]
+        if len(subbands) % 2:
+            merged.append(subbands[-1])
+        subbands = merged
+
+    out = subbands[0][2]
+    if out.shape[0] < max_delay:
+        out = np.concatenate([out, np.zeros((max_delay-out.shape[0], T), dtype=np.float32)])
+    return out
+
+
+def mergeSubbands(low: tuple, high: tuple, nDelays) -> tuple:
+    '''
+    Merge two neighbouring (lowest frequency, highest frequency, dedispersed series) subbands of the FDMT
+
+    A delay d across the merged band is split into the delay across the upper subband, the delay from the upper
+    subband down to the top of the lower subband, which shifts the lower subband, and the rest across the lower subband.
+    Delays sharing a shift are added as one slice.
+    '''
+    f_low, f_low_top, low_series = low
+    f_high_bottom, f_high, high_series = high
+    T = low_series.shape[1]
+    span = delaySpan(f_low, f_high)
+
+    delays = np.arange(nDelays(f_low, f_high))
+    high_delays = np.round(delays*delaySpan(f_high_bottom, f_high)/span).astype(np.int64)
+    shifts = np.round(delays*delaySpan(f_low_top, f_high)/span).astype(np.int64)
+    high_delays = np.minimum(high_delays, high_series.shape[0]-1)
+    low_delays = np.clip(delays - shifts, 0, low_series.shape[0]-1)
+
+    # Rows are added in place one at a time, which keeps them in cache and avoids temporary copies
+    out = np.zeros((delays.size, T), dtype=np.float32)
+    for d, h, l, shift in zip(delays, high_delays, low_delays, shifts):
+        if shift < T:
+            np.add(high_series[h, :T-shift], low_series[l, shift:], out=out[d, :T-shift])
+    return f_low, f_high, out
+
+
+def dedisperseBruteForce(data: np.ndarray, freqs: np.ndarray, dms: np.ndarray, tsamp: float) -> np.ndarray:
+    '''
+    Dedisperse a (channels, time samples) block at every DM in dms by shifting and summing each channel
+
+    Reference implementation for the FDMT, O(DMs x channels x time samples). Returns a (DMs, time samples) array
+    '''
+    n_chans, T = data.shape
+    out = np.zeros((len(dms), T), dtype=np.float32)
+    for i, dm in enumerate(dms):
+        for chan, delay in enumerate(delayTable(freqs, dm, tsamp)):
+            if delay < T:
+                out[i, :T-delay] += data[chan, delay:]
+    return out
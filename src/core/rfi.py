@@ -0,0 +1,117 @@
+import numpy as np
+
+# Sub-integrations used for the running median/MAD of the total power
+POWER_HISTORY = 64
+
+
+class SpectralKurtosis:
+    '''
+    RFI flagging by spectral kurtosis, accumulated as part of the FFT integration
+
+    Power spectra are added one at a time. For every sub-integration of sub_length spectra the per channel
+    sums S1 = sum(P) and S2 = sum(P^2) give the generalized spectral kurtosis estimator
+        SK = (M+1)/(M-1) * (M*S2/S1^2 - 1)
+    which is 1 for Gaussian noise. Channels deviating by more than threshold standard deviations are flagged.
+    Sub-integrations whose clean total power is an outlier by more than mad_threshold robust standard
+    deviations (median/MAD of recent sub-integrations) are flagged entirely, catching broadband bursts.
+
+    Flagged channels of a sub-integration are left out of the average.
+    If a doppler tracker (instance of DopplerTracker) is given, the clean sum of every sub-integration is also added to it.
+    '''
+    def __init__(self, n_bins: int, sub_length: int = 64, threshold: float = 4.0, mad_threshold: float = 5.0, doppler: "DopplerTracker" = None) -> None:
+        self.sub_length = max(int(sub_length), 2)
+        self.threshold = threshold
+        self.mad_threshold = mad_threshold
+        self.doppler = doppler
+
+        # Per channel sums of the power and squared power of the current sub-integration
+        self.S1 = np.zeros(n_bins)
+        self.S2 = np.zeros(n_bins)
+        self.count = 0
+
+        # Clean sum and number of spectra in it per channel
+        self.total = np.zeros(n_bins)
+        self.weights = np.zeros(n_bins)
+
+        self.flags = []
+        self.power_history = []
+
+    def add(self, psd: np.ndarray) -> None:
+        '''
+        Add a power spectrum to the sums of the current sub-integration
+        '''
+        self.S1 += psd
+        self.S2 += psd*psd
+        self.count += 1
+        if self.count == self.sub_length:
+            self.flush()
+
+    def flush(self) -> None:
+        '''
+        Flag the current sub-integration and add its clean channels to the average
+        '''
+        M = self.count
+        if M == 0:
+            return
+        if M < 2:
+            # Too short to estimate the kurtosis, so add it as is
+            flags = np.zeros(self.S1.size, dtype=bool)
+        else:
+            S1 = np.where(self.S1 > 0, self.S1, np.inf)
+            SK = (M+1)/(M-1)*(M*self.S2/S1**2 - 1)
+            sigma = np.sqrt(4*M**2/((M-1)*(M+2)*(M+3)))
+            flags = np.abs(SK - 1) > self.threshold*sigma
+
+            # Broadband bursts from the total power of the clean channels
+            power = np.mean(self.S1[~flags])/M if not np.all(flags) else np.inf
+            if len(self.power_history) >= 8:
+                history = np.array(self.power_history)
+                median = np.median(history)
+                mad = 1.4826*np.median(np.abs(history - median))
+                if mad > 0 and abs(power - median) > self.mad_threshold*mad:
+                    flags[:] = True
+            if not np.all(flags):
+                self.power_history = self.power_history[-POWER_HISTORY+1:] + [power]
+
+        clean = np.where(flags, 0, self.S1)
+        clean_weights = np.where(flags, 0, M)
+        self.total += clean
+        self.weights += clean_weights
+        if self.doppler is not None:
+            self.doppler.add(clean, clean_weights)
+        self.flags.append(flags)
+
+        self.S1[:] = 0
+        self.S2[:] = 0
+        self.count = 0
+
+    def getRunningAverage(self) -> np.ndarray:
+        '''
+        Return average of the clean data so far, including the unflagged current sub-integration
+        '''
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return (self.total + self.S1)/(self.weights + self.count)
+
+    def getSpectrum(self) -> np.ndarray:
+        '''
+        Flush remaining spectra and return the clean average spectrum
+
+        Channels that were flagged in every sub-integration are interpolated from their neighbours
+        '''
+        self.flush()
+        with np.errstate(invalid="ignore", divide="ignore"):
+            spectrum = self.total/self.weights
+
+        bad = self.weights == 0
+        if np.all(bad):
+            return spectrum
+        if np.any(bad):
+            idx = np.arange(spectrum.size)
+            spectrum[bad] = np.interp(idx[bad], idx[~bad], spectrum[~bad])
+        return spectrum
+
+    def getFlags(self) -> np.ndarray:
+        '''
+        Return flag mask with one row per sub-integration and one column per channel
+        '''
+        return np.array(self.flags, dtype=bool).reshape(-1, self.S1.size)
@@ -0,0 +1,180 @@
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from astropy.io import fits
+from astropy.time import Time
+
+# Name of the SDFITS binary tables, and the frame of the frequency axis and velocities written to them
+SDFITS_EXTNAME = "SINGLE DISH"
+SDFITS_CTYPE1 = "FREQ-OBS"
+SDFITS_VELDEF = "RADI-LSR"
+
+# Threads reading observations from disk, where most of the time of an export is spent
+SDFITS_READ_THREADS = 8
+
+# Speed of light in km/s
+C_KMS = 299792.458
+
+
+def restFrequency(frequency: np.ndarray, radial_velocity: np.ndarray, lsr_correction: float) -> float:
+    '''
+    Rest frequency of a spectrum, from its frequencies and radial velocities (radio convention, corrected by lsr_correction km/s)
+    '''
+    return float(np.median(frequency/(1 + (radial_velocity + lsr_correction)/C_KMS)))
+
+
+def observationColumns(observations: list) -> list:
+    '''
+    Gather the spectra and info of a list of Observation into columns, one row per spectrum
+
+    Spectra of different lengths can not share a table, so observations are grouped by the number of channels.
+    Returns a list of (column dictionary, number of channels) for every group
+    '''
+    def readObservation(obs: "Observation") -> tuple:
+        return (obs, *obs.readData(), obs.readInfo())
+
+    with ThreadPoolExecutor(max_workers=SDFITS_READ_THREADS) as executor:
+        rows = list(executor.map(readObservation, observations))
+
+    groups = {}
+    for row in rows:
+        groups.setdefault(row[3].size, []).append(row)
+
+    tables = []
+    for n_channels, group in groups.items():
+        freqs = np.array([row[1] for row in group])
+        lsr = np.array([float(row[4]["lsr_cor"]) for row in group])
+        times = Time([row[4]["time"].item().mjd for row in group], format="mjd")
+        horizontal = np.array([row[4]["horizontal_coords"] for row in group], dtype=np.float64)
+        equatorial = np.array([row[4]["equatorial_coords"] for row in group], dtype=np.float64)
+        galactic = np.array([row[4]["galactic_coords"] for row in group], dtype=np.float64)
+        dropouts = np.array([row[4]["dropouts"] if "dropouts" in row[4] else np.zeros(5) for row in group], dtype=np.int64)
+
+        # The frequency axis is stored as a reference pixel and step. Unevenly spaced axes are also stored in full
+        cdelt = (freqs[:, -1] - freqs[:, 0])/max(n_channels - 1, 1)
+        uniform = np.allclose(freqs, freqs[:, :1] + cdelt[:, None]*np.arange(n_channels), rtol=0, atol=1e-3*np.max(np.abs(cdelt)))
+        columns = {
+            "OBJECT": np.array([obs.DIR.strip("/").split("/")[-1] for obs, *_ in group]),
+            "DATE-OBS": times.isot,
+            "MJD": times.mjd,
+            "DATA": np.array([row[3] for row in group], dtype=np.float32),
+            "CRPIX1": np.ones(len(group)),
+            "CRVAL1": freqs[:, 0],
+            "CDELT1": cdelt,
+            "BANDWID": np.abs(cdelt)*n_channels,
+            "RESTFREQ": np.array([restFrequency(row[1], row[2], l) for row, l in zip(group, lsr)]),
+            "CRVAL2": equatorial[:, 0],
+            "CRVAL3": equatorial[:, 1],
+            "AZIMUTH": horizontal[:, 0],
+            "ELEVATIO": horizontal[:, 1],
+            "GLON": galactic[:, 0],
+            "GLAT": galactic[:, 1],
+            "VFRAME": lsr*1000,
+            "DROPOUTS": dropouts
+        }
+        if not uniform:
+            columns["FREQ"] = freqs
+        tables.append((columns, n_channels))
+    return tables
+
+
+def tableHDU(columns: dict, n_channels: int, extver: int) -> fits.BinTableHDU:
+    '''
+    Build an SDFITS binary table from whole columns at once
+    '''
+    units = {"DATA": "dB", "CRVAL1": "Hz", "CDELT1": "Hz", "BANDWID": "Hz", "RESTFREQ": "Hz", "CRVAL2": "deg", "CRVAL3": "deg",
+             "AZIMUTH": "deg", "ELEVATIO": "deg", "GLON": "deg", "GLAT": "deg", "VFRAME": "m/s", "MJD": "d", "FREQ": "Hz"}
+    formats = {"OBJECT": f"{max(len(s) for s in columns['OBJECT'])}A", "DATE-OBS": "23A", "DATA": f"{n_channels}E",
+               "CRPIX1": "E", "DROPOUTS": "5K", "FREQ": f"{n_channels}D"}
+
+    hdu = fits.BinTableHDU.from_columns([
+        fits.Column(name=name, format=formats.get(name, "D"), unit=units.get(name), array=array,
+                    dim=f"({n_channels})" if name in ("DATA", "FREQ") else None)
+        for name, array in columns.items()
+    ])
+    hdu.header["EXTNAME"] = SDFITS_EXTNAME
+    hdu.header["EXTVER"] = extver
+    hdu.header["NMATRIX"] = 1
+    hdu.header["TELESCOP"] = "RadioPy"
+    hdu.header["CTYPE1"] = SDFITS_CTYPE1
+    hdu.header["CTYPE2"] = "RA"
+    hdu.header["CTYPE3"] = "DEC"
+    hdu.header["EQUINOX"] = 2000.0
+    hdu.header["VELDEF"] = SDFITS_VELDEF
+    hdu.header["COMMENT"] = "DROPOUTS: dropped samples, runs, longest run, empty blocks, blocks"
+    return hdu
+
+
+def writeSDFITS(path: str, observations: list) -> int:
+    '''
+    Write a list of Observation to an SDFITS file, one row per spectrum and one table per number of channels
+
+    Returns the number of spectra written
+    '''
+    tables = observationColumns(observations)
+    hdus = [fits.PrimaryHDU()] + [tableHDU(columns, n_channels, i+1) for i, (columns, n_channels) in enumerate(tables)]
+    fits.HDUList(hdus).writeto(path, overwrite=True)
+    return sum(columns["DATA"].shape[0] for columns, _ in tables)
+
+
+class SDFITSReader:
+    '''
+    Reads SDFITS files written by writeSDFITS, or any SDFITS file with a regular frequency axis
+
+    The file is memory mapped, and only the rows and columns asked for are read
+    '''
+    def __init__(self, path: str) -> None:
+        self.hdul = fits.open(path, memmap=True)
+        self.tables = [hdu for hdu in self.hdul[1:] if hdu.name == SDFITS_EXTNAME]
+        self.offsets = np.cumsum([0] + [hdu.header["NAXIS2"] for hdu in self.tables])
+
+    def __len__(self) -> int:
+        return int(self.offsets[-1])
+
+    def __enter__(self) -> "SDFITSReader":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.hdul.close()
+
+    def locate(self, index: int) -> tuple:
+        '''
+        Return table and row in it of spectrum index
+        '''
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f"Spectrum {index} out of range for {len(self)} spectra")
+        table = int(np.searchsorted(self.offsets, index, side="right")) - 1
+        return self.tables[table], index - int(self.offsets[table])
+
+    def getColumn(self, name: str) -> np.ndarray:
+        '''
+        Return a scalar column of all spectra
+        '''
+        return np.concatenate([hdu.data.field(name) for hdu in self.tables])
+
+    def getRow(self, index: int) -> dict:
+        '''
+        Return all columns of spectrum index
+        '''
+        hdu, row = self.locate(index)
+        record = hdu.data[row]
+        return {name: record[name] for name in hdu.columns.names}
+
+    def getSpectrum(self, index: int) -> tuple:
+        '''
+        Return tuple of frequency and data of spectrum index
+        '''
+        hdu, row = self.locate(index)
+        data = hdu.data.field("DATA")[row]
+        if "FREQ" in hdu.columns.names:
+            return np.asarray(hdu.data.field("FREQ")[row]), np.asarray(data)
+        crpix, crval, cdelt = (hdu.data.field(key)[row] for key in ("CRPIX1", "CRVAL1", "CDELT1"))
+        return crval + (np.arange(data.size) + 1 - crpix)*cdelt, np.asarray(data)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.getSpectrum(index)
@@ -0,0 +1,210 @@
+import time
+
+from core.soapy import SDR, SDRError, SDRStreamError, SDRDisconnectedError
+
+# Reconnect attempts after a stream error, and the delay before the first and longest delay in seconds
+RECONNECT_ATTEMPTS = 6
+RECONNECT_DELAY = 1.0
+RECONNECT_MAX_DELAY = 30.0
+
+
+class SDRSession:
+    '''
+    Long lived connection to an SDR, kept open across observations
+
+    The device and its stream are opened once. configure() only touches the settings that changed, so observations
+    at new frequencies retune in place. Between observations the stream is paused rather than closed.
+    If reading fails, e.g. because a USB device dropped off the bus, the device is reopened with exponential
+    backoff and the read is retried, so long unattended runs survive disconnects.
+
+    Has the streaming interface of SDR (startStream, readFromStream, stopStream, getFrequency, ...),
+    so it can be handed to anything collecting data from an SDR.
+    '''
+    def __init__(self, driver: str) -> None:
+        self.driver = driver
+        self.sdr = None
+        self.settings = {}
+        self.reconnects = 0
+
+    def configure(self, freq: int, sample_rate: int, ppm_offset: int = 0, bins: int = 4096, stream_format: str = "cf32") -> "SDRSession":
+        '''
+        Open the device if needed and apply settings that differ from the current ones
+
+        Raises SDRError (or a subclass) if the device cannot be opened or a setting is not supported
+        '''
+        settings = {"freq": freq, "sample_rate": sample_rate, "ppm_offset": ppm_offset, "bins": bins, "stream_format": stream_format}
+        if self.sdr is None:
+            self.sdr = SDR(driver = self.driver, **settings)
+            self.settings = settings
+            return self
+
+        restart = self.sdr.active and settings["sample_rate"] != self.settings.get("sample_rate")
+        if restart:
+            self.sdr.pauseStream()
+        if settings["sample_rate"] != self.settings.get("sample_rate"):
+            self.sdr.setSampleRate(sample_rate)
+        if settings["freq"] != self.settings.get("freq"):
+            self.sdr.setFrequency(freq)
+        if settings["ppm_offset"] != self.settings.get("ppm_offset"):
+            self.sdr.setPPMOffset(ppm_offset)
+        if settings["bins"] != self.settings.get("bins"):
+            self.sdr.setBins(bins)
+        if settings["stream_format"] != self.settings.get("stream_format"):
+            # Closes the stream, which is set up again in the new format by the next startStream()
+            self.sdr.setStreamFormat(stream_format)
+        if restart:
+            self.sdr.startStream()
+
+        self.settings = settings
+        return self
+
+    def retune(self, frequency: int, settle_reads: int = 1) -> None:
+        '''
+        Change the center frequency while streaming
+
+        settle_reads blocks are read and discarded afterwards, as they may hold samples from before the retune
+        '''
+        self.sdr.setFrequency(frequency)
+        self.settings["freq"] = frequency
+        if self.sdr.active:
+            for _ in range(settle_reads):
+                self.readFromStream()
+
+    def reconnect(self) -> None:
+        '''
+        Close and reopen the device with the current settings, waiting longer after every failed attempt
+
+        Raises SDRDisconnectedError if the device could not be reopened
+        '''
+        streaming = self.sdr is not None and self.sdr.active
+        self.close()
+
+        delay = RECONNECT_DELAY
+        for attempt in range(RECONNECT_ATTEMPTS):
+            print(f"Reconnecting to {self.driver} in {delay} s (attempt {attempt+1} of {RECONNECT_ATTEMPTS})...")
+            time.sleep(delay)
+            try:
+                self.sdr = SDR(driver = self.driver, **self.settings)
+                if streaming:
+                    self.sdr.startStream()
+                self.reconnects += 1
+                return
+            except Exception as e:
+                print(f"Reconnect failed: {e}")
+                self.sdr = None
+                delay = min(2*delay, RECONNECT_MAX_DELAY)
+
+        raise SDRDisconnectedError(f"Lost connection to {self.driver} and could not reconnect")
+
+    def close(self) -> None:
+        '''
+        Close stream and device, ignoring errors from a device that is already gone
+        '''
+        if self.sdr is None:
+            return
+        try:
+            if self.sdr.rxStream is not None:
+                self.sdr.stopStream()
+        except Exception:
+            pass
+        self.sdr = None
+
+    # ------------------------------- Streaming ------------------------------ #
+
+    def startStream(self) -> None:
+        '''
+        Start (or resume) the stream
+        '''
+        try:
+            self.sdr.startStream()
+        except Exception as e:
+            raise SDRStreamError(f"Could not start stream: {e}") from e
+
+    def readFromStream(self):
+        '''
+        Read bins from the stream, reconnecting to the device once if the read fails
+        '''
+        try:
+            return self.sdr.readFromStream()
+        except SDRStreamError as e:
+            print(f"{e}... Reconnecting")
+        except SDRError:
+            raise
+        except Exception as e:
+            print(f"Error when reading samples: {e}... Reconnecting")
+
+        self.reconnect()
+        return self.sdr.readFromStream()
+
+    def stopStream(self) -> None:
+        '''
+        Pause the stream, keeping it set up for the next observation
+        '''
+        if self.sdr is not None:
+            self.sdr.pauseStream()
+
+    # ------------------------------ Properties ------------------------------ #
+
+    def getFrequency(self) -> int:
+        '''
+        Return the current center frequency
+        '''
+        return self.sdr.getFrequency()
+
+    def getSampleRate(self) -> int:
+        '''
+        Return the current sample rate
+        '''
+        return self.sdr.getSampleRate()
+
+    def getBins(self) -> int:
+        '''
+        Return the current number of bins read from the stream
+        '''
+        return self.sdr.getBins()
+
+    def getGain(self) -> str:
+        '''
+        Return the current gain as a string, "auto" if the automatic gain control is on
+        '''
+        return self.sdr.getGain()
+
+    def getSerial(self) -> str:
+        '''
+        Return the serial of the device
+        '''
+        return self.sdr.getSerial()
+
+    def getStreamFormat(self) -> str:
+        '''
+        Return the Soapy format samples are streamed in
+        '''
+        return self.sdr.getStreamFormat()
+
+    def getPPMOffset(self) -> int:
+        '''
+        Return the current PPM offset
+        '''
+        return self.sdr.getPPMOffset()
+
+
+# Open sessions by driver, reused by every observation run in the same process
+sessions = {}
+
+
+def getSession(driver: str) -> SDRSession:
+    '''
+    Return the open session of the given driver, creating it if there is none
+    '''
+    if driver not in sessions:
+        sessions[driver] = SDRSession(driver)
+    return sessions[driver]
+
+
+def closeSessions() -> None:
+    '''
+    Close every open session
+    '''
+    for session in sessions.values():
+        session.close()
+    sessions.clear()
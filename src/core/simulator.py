@@ -0,0 +1,162 @@
+import time
+import numpy as np
+
+# Driver name of the simulated device
+SIMULATED_DRIVER = "sim"
+
+# Stream formats, as the format strings of the Soapy API
+SIM_FORMAT_CF32 = "CF32"
+SIM_FORMAT_CS16 = "CS16"
+
+# Rest frequency (Hz), width (Hz) and peak (relative to the noise) of the simulated neutral hydrogen line
+SIM_LINE_FREQ = 1420405752
+SIM_LINE_WIDTH = 50e3
+SIM_LINE_PEAK = 0.3
+
+# Full scale of the simulated CS16 native format
+SIM_FULL_SCALE = 2048
+
+
+class SimRange:
+    '''
+    Frequency range in the form of a Soapy range
+    '''
+    def __init__(self, minimum: float, maximum: float) -> None:
+        self.min = minimum
+        self.max = maximum
+
+    def minimum(self) -> float:
+        return self.min
+
+    def maximum(self) -> float:
+        return self.max
+
+
+class SimStreamResult:
+    '''
+    Result of a read in the form of a Soapy stream result
+    '''
+    def __init__(self, ret: int) -> None:
+        self.ret = ret
+
+
+class SimulatedDevice:
+    '''
+    Simulated SDR with the subset of the Soapy device interface used by SDR
+
+    Streams complex noise shaped by a bandpass roll-off, with the neutral hydrogen line when it is within the band.
+    Samples are paced to the sample rate, so observations take as long as they would with a real device.
+    Opened by SDR for the driver "sim", so observations, the UI and the server run without hardware
+    '''
+    def __init__(self, seed: int = None) -> None:
+        self.frequency = SIM_LINE_FREQ
+        self.sample_rate = 2.4e6
+        self.bandwidth = 2.4e6
+        self.correction = 0
+        self.gain_mode = True
+        self.rng = np.random.default_rng(seed)
+        self.stream_start = None
+        self.streamed = 0
+        self.shape = None
+
+    # Settings
+    def setGainMode(self, direction: int, channel: int, automatic: bool) -> None:
+        self.gain_mode = automatic
+
+    def getGainMode(self, direction: int, channel: int) -> bool:
+        return self.gain_mode
+
+    def getGain(self, direction: int, channel: int) -> float:
+        return 20.0
+
+    def getFrequencyRange(self, direction: int, channel: int) -> list:
+        return [SimRange(24e6, 1766e6)]
+
+    def listSampleRates(self, direction: int, channel: int) -> list:
+        return [1.024e6, 2.048e6, 2.4e6, 3.2e6]
+
+    def listBandwidths(self, direction: int, channel: int) -> list:
+        return []
+
+    def listFrequencies(self, direction: int, channel: int) -> list:
+        return ["RF", "CORR"]
+
+    def setFrequency(self, direction: int, channel: int, frequency: float) -> None:
+        self.frequency = frequency
+        self.shape = None
+
+    def getFrequency(self, direction: int, channel: int) -> float:
+        return self.frequency
+
+    def setSampleRate(self, direction: int, channel: int, sample_rate: float) -> None:
+        self.sample_rate = sample_rate
+        self.shape = None
+
+    def getSampleRate(self, direction: int, channel: int) -> float:
+        return self.sample_rate
+
+    def setBandwidth(self, direction: int, channel: int, bandwidth: float) -> None:
+        self.bandwidth = bandwidth
+
+    def getBandwidth(self, direction: int, channel: int) -> float:
+        return self.bandwidth
+
+    def setFrequencyCorrection(self, direction: int, channel: int, correction: float) -> None:
+        self.correction = correction
+
+    def getFrequencyCorrection(self, direction: int, channel: int) -> float:
+        return self.correction
+
+    def getNativeStreamFormat(self, direction: int, channel: int) -> tuple:
+        return SIM_FORMAT_CS16, SIM_FULL_SCALE
+
+    # Streaming
+    def setupStream(self, direction: int, stream_format: str) -> str:
+        return stream_format
+
+    def activateStream(self, stream: str) -> int:
+        self.stream_start = time.perf_counter()
+        self.streamed = 0
+        return 0
+
+    def deactivateStream(self, stream: str) -> int:
+        self.stream_start = None
+        return 0
+
+    def closeStream(self, stream: str) -> None:
+        self.stream_start = None
+
+    def spectralShape(self, n: int) -> np.ndarray:
+        '''
+        Amplitude per FFT bin (in numpy FFT order) of the simulated signal: bandpass roll-off and the line
+        '''
+        if self.shape is None or self.shape.size != n:
+            freqs = np.fft.fftfreq(n, 1/self.sample_rate)
+            bandpass = 1/(1 + (2*freqs/self.sample_rate/0.85)**8)
+            line = SIM_LINE_PEAK*np.exp(-0.5*((self.frequency + freqs - SIM_LINE_FREQ)/SIM_LINE_WIDTH)**2)
+            self.shape = np.sqrt(bandpass*(1 + line))
+        return self.shape
+
+    def readStream(self, stream: str, buffers: list, n: int, timeoutUs: int = 100000) -> SimStreamResult:
+        '''
+        Fill the buffer with n samples, generated in the frequency domain so every block has the simulated spectrum
+        '''
+        shape = self.spectralShape(n)
+        spectrum = (self.rng.standard_normal(n) + 1j*self.rng.standard_normal(n))*shape
+        samples = np.fft.ifft(spectrum)*np.sqrt(n/2)*0.1
+
+        buffer = buffers[0]
+        if stream == SIM_FORMAT_CF32:
+            buffer[:n] = samples
+        else:
+            interleaved = np.empty(2*n)
+            interleaved[0::2], interleaved[1::2] = samples.real, samples.imag
+            buffer[:2*n] = np.clip(np.rint(interleaved*SIM_FULL_SCALE), -SIM_FULL_SCALE, SIM_FULL_SCALE - 1)
+
+        # Pace to the sample rate like a real device
+        self.streamed += n
+        if self.stream_start is not None:
+            ahead = self.streamed/self.sample_rate - (time.perf_counter() - self.stream_start)
+            if ahead > 0:
+                time.sleep(ahead)
+        return SimStreamResult(n)
@@ -1,42 +1,179 @@
-import SoapySDR
-from SoapySDR import *
-
 import numpy as np
 
-def listDrivers() -> list:
+import core.dsp as DSP
+from core.simulator import SIMULATED_DRIVER, SimulatedDevice
+from core.device_cache import DeviceCapabilities, deviceKey, loadDeviceCache, saveDeviceCache
+
+# Soapy constants used here, with the values of the Soapy API. SoapySDR is imported only to open real devices,
+# so the simulated device runs without the Soapy bindings
+SOAPY_SDR_RX = 1
+SOAPY_SDR_CF32, SOAPY_SDR_CS16, SOAPY_SDR_CS8 = "CF32", "CS16", "CS8"
+SOAPY_SDR_OVERFLOW = -4
+
+# Timeout of a single read from the stream in microseconds
+READ_TIMEOUT_US = 1000000
+
+# Native stream formats that are read into integer buffers and converted on the host
+NATIVE_FORMATS = {SOAPY_SDR_CS16: np.int16, SOAPY_SDR_CS8: np.int8}
+
+
+class SDRError(Exception):
+    '''
+    Base class of errors raised by the SDR
+    '''
+
+class SDRDeviceError(SDRError):
+    '''
+    The device could not be opened
+    '''
+
+class SDRConfigError(SDRError):
+    '''
+    A setting is not supported by the device, e.g. a frequency outside its range
+    '''
+
+class SDRStreamError(SDRError):
+    '''
+    Reading from the stream failed. code is the Soapy error code, if any
+    '''
+    def __init__(self, message: str, code: int = None) -> None:
+        super().__init__(message)
+        self.code = code
+
+class SDRDisconnectedError(SDRStreamError):
+    '''
+    The device was lost and could not be reconnected
+    '''
+
+
+def listDevices(refresh: bool = False) -> list:
+    '''
+    Retreive the available Soapy devices.
+
+    Devices are enumerated once and then read from the device cache, unless refresh is True.
+    The devices are returned as a list of dictionaries with driver and serial. The simulated device is always last,
+    and the only one if the Soapy bindings are not installed
+    '''
+    cache = loadDeviceCache()
+    if cache["devices"] is not None and not refresh:
+        return cache["devices"]
+
+    try:
+        import SoapySDR
+        soapy_devices = [dict(item) for item in SoapySDR.Device.enumerate()]
+    except ImportError:
+        print("SoapySDR is not installed... Only the simulated device is available")
+        soapy_devices = []
+    devices = [{"driver": device["driver"], "serial": device.get("serial", "")} for device in soapy_devices if device["driver"] != "audio"]
+    devices.append({"driver": SIMULATED_DRIVER, "serial": SIMULATED_DRIVER})
+
+    cache["devices"] = devices
+    saveDeviceCache(cache)
+    return devices
+
+def listDrivers(refresh: bool = False) -> list:
     '''
     Retreive the available Soapy drivers.
 
     The available drivers are returned as a list of strings
     '''
-    soapy_drivers = [dict(item) for item in SoapySDR.Device.enumerate()]
-    driver_names = [driver["driver"] for driver in soapy_drivers if driver["driver"] != "audio"]
+    driver_names = [device["driver"] for device in listDevices(refresh)]
     
-    return driver_names
+    return list(dict.fromkeys(driver_names))
+
+def findSerial(driver: str) -> str:
+    '''
+    Return serial of the first known device with the given driver, or an empty string if there is none
+    '''
+    for device in listDevices():
+        if device["driver"] == driver:
+            return device["serial"]
+    return ""
+
+def probeCapabilities(device) -> DeviceCapabilities:
+    '''
+    Query the capabilities of an open Soapy device
+    '''
+    range = device.getFrequencyRange(SOAPY_SDR_RX, 0)[0]
+    return DeviceCapabilities(
+        frequency_range = [range.minimum(), range.maximum()],
+        sample_rates = [int(sample_rate) for sample_rate in device.listSampleRates(SOAPY_SDR_RX, 0)],
+        bandwidths = [float(bandwidth) for bandwidth in device.listBandwidths(SOAPY_SDR_RX, 0)],
+        tunable_elements = list(device.listFrequencies(SOAPY_SDR_RX, 0))
+    )
+
+def getCapabilities(driver: str, serial: str = None, device = None, refresh: bool = False) -> DeviceCapabilities:
+    '''
+    Return the capabilities of a device from the device cache
+
+    Devices that are not cached (or all devices if refresh is True) are probed, opening the device
+    unless an already open device is given, and the result is cached
+    '''
+    serial = findSerial(driver) if serial is None else serial
+    key = deviceKey(driver, serial)
+    cache = loadDeviceCache()
+    if key in cache["capabilities"] and not refresh:
+        return DeviceCapabilities.fromDict(cache["capabilities"][key])
+
+    if device is None:
+        device = openDevice(driver, serial)
+    capabilities = probeCapabilities(device)
+
+    cache["capabilities"][key] = capabilities.toDict()
+    saveDeviceCache(cache)
+    return capabilities
+
+def deviceArgs(driver: str, serial: str = "") -> str:
+    '''
+    Soapy device arguments selecting the device with the given driver and serial
+    '''
+    return f"driver={driver}" + (f",serial={serial}" if serial else "")
+
+def openDevice(driver: str, serial: str = ""):
+    '''
+    Open the Soapy device with the given driver and serial, or the simulated device for the driver "sim"
+    '''
+    if driver == SIMULATED_DRIVER:
+        return SimulatedDevice()
+    import SoapySDR
+    return SoapySDR.Device(deviceArgs(driver, serial))
 
 class SDR:
-    def __init__(self, driver: str, freq: int = 1420405752, sample_rate: int = 1e6, ppm_offset: int = 0, bins: int = 4096):
+    def __init__(self, driver: str, freq: int = 1420405752, sample_rate: int = 1e6, ppm_offset: int = 0, bins: int = 4096, stream_format: str = "cf32"):
         
         # Initialize SDR
         self.center_frequency = freq
         self.sample_rate = sample_rate
         self.ppm_offset = ppm_offset
         self.bins = bins
+        self.rxStream = None
+        self.active = False
+        self.overflows = 0
         
         # Initialize device and set automatic gain
-        self.sdr = SoapySDR.Device(f"driver={driver}")
+        self.driver = driver
+        self.serial = findSerial(driver)
+        try:
+            self.sdr = openDevice(driver, self.serial)
+        except Exception:
+            # Cached serial belongs to a device that is no longer connected
+            self.serial = ""
+            try:
+                self.sdr = openDevice(driver)
+            except Exception as e:
+                raise SDRDeviceError(f"Could not open device with driver {driver}: {e}") from e
         self.sdr.setGainMode(SOAPY_SDR_RX, 0, True)
 
+        # Capabilities are probed only the first time a device is used
+        self.capabilities = getCapabilities(driver, self.serial, device=self.sdr)
+
         # Configure other parameters
         self.setSampleRate(sample_rate)
         self.setFrequency(freq)
         self.setPPMOffset(ppm_offset)
 
-                
-        # Initialize variables for later use
-        self.buffer = np.zeros(bins, dtype=np.complex64)
-        # self.buffer = np.array([0]*bins, np.complex64)
-        self.rxStream = None
+        # Allocates the buffers for streaming
+        self.setStreamFormat(stream_format)
 
     # ------------------------------ Properties ------------------------------ #
 
@@ -46,8 +183,7 @@ class SDR:
 
         Returns a list of lowest and highest tunable frequency
         '''
-        range = self.sdr.getFrequencyRange(SOAPY_SDR_RX, 0)[0]
-        return [range.minimum(), range.maximum()]
+        return self.capabilities.frequency_range
     
     def getAvailableSampleRates(self) -> list:
         '''
@@ -55,8 +191,7 @@ class SDR:
 
         Returns a list of tunable sample rates
         '''
-        range = self.sdr.listSampleRates(SOAPY_SDR_RX, 0)
-        return list(int(sample_rate) for sample_rate in range)
+        return self.capabilities.sample_rates
     
     def getTunableElements(self) -> list:
         '''
@@ -64,8 +199,7 @@ class SDR:
         
         Returns a list of tunable elements
         '''
-        elem = self.sdr.listFrequencies(SOAPY_SDR_RX, 0)
-        return list(elem)
+        return self.capabilities.tunable_elements
 
 
     def setFrequency(self, frequency: int) -> None:
@@ -76,8 +210,7 @@ class SDR:
         if avail_freqs[0] < frequency and frequency < avail_freqs[1]:
             self.sdr.setFrequency(SOAPY_SDR_RX, 0, frequency)
         else:
-            print("Frequency is outside the range of this device!!")
-            quit()
+            raise SDRConfigError(f"Frequency {frequency} Hz is outside the range of this device!!")
 
     def getFrequency(self) -> int:
         '''
@@ -97,9 +230,8 @@ class SDR:
             if bws.size != 0:
                 bw = bws[bws>sample_rate].min()
                 self.setBandwidth(bandwidth=bw)
-        except:
-            print("Device does not support the selected sample rate!!")
-            quit()
+        except Exception as e:
+            raise SDRConfigError(f"Device does not support the sample rate {sample_rate} Hz!!") from e
 
     def getSampleRate(self) -> int:
         '''
@@ -112,7 +244,7 @@ class SDR:
         '''
         List available bandwidth of device
         '''
-        return np.array(self.sdr.listBandwidths(SOAPY_SDR_RX, 0))
+        return np.array(self.capabilities.bandwidths)
 
     def getBandwidth(self) -> float:
         ''''
@@ -133,14 +265,16 @@ class SDR:
     def setBins(self, bins: int) -> None:
         '''
         Set the number of bins collected to the buffer wehn streaming
+
+        Any positive number is allowed, as the pulsar and radiometer modes read blocks that are not powers of 2
         '''
-        # Do hacky integer evaluation
-        if np.log2(bins) % 1 == 0 and bins > 0:
-            self.bins = bins
-            self.buffer = np.array([0]*bins, np.complex64)
+        if int(bins) == bins and bins > 0:
+            self.bins = int(bins)
+            self.buffer = np.zeros(self.bins, dtype=np.complex64)
+            # Interleaved I/Q samples as they arrive from the device in a native format
+            self.raw_buffer = np.zeros(2*self.bins, dtype=NATIVE_FORMATS[self.format]) if self.format in NATIVE_FORMATS else None
         else:
-            print("Invalid number of bins. Must be positive and follow exponential with base 2 and an integer power!!")
-            quit()
+            raise SDRConfigError(f"Invalid number of bins {bins}. Must be a positive integer!!")
 
     def getBins(self) -> int:
         '''
@@ -149,6 +283,21 @@ class SDR:
         return self.bins
 
 
+    def getGain(self) -> str:
+        '''
+        Return the current gain as a string, "auto" if the automatic gain control is on
+        '''
+        if self.sdr.getGainMode(SOAPY_SDR_RX, 0):
+            return "auto"
+        return f"{self.sdr.getGain(SOAPY_SDR_RX, 0):g}"
+
+    def getSerial(self) -> str:
+        '''
+        Return the serial of the device, or an empty string if it is not known
+        '''
+        return self.serial
+
+
     def setPPMOffset(self, offset: int) -> None:
         '''
         Set the PPM offset for the SDR
@@ -157,7 +306,7 @@ class SDR:
             try:
                 self.sdr.setFrequencyCorrection(SOAPY_SDR_RX, 0, offset)
             except Exception as e:
-                raise Exception(e)
+                raise SDRConfigError(f"Not able to set PPM offset {offset}: {e}") from e
         else:
             print("PPM offset not availabe for this device... skipping...")
     
@@ -167,40 +316,92 @@ class SDR:
         '''
         return self.sdr.getFrequencyCorrection(SOAPY_SDR_RX, 0)
 
+
+    def setStreamFormat(self, stream_format: str) -> None:
+        '''
+        Set the format samples are streamed in, either "cf32" or "native"
+
+        In the native format of the device (CS16 or CS8 for most SDRs) the driver does not convert the samples,
+        and 2-4 times fewer bytes are moved per sample. They are read into an integer buffer and converted to complex64
+        by readFromStream. Devices without an integer native format stream CF32.
+        A stream that is already set up is closed, so the next startStream() sets it up in the new format
+        '''
+        if stream_format not in ("cf32", "native"):
+            raise SDRConfigError(f"Invalid stream format {stream_format}. Must be cf32 or native!!")
+
+        self.format, self.full_scale = SOAPY_SDR_CF32, 1.0
+        if stream_format == "native":
+            native_format, full_scale = self.sdr.getNativeStreamFormat(SOAPY_SDR_RX, 0)
+            if native_format in NATIVE_FORMATS:
+                self.format, self.full_scale = native_format, full_scale
+
+        if self.rxStream is not None:
+            self.stopStream()
+        self.setBins(self.bins)
+
+    def getStreamFormat(self) -> str:
+        '''
+        Return the Soapy format samples are streamed in
+        '''
+        return self.format
+
     # ------------------------------- Streaming ------------------------------ #
 
     def startStream(self) -> None:
         '''
         Start a stream from device
+
+        A stream that was paused is activated again without setting it up anew
         '''
-        self.rxStream = self.sdr.setupStream(SOAPY_SDR_RX, SOAPY_SDR_CF32)
-        self.sdr.activateStream(self.rxStream)
+        if self.rxStream is None:
+            self.rxStream = self.sdr.setupStream(SOAPY_SDR_RX, self.format)
+        if not self.active:
+            self.sdr.activateStream(self.rxStream)
+            self.active = True
 
     def readFromStream(self) -> np.ndarray:
         '''
-        Read bins into buffer
+        Read bins into buffer, returned as complex64 samples
+
+        Partial reads are continued until the buffer is full. Overflows, where the device dropped samples
+        because they were not read in time, are counted in overflows and reading continues.
+        Samples in a native format are converted into the same preallocated buffer, which is overwritten by the next read
         '''
-        if self.rxStream == None:
-            print("Stream has not been started yet. Please run startStream() first!!")
-            quit()
-        
-        sr = self.sdr.readStream(self.rxStream, [self.buffer], self.bins)
-        if sr.ret < self.bins:
-            print(f"Error when reading samples... Received {sr.ret}, but expected {self.bins}")
-            self.stopStream()
-            return
+        if self.rxStream is None or not self.active:
+            raise SDRStreamError("Stream has not been started yet. Please run startStream() first!!")
 
+        native = self.raw_buffer is not None
+        filled = 0
+        while filled < self.bins:
+            target = self.raw_buffer[2*filled:] if native else self.buffer[filled:]
+            sr = self.sdr.readStream(self.rxStream, [target], self.bins - filled, timeoutUs=READ_TIMEOUT_US)
+            if sr.ret == SOAPY_SDR_OVERFLOW:
+                self.overflows += 1
+                continue
+            if sr.ret < 0:
+                import SoapySDR
+                raise SDRStreamError(f"Error when reading samples... Received error code {sr.ret} ({SoapySDR.errToStr(sr.ret)})", code=sr.ret)
+            filled += sr.ret
+
+        if native:
+            return DSP.nativeToComplex(raw = self.raw_buffer, full_scale = self.full_scale, out = self.buffer)
         return self.buffer
 
+    def pauseStream(self) -> None:
+        '''
+        Deactivate the stream, but keep it set up so it can be restarted quickly with startStream()
+        '''
+        if self.rxStream is not None and self.active:
+            self.sdr.deactivateStream(self.rxStream)
+            self.active = False
+
     def stopStream(self) -> None:
         '''
         Stop the stream from device
         '''
-        if self.rxStream == None:
-            print("No stream to stop. Please start a stream with startStream()!!")
-            quit()
+        if self.rxStream is None:
+            raise SDRStreamError("No stream to stop. Please start a stream with startStream()!!")
 
-        self.sdr.deactivateStream(self.rxStream)
+        self.pauseStream()
         self.sdr.closeStream(self.rxStream)
         self.rxStream = None
-
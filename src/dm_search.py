@@ -0,0 +1,171 @@
+import os
+import time
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+from core.pulsar import readFilterbank, closeFilterbank, fdmt, dedisperseBruteForce, dmFromDelay, delayFromDM
+
+# Time samples dedispersed by a worker at a time, excluding the overlap with the next chunk
+SEARCH_CHUNK_SIZE = 2**14
+
+# Boxcar widths (in samples) searched for pulses
+PULSE_WIDTHS = (1, 2, 4, 8, 16, 32)
+
+# Samples per dedispersed series used to estimate its noise
+NOISE_SAMPLES = 2048
+
+
+def channelFrequencies(header: dict) -> tuple:
+    '''
+    Return channel frequencies (in Hz) of a filterbank header in increasing order, and whether the channels must be flipped to get there
+    '''
+    freqs = (header["fch1"] + header["foff"]*np.arange(header["nchans"]))*10**6
+    flip = header["foff"] < 0
+    return (freqs[::-1] if flip else freqs), flip
+
+
+def loadChunk(data: np.memmap, start: int, stop: int, flip: bool) -> np.ndarray:
+    '''
+    Load time samples start to stop of a memory mapped filterbank as a (channels, time samples) block in increasing frequency
+
+    The median of each channel is subtracted, so the bandpass does not add up in the dedispersed series
+    '''
+    block = data[start:stop].T
+    block = np.ascontiguousarray(block[::-1] if flip else block, dtype=np.float32)
+    block -= np.median(block, axis=1)[:, None]
+    return block
+
+
+def pulseSNR(series: np.ndarray, widths: tuple = PULSE_WIDTHS) -> tuple:
+    '''
+    Search each row of a (trials, time samples) array of dedispersed series for the strongest pulse with boxcar filters
+
+    Noise is estimated from the median absolute deviation of each row, taken from a subset of about NOISE_SAMPLES samples.
+    Returns the signal to noise ratio, sample and boxcar width of the best pulse of every row
+    '''
+    subset = series[:, ::max(series.shape[1]//NOISE_SAMPLES, 1)]
+    med = np.median(subset, axis=1)
+    noise = 1.4826*np.median(np.abs(subset - med[:, None]), axis=1)
+    noise[~(noise > 0)] = np.inf
+    cumsum = np.cumsum(series - med[:, None], axis=1, dtype=np.float64)
+    cumsum = np.concatenate([np.zeros((series.shape[0], 1)), cumsum], axis=1)
+
+    best_snr = np.full(series.shape[0], -np.inf)
+    best_sample = np.zeros(series.shape[0], dtype=np.int64)
+    best_width = np.zeros(series.shape[0], dtype=np.int64)
+    rows = np.arange(series.shape[0])
+    for width in widths:
+        if width > series.shape[1]:
+            break
+        snr = (cumsum[:, width:] - cumsum[:, :-width])/(noise[:, None]*np.sqrt(width))
+        peak = np.argmax(snr, axis=1)
+        better = snr[rows, peak] > best_snr
+        best_snr[better] = snr[rows, peak][better]
+        best_sample[better] = peak[better]
+        best_width[better] = width
+    return best_snr, best_sample, best_width
+
+
+def searchChunk(job: tuple) -> tuple:
+    '''
+    Dedisperse and search one chunk of a filterbank file
+
+    job is (path, start, stop, max_delay). The file is memory mapped by the worker itself, so only the chunk is read.
+    Returns the signal to noise ratio, sample and width of the best pulse at every trial delay
+    '''
+    path, start, stop, max_delay = job
+    header, data = readFilterbank(path)
+    freqs, flip = channelFrequencies(header)
+
+    # Samples after the chunk are needed to complete the dedispersed series at its end
+    block = loadChunk(data, start, min(stop + max_delay - 1, data.shape[0]), flip)
+    closeFilterbank(data)
+    n_valid = min(stop - start, block.shape[1] - max_delay + 1)
+    series = fdmt(block, freqs, max_delay)[:, :n_valid]
+
+    snr, sample, width = pulseSNR(series)
+    return snr, sample + start, width
+
+
+def searchFilterbank(path: str, dm_max: float = 500.0, threshold: float = 6.0) -> None:
+    '''
+    Search a recorded filterbank file for dispersed pulses at every trial DM up to dm_max
+
+    The file is split into chunks of SEARCH_CHUNK_SIZE samples that are dedispersed with the FDMT in parallel.
+    The trial DMs are spaced by one sample of delay across the band. The best pulse of every chunk and trial DM
+    above threshold is saved as a candidate to a csv file next to the filterbank file.
+    '''
+    header, data = readFilterbank(path)
+    freqs, _ = channelFrequencies(header)
+    tsamp = header["tsamp"]
+    n_samples = data.shape[0]
+    closeFilterbank(data)
+
+    max_delay = delayFromDM(dm_max, freqs[0], freqs[-1], tsamp) + 1
+    if max_delay >= n_samples:
+        print(f"Recording of {n_samples} samples is too short for a delay of {max_delay} samples at DM {dm_max}!!")
+        return
+    dms = dmFromDelay(np.arange(max_delay), freqs[0], freqs[-1], tsamp)
+
+    chunk_size = max(SEARCH_CHUNK_SIZE, 4*max_delay)
+    jobs = [(path, start, min(start + chunk_size, n_samples - max_delay + 1), max_delay)
+            for start in range(0, n_samples - max_delay + 1, chunk_size)]
+    print(f"Searching {len(dms)} trial DMs in {n_samples} samples ({len(jobs)} chunks)...")
+
+    start_time = time.perf_counter()
+    with ProcessPoolExecutor() as executor:
+        chunk_results = list(executor.map(searchChunk, jobs))
+    print(f"Done in {round(time.perf_counter() - start_time, 2)} s")
+
+    # Best pulse of every chunk and trial DM
+    snr, sample, width = (np.concatenate(values) for values in zip(*chunk_results))
+    results = pd.DataFrame(data={
+        "DM": np.tile(dms, len(jobs)),
+        "SNR": snr,
+        "Time": sample*tsamp,
+        "Width": width*tsamp
+    })
+    candidates = results[results["SNR"] > threshold].sort_values("SNR", ascending=False)
+
+    out_path = os.path.splitext(path)[0] + "_candidates.csv"
+    candidates.to_csv(out_path, encoding="utf-8", index=False)
+
+    if len(candidates) == 0:
+        print(f"No pulses above SNR {threshold}")
+    for _, candidate in candidates.head(10).iterrows():
+        print(f"DM {round(candidate['DM'], 2)}: SNR {round(candidate['SNR'], 1)} at {round(candidate['Time'], 4)} s, width {round(candidate['Width']*1000, 2)} ms")
+    print(f"Saved {len(candidates)} candidates to {out_path}")
+
+
+def benchmarkDedispersion(path: str, dm_max: float = 500.0) -> None:
+    '''
+    Time the FDMT against brute force dedispersion on the first chunk of a filterbank file, at the same trial DMs
+    '''
+    header, data = readFilterbank(path)
+    freqs, flip = channelFrequencies(header)
+    tsamp = header["tsamp"]
+
+    max_delay = delayFromDM(dm_max, freqs[0], freqs[-1], tsamp) + 1
+    dms = dmFromDelay(np.arange(max_delay), freqs[0], freqs[-1], tsamp)
+    block = loadChunk(data, 0, min(max(SEARCH_CHUNK_SIZE, 4*max_delay) + max_delay - 1, data.shape[0]), flip)
+    closeFilterbank(data)
+    n_valid = block.shape[1] - max_delay + 1
+    if n_valid <= 0:
+        print(f"Recording is too short for a delay of {max_delay} samples at DM {dm_max}!!")
+        return
+    print(f"Dedispersing {block.shape[1]} samples of {block.shape[0]} channels at {len(dms)} trial DMs...")
+
+    start_time = time.perf_counter()
+    fdmt_series = fdmt(block, freqs, max_delay)
+    fdmt_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    brute_series = dedisperseBruteForce(block, freqs, dms, tsamp)
+    brute_time = time.perf_counter() - start_time
+
+    fdmt_snr = pulseSNR(fdmt_series[:, :n_valid])[0]
+    brute_snr = pulseSNR(brute_series[:, :n_valid])[0]
+    print(f"FDMT:        {round(fdmt_time, 3)} s, best SNR {round(fdmt_snr.max(), 1)} at DM {round(dms[np.argmax(fdmt_snr)], 2)}")
+    print(f"Brute force: {round(brute_time, 3)} s, best SNR {round(brute_snr.max(), 1)} at DM {round(dms[np.argmax(brute_snr)], 2)}")
+    print(f"Speedup: {round(brute_time/fdmt_time, 1)}x")
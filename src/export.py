@@ -0,0 +1,26 @@
+import time
+
+from core.observation import Observation
+from core.sdfits import writeSDFITS
+from model_fitting import findObservations
+
+
+def exportSDFITS(path: str, out_path: str = "none") -> None:
+    '''
+    Export the observation directory path, or every observation in the survey directory path, to one SDFITS file
+
+    The file is written to out_path, or next to the observations as <directory name>.fits
+    '''
+    path += "" if path[-1] == "/" or path[-1] == "\\" else "/"
+    obs_dirs = [path] if Observation.hasData(path) else findObservations(path)
+    if len(obs_dirs) == 0:
+        print("No observations found!!")
+        return
+
+    if out_path == "none":
+        out_path = path.rstrip("/\\")+".fits" if len(obs_dirs) > 1 else path+"observation_data.fits"
+
+    print(f"Exporting {len(obs_dirs)} observations to {out_path}...")
+    start = time.perf_counter()
+    n_spectra = writeSDFITS(out_path, [Observation(dir=d) for d in obs_dirs])
+    print(f"Done! Wrote {n_spectra} spectra in {round(time.perf_counter() - start, 2)} s")
@@ -0,0 +1,72 @@
+'''
+Import time budget of the entry points of RadioPy.
+
+Every entry module is imported in a fresh interpreter, timing the import and
+checking that heavy modules it should load lazily were not pulled in.
+'''
+import os
+import sys
+import subprocess
+
+# Entry module: (import time budget in seconds, modules it must not import)
+IMPORT_BUDGETS = {
+    "observation_worker": (0.05, ("numpy", "astropy", "SoapySDR", "dearpygui", "pandas", "matplotlib")),
+    "spectral_line": (2.5, ("dearpygui", "pandas", "matplotlib")),
+    "pulsar": (2.5, ("dearpygui", "pandas", "matplotlib")),
+    "radiometer": (2.5, ("dearpygui", "pandas", "matplotlib")),
+    "model_fitting": (1.0, ("dearpygui", "astropy", "SoapySDR", "pandas", "matplotlib")),
+    "dm_search": (1.0, ("dearpygui", "astropy", "SoapySDR", "matplotlib")),
+    "allan": (1.0, ("dearpygui", "astropy", "SoapySDR", "matplotlib")),
+    "migrate": (1.0, ("dearpygui", "astropy", "SoapySDR", "pandas", "matplotlib")),
+    "export": (1.5, ("dearpygui", "SoapySDR", "pandas", "matplotlib")),
+    "server": (0.5, ("dearpygui", "astropy", "SoapySDR", "pandas", "matplotlib")),
+    "ui.radiopy_ui": (1.5, ("astropy", "pandas", "matplotlib")),
+}
+
+IMPORT_SCRIPT = """
+import sys, time
+sys.path.insert(0, {src!r})
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start)
+print(",".join(m for m in {forbidden!r} if m in sys.modules))
+"""
+
+
+def measureImport(module: str, forbidden: tuple) -> tuple:
+    '''
+    Import module in a fresh interpreter
+
+    Returns the import time in seconds and the forbidden modules that were imported, or None if the import failed
+    '''
+    src = os.path.dirname(os.path.abspath(__file__))
+    script = IMPORT_SCRIPT.format(src=src, module=module, forbidden=forbidden)
+    result = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True)
+    if result.returncode != 0:
+        return None
+    lines = result.stdout.splitlines()
+    return float(lines[-2]), [m for m in lines[-1].split(",") if m]
+
+
+def checkImportBudget() -> bool:
+    '''
+    Print import time of every entry module against its budget
+
+    Returns True if all entry modules import within budget and without their forbidden modules
+    '''
+    passed = True
+    for module, (budget, forbidden) in IMPORT_BUDGETS.items():
+        measured = measureImport(module, forbidden)
+        if measured is None:
+            print(f"{module:<20} import failed")
+            passed = False
+            continue
+
+        import_time, imported = measured
+        ok = import_time <= budget and not imported
+        passed &= ok
+        status = "OK" if ok else "FAIL"
+        print(f"{module:<20} {import_time:6.2f} s (budget {budget:.2f} s)  {status}")
+        if imported:
+            print(f"{'':<20} imports {', '.join(imported)}")
+    return passed
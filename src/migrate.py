@@ -0,0 +1,98 @@
+import os
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+from core.archive import ARCHIVE_NAME, ArchiveReader, ArchiveWriter
+from core.observation import Observation
+from core.pulsar import readFilterbank
+
+# Data files of an observation directory that are moved into its archive
+ARCHIVED_FILES = ("observation_data.csv", "observation_data.fil", "observation_radiometer.npz", "observation_series.npy")
+
+
+def findArchivable(path: str) -> list:
+    '''
+    Return sorted list of observation directories in path (or path itself) with data files not yet archived
+    '''
+    path += "" if path[-1] == "/" or path[-1] == "\\" else "/"
+    dirs = [path] + [path+d+"/" for d in sorted(os.listdir(path)) if os.path.isdir(path+d)]
+    return [d for d in dirs if any(os.path.isfile(d+f) for f in ARCHIVED_FILES)]
+
+
+def archiveObservation(job: tuple) -> tuple:
+    '''
+    Move the data files of an observation directory into its archive
+
+    Spectra in dB are stored with at most precision dB error, and linear power (filterbank, total power and time series)
+    with the matching relative error of the chunk mean. Axes, times and coordinates are stored losslessly.
+    Originals are only deleted once the archive is verified, and kept if keep is True.
+
+    Returns tuple of the directory, bytes before and after, and whether the archive verified
+    '''
+    obs_dir, precision, codec, keep = job
+    originals = [f for f in ARCHIVED_FILES if os.path.isfile(obs_dir+f)]
+    before = sum(os.path.getsize(obs_dir+f) for f in originals)
+    relative = 10**(precision/10) - 1
+
+    # Arrays to add as (name, array, precision, relative, attrs)
+    arrays = []
+    if "observation_data.csv" in originals:
+        frequency, radial_velocity, data = Observation(dir=obs_dir).readData()
+        arrays += [("frequency", frequency, 0.0, False, None), ("radial_velocity", radial_velocity, 0.0, False, None),
+                   ("data", data, precision, False, None)]
+    if "observation_data.fil" in originals:
+        header, data = readFilterbank(obs_dir+"observation_data.fil")
+        arrays.append(("filterbank", data, relative, True, header))
+    if "observation_radiometer.npz" in originals:
+        with np.load(obs_dir+"observation_radiometer.npz") as f:
+            arrays += [("radiometer/"+key, f[key], relative if key == "power" else 0.0, key == "power", None) for key in f.files]
+    if "observation_series.npy" in originals:
+        arrays.append(("series", np.load(obs_dir+"observation_series.npy", mmap_mode="r"), relative, True, None))
+
+    # Arrays of an existing archive are copied over as they are
+    existing = ArchiveReader(obs_dir+ARCHIVE_NAME) if os.path.isfile(obs_dir+ARCHIVE_NAME) else None
+    try:
+        with ArchiveWriter(obs_dir+ARCHIVE_NAME, codec) as writer:
+            if existing is not None:
+                for name in existing.names():
+                    if name not in [a[0] for a in arrays]:
+                        writer.copyArray(existing, name)
+                # Closed before the new archive replaces it
+                existing.close()
+            for name, array, array_precision, array_relative, attrs in arrays:
+                writer.addArray(name, array, precision=array_precision, relative=array_relative, attrs=attrs)
+    finally:
+        if existing is not None:
+            existing.close()
+
+    with ArchiveReader(obs_dir+ARCHIVE_NAME) as archive:
+        verified = all(archive[name].verify(array) for name, array, *_ in arrays)
+    if verified and not keep:
+        for f in originals:
+            os.remove(obs_dir+f)
+    return obs_dir, before, os.path.getsize(obs_dir+ARCHIVE_NAME), verified
+
+
+def migrateObservations(path: str, precision: float = 0.001, codec: str = "zlib", keep: bool = False) -> None:
+    '''
+    Convert every observation directory in path to the compressed archive format, in parallel
+    '''
+    obs_dirs = findArchivable(path)
+    if len(obs_dirs) == 0:
+        print("No observations to archive found!!")
+        return
+
+    print(f"Archiving {len(obs_dirs)} observations with at most {precision} dB error...")
+    start = time.perf_counter()
+    jobs = [(d, precision, codec, keep) for d in obs_dirs]
+    with ProcessPoolExecutor() as executor:
+        results = list(executor.map(archiveObservation, jobs, chunksize=8))
+
+    before = sum(r[1] for r in results)
+    after = sum(r[2] for r in results)
+    failed = [r[0] for r in results if not r[3]]
+    for obs_dir in failed:
+        print(f"Archive of {obs_dir} did not verify... keeping the original files")
+    print(f"Done! {round(before/2**20, 1)} MB to {round(after/2**20, 1)} MB ({round(before/max(after, 1), 1)}x) "
+          f"in {round(time.perf_counter() - start, 1)} s")
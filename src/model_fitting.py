@@ -0,0 +1,71 @@
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+from core.observation import Observation
+from core.fitting import GaussianModel, fitBatch
+from core.detection import detectLines
+
+# Number of spectra handed to a worker process at a time
+FIT_CHUNK_SIZE = 64
+
+
+def findObservations(path: str) -> list:
+    '''
+    Return sorted list of observation directories in path
+    '''
+    path += "" if path[-1] == "/" or path[-1] == "\\" else "/"
+    return [path+d+"/" for d in sorted(os.listdir(path)) if os.path.isdir(path+d) and Observation.hasData(path+d)]
+
+
+def detectSeeds(spectra: list) -> list:
+    '''
+    Generate initial guesses for a list of (radial velocity, data) spectra with the line detector
+
+    Spectra with the same number of channels are searched together
+    '''
+    seeds = [None]*len(spectra)
+    sizes = np.array([data.size for _, data in spectra])
+    for size in np.unique(sizes):
+        idx = np.flatnonzero(sizes == size)
+        vels = np.array([spectra[i][0] for i in idx])
+        data = np.array([spectra[i][1] for i in idx])
+        for i, model in zip(idx, detectLines(vels, data)):
+            seeds[i] = model
+    return seeds
+
+
+def fitObservations(path: str, seed_path: str = "none", name: str = "auto") -> None:
+    '''
+    Fit a Gaussian model to every observation in the directory path, using the model saved at seed_path as initial guess
+
+    If no seed is given, initial guesses are found for each observation by the line detector
+    The fitted models are saved with each observation under the given name
+    '''
+    obs_dirs = findObservations(path)
+    if len(obs_dirs) == 0:
+        print("No observations found!!")
+        return
+
+    observations = [Observation(dir=d) for d in obs_dirs]
+    spectra = [obs.readData()[1:] for obs in observations]
+
+    if seed_path == "none":
+        print(f"Detecting lines in {len(obs_dirs)} observations...")
+        seeds = detectSeeds(spectra)
+    else:
+        with np.load(seed_path) as seed_file:
+            seeds = [GaussianModel.fromDict(seed_file)]*len(spectra)
+
+    print(f"Fitting {len(obs_dirs)} observations...")
+    jobs = [(radial_vel, data, seed) for (radial_vel, data), seed in zip(spectra, seeds)]
+
+    chunks = [jobs[i:i+FIT_CHUNK_SIZE] for i in range(0, len(jobs), FIT_CHUNK_SIZE)]
+    with ProcessPoolExecutor() as executor:
+        models = [model for chunk in executor.map(fitBatch, chunks) for model in chunk]
+
+    for obs, model in zip(observations, models):
+        obs.writeModel(name, model)
+
+    n_success = sum(model.SUCCESS for model in models)
+    print(f"Done! {n_success} of {len(models)} fits converged")
@@ -0,0 +1,53 @@
+'''
+Entry point for observations run in a background process.
+
+This module is kept free of heavy imports, so the UI can hand its functions to
+a child process without the child importing the UI or the UI importing the
+acquisition code.
+'''
+
+def observationWorker(commands, live_queue, stop = None) -> None:
+    '''
+    Persistent worker running a spectral line observation from the config file for every "run" on commands
+
+    The acquisition code (astropy, scipy) is imported and warmed up once when the worker starts, so it is ready
+    by the time an observation is requested. Live updates are streamed to live_queue, and a {"finished": True}
+    message is always sent last for each observation, also if it fails. The SDR stays open between observations
+    and is closed when the worker exits on None.
+    If a stop event is given, setting it ends the running integration early, and the observation is saved with the
+    spectra integrated so far. It has to be cleared before the next "run" is sent.
+    '''
+    from spectral_line import runObservation
+    from core.session import closeSessions
+    warmUp()
+
+    while True:
+        command = commands.get()
+        if command is None:
+            break
+        try:
+            runObservation(live_queue = live_queue, stop = stop)
+        # Loading a broken config quit()s, which must not take down the worker
+        except (Exception, SystemExit) as error:
+            print(f"Observation failed: {error}")
+        finally:
+            live_queue.put({"finished": True})
+
+    closeSessions()
+
+
+def warmUp() -> None:
+    '''
+    Run a throwaway coordinate transformation and LSR correction
+
+    The first of these loads astropy's Earth orientation and ephemeris tables, which would otherwise delay the first observation
+    '''
+    from datetime import datetime
+    from core.ground_station import Antenna, GroundStation
+    try:
+        antenna = Antenna(AZ=0, ALT=45, RA=0, DEC=0, use_eq_coords=False, LO_FREQ=0)
+        gs = GroundStation(lat=0, lon=0, elev=0, time=datetime.utcnow(), lsr_correct=True, antenna=antenna)
+        ra, dec = antenna.getEquatorialCoordinates(gs)
+        gs.getLSRCorrection(ra=ra, dec=dec)
+    except Exception:
+        pass
@@ -0,0 +1,172 @@
+import time
+import shutil
+from datetime import datetime
+import numpy as np
+
+import ui.config_callbacks as CB
+from core.ground_station import Antenna, GroundStation
+from core.soapy import SDR, SDRError
+from core.session import getSession
+import core.dsp as DSP
+from core.observation import Observation
+from core.pulsar import FilterbankWriter, StreamingDedisperser, Folder, delayTable, degreesToSigproc
+
+# Approximate number of samples read from the SDR at a time
+SAMPLES_PER_READ = 2**16
+
+def runPulsarObservation():
+    # Load config
+    config = CB.loadConfig()
+    print("Running pulsar observation...")
+
+    # Configure Antenna/ground station
+    lat = config.getfloat("Ground station", "lat")
+    lon = config.getfloat("Ground station", "lon")
+    elev = config.getfloat("Ground station", "elev")
+    az = config.getfloat("Ground station", "az")
+    alt = config.getfloat("Ground station", "alt")
+    ra = config.getfloat("Ground station", "ra")
+    dec = config.getfloat("Ground station", "dec")
+    use_eq_coords = config.getboolean("Ground station", "use_eq_coords")
+    LO_freq = config.getfloat("Ground station", "lo_freq")
+
+    antenna = Antenna(az, alt, ra, dec, use_eq_coords, LO_freq)
+    current_time = datetime.utcnow()
+    formatted_time = current_time.strftime("%d_%m_%Y_%H_%M_%S")
+    gs = GroundStation(lat, lon, elev, current_time, False, antenna)
+
+    # Configure SDR
+    if config.get("SDR", "driver") == "none" or config.getint("SDR", "sample_rate") == 0:
+        print("Please select a driver and sample rate first!")
+        return
+
+    driver = config.get("SDR", "driver")
+    sample_rate = config.getint("SDR", "sample_rate")
+    PPM_offset = config.getint("SDR", "ppm_offset")
+    center_freq = config.getint("SDR", "frequency")
+    dropout_repair = config.get("SDR", "dropout_repair", fallback="interpolate")
+    stream_format = config.get("SDR", "stream_format", fallback="cf32")
+
+    dm = config.getfloat("Pulsar", "dm", fallback=0.0)
+    period = config.getfloat("Pulsar", "period", fallback=0.0)
+    phase_bins = config.getint("Pulsar", "phase_bins", fallback=128)
+    duration = config.getfloat("Pulsar", "duration", fallback=60.0)
+    channels = config.getint("Pulsar", "channels", fallback=64)
+    fft_avg = config.getint("Pulsar", "fft_avg", fallback=16)
+    save_filterbank = config.getboolean("Pulsar", "save_filterbank", fallback=True)
+    out_dir = config.get("Spectral line", "output_dir", fallback="")
+    out_dir = "Observations/" if out_dir == "" else out_dir
+    out_dir += "" if out_dir[-1] == "/" or out_dir[-1] == "\\" else "/"
+
+    # Every read holds a whole number of filterbank spectra
+    samples_per_spectrum = channels*fft_avg
+    n_bins = max(SAMPLES_PER_READ//samples_per_spectrum, 1)*samples_per_spectrum
+    tsamp = samples_per_spectrum/sample_rate
+
+    sdr_freq = center_freq - LO_freq
+    try:
+        # The device stays open between observations, and is only retuned
+        sdr = getSession(driver).configure(freq = sdr_freq, sample_rate = sample_rate, ppm_offset = PPM_offset, bins = n_bins,
+                                           stream_format = stream_format)
+    except SDRError as error:
+        print(f"Observation failed: {error}")
+        return
+
+    # Channel frequencies in increasing order, matching the shifted FFT
+    freqs = center_freq + np.fft.fftshift(np.fft.fftfreq(channels, 1/sample_rate))
+    delays = delayTable(freqs = freqs, dm = dm, tsamp = tsamp)
+    if delays.max() > 0:
+        print(f"Dispersion sweep across the band is {delays.max()} samples ({round(delays.max()*tsamp, 3)} s)")
+
+    obs_name = f"pulsar_{center_freq}_{formatted_time}"
+    obs = Observation(dir = out_dir+obs_name+"/")
+
+    writer = None
+    if save_filterbank:
+        eq_coords = antenna.getEquatorialCoordinates(gs)
+        header = {
+            "source_name": obs_name,
+            "machine_id": 0,
+            "telescope_id": 0,
+            "data_type": 1,
+            "nchans": channels,
+            "nbits": 32,
+            "nifs": 1,
+            "fch1": freqs[0]/10**6,
+            "foff": sample_rate/channels/10**6,
+            "tstart": gs.TIME.mjd,
+            "tsamp": tsamp,
+            "src_raj": degreesToSigproc(eq_coords[0], hours=True),
+            "src_dej": degreesToSigproc(eq_coords[1]),
+            "refdm": dm
+        }
+        writer = FilterbankWriter(obs.DIR+"observation_data.fil", header)
+
+    dedisperser = StreamingDedisperser(delays)
+    folder = Folder(period = period, tsamp = tsamp, phase_bins = phase_bins) if period > 0 else None
+    dropouts = DSP.DropoutRepair(n_samples = n_bins, mode = dropout_repair, min_run = DSP.minDropoutRun(stream_format))
+
+    try:
+        series = collectPulsarData(sdr = sdr, channels = channels, fft_avg = fft_avg, duration = duration,
+                                   dedisperser = dedisperser, folder = folder, writer = writer, dropouts = dropouts)
+    except SDRError as error:
+        print(f"Observation failed: {error}")
+        return
+    finally:
+        if writer is not None:
+            writer.close()
+
+    # Save data
+    obs.writeInfo(ground_station=gs, antenna=antenna, sdr=sdr, dropouts=dropouts.stats)
+    obs.writeTimeSeries(series=series, tsamp=tsamp, dm=dm)
+    if folder is not None:
+        obs.writeProfile(profile=folder.getProfile(), period=period, dm=dm)
+        obs.plotProfile()
+    shutil.copyfile("config.ini", out_dir+obs_name+"/"+"observation_config.ini")
+
+
+def collectPulsarData(sdr: SDR, channels: int, fft_avg: int, duration: float, dedisperser: StreamingDedisperser,
+                      folder: Folder = None, writer: FilterbankWriter = None, dropouts: DSP.DropoutRepair = None) -> np.ndarray:
+    '''
+    Stream filterbank spectra from a given sdr (instance of SDR or SDRSession) for duration seconds
+
+    Every read is split into FFTs of channels samples, and fft_avg consecutive power spectra are averaged into one
+    filterbank spectrum. The spectra are appended to writer, dedispersed and, if a folder is given, folded as they arrive.
+    Reads where every sample was dropped are replaced by the mean spectrum of the previous read (zeros before the first),
+    so the filterbank, dedispersion and fold phase keep the timing of the stream
+    Returns the dedispersed time series
+    '''
+    n_bins = sdr.getBins()
+    dropouts = DSP.DropoutRepair(n_samples = n_bins) if dropouts is None else dropouts
+
+    series = []
+    spectra_per_read = n_bins//(channels*fft_avg)
+    last_mean = np.zeros(channels, dtype=np.float32)
+    start_time = time.perf_counter()
+    sdr.startStream()
+    try:
+        while time.perf_counter() - start_time < duration:
+            samples = sdr.readFromStream()
+            if dropouts(samples):
+                # All FFTs of the read at once, then averaged to (spectra, channels)
+                psd = DSP.doFFT(bins = samples.reshape(-1, channels), n_bins = channels)
+                spectra = psd.reshape(-1, fft_avg, channels).mean(axis=1, dtype=np.float32)
+                last_mean = spectra.mean(axis=0)
+            else:
+                spectra = np.tile(last_mean, (spectra_per_read, 1))
+
+            if writer is not None:
+                writer.write(spectra)
+            dedispersed = dedisperser.process(spectra)
+            if folder is not None:
+                folder.add(dedispersed)
+            series.append(dedispersed)
+
+    finally:
+        sdr.stopStream()
+
+    if dropouts.stats.dropped_samples > 0:
+        print(f"Repaired {dropouts.stats.dropped_samples} dropped samples in {dropouts.stats.runs} runs (longest {dropouts.stats.longest_run})")
+        print(f"Filled {dropouts.stats.empty_blocks} blocks with only dropped samples from the previous block")
+
+    return np.concatenate(series) if series else np.zeros(0, dtype=np.float32)
@@ -0,0 +1,137 @@
+import time
+import shutil
+from datetime import datetime
+import numpy as np
+from astropy.time import Time
+
+import ui.config_callbacks as CB
+from core.ground_station import Antenna, GroundStation
+from core.soapy import SDR, SDRError
+from core.session import getSession
+import core.dsp as DSP
+from core.observation import Observation
+
+# Time samples whose sky coordinates are computed in one astropy call
+COORD_BATCH_SIZE = 10000
+
+def runRadiometerObservation():
+    # Load config
+    config = CB.loadConfig()
+    print("Running total power observation...")
+
+    # Configure Antenna/ground station
+    lat = config.getfloat("Ground station", "lat")
+    lon = config.getfloat("Ground station", "lon")
+    elev = config.getfloat("Ground station", "elev")
+    az = config.getfloat("Ground station", "az")
+    alt = config.getfloat("Ground station", "alt")
+    ra = config.getfloat("Ground station", "ra")
+    dec = config.getfloat("Ground station", "dec")
+    use_eq_coords = config.getboolean("Ground station", "use_eq_coords")
+    LO_freq = config.getfloat("Ground station", "lo_freq")
+
+    antenna = Antenna(az, alt, ra, dec, use_eq_coords, LO_freq)
+    current_time = datetime.utcnow()
+    formatted_time = current_time.strftime("%d_%m_%Y_%H_%M_%S")
+    gs = GroundStation(lat, lon, elev, current_time, False, antenna)
+
+    # Configure SDR
+    if config.get("SDR", "driver") == "none" or config.getint("SDR", "sample_rate") == 0:
+        print("Please select a driver and sample rate first!")
+        return
+
+    driver = config.get("SDR", "driver")
+    sample_rate = config.getint("SDR", "sample_rate")
+    PPM_offset = config.getint("SDR", "ppm_offset")
+    center_freq = config.getint("SDR", "frequency")
+    dropout_repair = config.get("SDR", "dropout_repair", fallback="interpolate")
+    stream_format = config.get("SDR", "stream_format", fallback="cf32")
+
+    duration = config.getfloat("Radiometer", "duration", fallback=60.0)
+    sample_time = config.getfloat("Radiometer", "sample_time", fallback=0.1)
+    subbands = max(config.getint("Radiometer", "subbands", fallback=1), 1)
+    out_dir = config.get("Spectral line", "output_dir", fallback="")
+    out_dir = "Observations/" if out_dir == "" else out_dir
+    out_dir += "" if out_dir[-1] == "/" or out_dir[-1] == "\\" else "/"
+
+    # One read per time sample, a whole number of sub-band FFTs long
+    n_bins = max(int(sample_rate*sample_time)//subbands, 1)*subbands
+
+    sdr_freq = center_freq - LO_freq
+    try:
+        # The device stays open between observations, and is only retuned
+        sdr = getSession(driver).configure(freq = sdr_freq, sample_rate = sample_rate, ppm_offset = PPM_offset, bins = n_bins,
+                                           stream_format = stream_format)
+
+        dropouts = DSP.DropoutRepair(n_samples = n_bins, mode = dropout_repair, min_run = DSP.minDropoutRun(stream_format))
+        times, power = collectPowerData(sdr = sdr, duration = duration, subbands = subbands, dropouts = dropouts)
+    except SDRError as error:
+        print(f"Observation failed: {error}")
+        return
+
+    if times.size == 0:
+        print("Every sample was dropped... Please check the connection to the SDR and try again")
+        return
+
+    # Sky coordinates of every time sample
+    times = Time(times, format="unix").mjd
+    coords = {}
+    for start in range(0, times.size, COORD_BATCH_SIZE):
+        batch = antenna.getCoordinatesAt(gs, Time(times[start:start+COORD_BATCH_SIZE], format="mjd"))
+        for key, value in batch.items():
+            coords.setdefault(key, []).append(value)
+    coords = {key: np.concatenate(value) for key, value in coords.items()}
+
+    subband_freqs = center_freq + np.fft.fftshift(np.fft.fftfreq(subbands, 1/sample_rate)) if subbands > 1 else np.array([center_freq])
+
+    # Save data
+    obs_name = f"radiometer_{center_freq}_{formatted_time}"
+    obs = Observation(dir = out_dir+obs_name+"/")
+    obs.writeInfo(ground_station=gs, antenna=antenna, sdr=sdr, dropouts=dropouts.stats)
+    obs.writeRadiometerData(times=times, power=power, coords=coords, subband_freqs=subband_freqs)
+    obs.plotRadiometerData()
+    shutil.copyfile("config.ini", out_dir+obs_name+"/"+"observation_config.ini")
+
+
+def collectPowerData(sdr: SDR, duration: float, subbands: int = 1, dropouts: DSP.DropoutRepair = None) -> tuple:
+    '''
+    Collect band power from a given sdr (instance of SDR or SDRSession) for duration seconds
+
+    Every read is reduced to its mean power, in each of subbands sub-bands, and timestamped with the middle of the read.
+    Returns tuple of the unix times and a (time samples, sub-bands) array of power
+    '''
+    n_bins = sdr.getBins()
+    dropouts = DSP.DropoutRepair(n_samples = n_bins) if dropouts is None else dropouts
+    read_time = n_bins/sdr.getSampleRate()
+
+    # Preallocated for the expected number of reads, grown if the device delivers faster
+    n_expected = int(duration/read_time) + 1
+    times = np.zeros(n_expected)
+    power = np.zeros((n_expected, max(subbands, 1)))
+    n_samples = 0
+
+    start_unix = time.time()
+    start_time = time.perf_counter()
+    sdr.startStream()
+    try:
+        while time.perf_counter() - start_time < duration:
+            samples = sdr.readFromStream()
+            now = time.perf_counter()
+            if not dropouts(samples):
+                continue
+
+            if n_samples == times.size:
+                times = np.concatenate([times, np.zeros(n_expected)])
+                power = np.concatenate([power, np.zeros((n_expected, power.shape[1]))])
+            times[n_samples] = start_unix + (now - start_time) - read_time/2
+            power[n_samples] = DSP.bandPower(samples = samples, n_subbands = subbands)
+            n_samples += 1
+
+    finally:
+        sdr.stopStream()
+
+    if dropouts.stats.dropped_samples > 0:
+        print(f"Repaired {dropouts.stats.dropped_samples} dropped samples in {dropouts.stats.runs} runs (longest {dropouts.stats.longest_run})")
+        print(f"Skipped {dropouts.stats.empty_blocks} blocks with only dropped samples")
+
+    return times[:n_samples], power[:n_samples]
@@ -0,0 +1,454 @@
+'''
+Local control and streaming server for headless observations.
+
+HTTP endpoints, answering with JSON:
+ - GET  /status     State of the server and the running observation
+ - POST /start      Start a spectral line observation from config.ini, after applying {"config": {section: {key: value}}}
+ - POST /stop       End the running integration early. The observation is saved with what was integrated
+ - POST /retune     Set the center frequency {"frequency": Hz}, restarting a running observation there
+ - GET  /spectrum   Latest spectrum as a binary frame
+ - GET  /ws         WebSocket streaming every spectrum as a binary frame. Text messages {"command": name, ...}
+                    run the commands above and are answered with their JSON
+
+Only the standard library and numpy are used. Observations run in the same persistent worker process as in the UI,
+which never waits for the server, and slow clients skip frames instead of holding up the others.
+'''
+import json
+import queue
+import base64
+import struct
+import asyncio
+import hashlib
+import configparser
+import multiprocessing
+import numpy as np
+
+from observation_worker import observationWorker
+
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 8765
+
+# Binary spectrum frame: magic, version, flags (FRAME_FINAL for the final spectrum), channels, progress (0-1), ETA (s),
+# dropped samples, frequency of the first channel and channel spacing (Hz), followed by the spectrum as float32 dB
+SPECTRUM_MAGIC = b"RPYS"
+SPECTRUM_VERSION = 1
+SPECTRUM_HEADER = struct.Struct("<4sBBxxIffQdd")
+FRAME_FINAL = 1
+
+# Frames queued per client, the oldest is dropped when a new one arrives for a full queue
+CLIENT_QUEUE_SIZE = 2
+
+# Largest request head, body or WebSocket message accepted from a client
+MAX_REQUEST_SIZE = 2**16
+
+# Type of every config key that can be set, as read by the observations: "boolean", "int", "float" or "str"
+CONFIG_TYPES = {
+    "Ground station": {
+        "lat": "float", "lon": "float", "elev": "float", "lsr_correct": "boolean", "az": "float", "alt": "float",
+        "ra": "float", "dec": "float", "use_eq_coords": "boolean", "lo_freq": "float"
+    },
+    "SDR": {
+        "driver": "str", "sample_rate": "int", "ppm_offset": "int", "bins": "int", "frequency": "int",
+        "dropout_repair": "str", "stream_format": "str"
+    },
+    "Spectral line": {
+        "fft_num": "int", "smoothing": "int", "smoothing_method": "str", "restfreq": "float", "y_min": "float",
+        "y_max": "float", "save_data": "boolean", "output_dir": "str", "background_cal": "boolean",
+        "rfi_flagging": "boolean", "rfi_subint": "int", "rfi_threshold": "float", "doppler_tracking": "boolean",
+        "doppler_interval": "float", "zoom_decimation": "int", "zoom_freq": "float", "restfreqs": "str",
+        "line_window": "float", "bandpass_cal": "boolean", "adaptive": "boolean", "target_rms": "float",
+        "rms_unit": "str", "tsys": "float", "target_snr": "float", "archive": "boolean", "archive_precision": "float",
+        "archive_codec": "str"
+    },
+    "Pulsar": {
+        "dm": "float", "period": "float", "phase_bins": "int", "duration": "float", "channels": "int", "fft_avg": "int",
+        "save_filterbank": "boolean"
+    },
+    "Radiometer": {
+        "duration": "float", "sample_time": "float", "subbands": "int"
+    }
+}
+
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+WS_TEXT, WS_BINARY, WS_CLOSE, WS_PING, WS_PONG = 0x1, 0x2, 0x8, 0x9, 0xA
+
+HTTP_REASONS = {200: "OK", 204: "No Content", 400: "Bad Request", 404: "Not Found", 409: "Conflict", 413: "Payload Too Large"}
+
+
+def encodeSpectrum(update: dict, final: bool = False) -> bytes:
+    '''
+    Encode a live update of the observation worker as a binary spectrum frame
+    '''
+    freqs = np.asarray(update["freqs"], dtype=np.float64)
+    data = np.asarray(update["data"], dtype="<f4")
+    step = (freqs[-1] - freqs[0])/(freqs.size - 1) if freqs.size > 1 else 0.0
+    header = SPECTRUM_HEADER.pack(SPECTRUM_MAGIC, SPECTRUM_VERSION, FRAME_FINAL if final else 0, data.size, update["progress"],
+                                  update["eta"], update["dropped"] or 0, freqs[0] if freqs.size > 0 else 0.0, step)
+    return header + data.tobytes()
+
+
+def decodeSpectrum(frame: bytes) -> dict:
+    '''
+    Decode a binary spectrum frame into a dictionary with freqs, data, progress, eta, dropped and final
+    '''
+    magic, version, flags, channels, progress, eta, dropped, first, step = SPECTRUM_HEADER.unpack_from(frame)
+    if magic != SPECTRUM_MAGIC or version != SPECTRUM_VERSION:
+        raise ValueError("Not a spectrum frame of a supported version")
+    data = np.frombuffer(frame, dtype="<f4", count=channels, offset=SPECTRUM_HEADER.size)
+    return {"freqs": first + step*np.arange(channels), "data": data, "progress": progress, "eta": eta, "dropped": dropped,
+            "final": bool(flags & FRAME_FINAL)}
+
+
+def websocketAccept(key: str) -> str:
+    '''
+    Sec-WebSocket-Accept answer to a Sec-WebSocket-Key
+    '''
+    return base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode()).digest()).decode()
+
+
+def websocketFrame(payload: bytes, opcode: int = WS_BINARY) -> bytes:
+    '''
+    Unmasked, unfragmented WebSocket frame, as sent by servers
+    '''
+    n = len(payload)
+    if n < 126:
+        header = struct.pack("!BB", 0x80 | opcode, n)
+    elif n < 2**16:
+        header = struct.pack("!BBH", 0x80 | opcode, 126, n)
+    else:
+        header = struct.pack("!BBQ", 0x80 | opcode, 127, n)
+    return header + payload
+
+
+async def readWebsocketFrame(reader: asyncio.StreamReader) -> tuple:
+    '''
+    Read a WebSocket frame from a client. Returns tuple of opcode and unmasked payload
+    '''
+    first, second = await reader.readexactly(2)
+    opcode, length = first & 0x0F, second & 0x7F
+    if length == 126:
+        length = struct.unpack("!H", await reader.readexactly(2))[0]
+    elif length == 127:
+        length = struct.unpack("!Q", await reader.readexactly(8))[0]
+    if length > MAX_REQUEST_SIZE:
+        raise ValueError(f"WebSocket message of {length} bytes is too large")
+    mask = await reader.readexactly(4) if second & 0x80 else None
+    payload = await reader.readexactly(length)
+    if mask is not None:
+        payload = (np.frombuffer(payload, dtype=np.uint8) ^ np.resize(np.frombuffer(mask, dtype=np.uint8), length)).tobytes()
+    return opcode, payload
+
+
+def parsesAs(value: str, value_type: str) -> bool:
+    '''
+    Return True if value can be read as value_type by configparser. Line breaks are never allowed, as they would add keys
+    '''
+    if "\n" in value or "\r" in value:
+        return False
+    if value_type == "boolean":
+        return value.lower() in configparser.ConfigParser.BOOLEAN_STATES
+    parse = {"int": int, "float": float}.get(value_type, str)
+    try:
+        parse(value)
+    except ValueError:
+        return False
+    return True
+
+
+class ObservationServer:
+    '''
+    Serves the control endpoints and spectrum stream, and drives the observation worker
+    '''
+    def __init__(self, host: str = SERVER_HOST, port: int = SERVER_PORT) -> None:
+        self.host = host
+        self.port = port
+        self.clients = set()
+        self.latest = None
+        self.restart = False
+        self.status = {"running": False, "progress": 0.0, "eta": 0.0, "dropped": 0, "observations": 0}
+        self.worker_process = None
+
+    # ------------------------------- Worker ------------------------------- #
+
+    def startWorker(self) -> None:
+        '''
+        Start the background worker, which imports the acquisition code while the server is idle
+        '''
+        ctx = multiprocessing.get_context("spawn")
+        self.commands = ctx.Queue()
+        self.live_queue = ctx.Queue(maxsize=2)
+        self.stop_event = ctx.Event()
+        self.worker_process = ctx.Process(target=observationWorker, args=(self.commands, self.live_queue, self.stop_event), daemon=True)
+        self.worker_process.start()
+
+    def stopWorker(self) -> None:
+        '''
+        Stop the background worker, ending any running observation first
+        '''
+        if self.worker_process is None:
+            return
+        self.stop_event.set()
+        self.commands.put(None)
+        self.worker_process.join(timeout=10)
+        if self.worker_process.is_alive():
+            self.worker_process.terminate()
+            self.worker_process.join()
+        self.worker_process = None
+
+    def nextUpdate(self) -> "dict | None":
+        '''
+        Wait shortly for the next live update of the worker. Run in a thread, so the event loop never blocks
+        '''
+        try:
+            return self.live_queue.get(timeout=0.5)
+        except queue.Empty:
+            return None
+
+    async def pumpUpdates(self) -> None:
+        '''
+        Forward live updates of the worker to the clients as binary frames
+        '''
+        loop = asyncio.get_running_loop()
+        while True:
+            update = await loop.run_in_executor(None, self.nextUpdate)
+            if update is None:
+                # Worker died without finishing, e.g. killed by the system
+                if self.status["running"] and not self.worker_process.is_alive():
+                    print("Observation worker died... restarting it")
+                    self.status["running"] = False
+                    self.stopWorker()
+                    self.startWorker()
+                continue
+
+            if update.get("finished"):
+                self.status["running"] = False
+                self.status["observations"] += 1
+                if self.restart:
+                    self.restart = False
+                    self.start()
+                continue
+
+            # Only the final spectrum of an observation has radial velocities
+            final = update.get("vel") is not None
+            self.status.update(progress=float(update["progress"]), eta=float(update["eta"]), dropped=int(update["dropped"] or 0))
+            self.broadcast(encodeSpectrum(update, final))
+
+    def broadcast(self, frame: bytes) -> None:
+        '''
+        Queue a frame for every client. Clients that have not sent the previous frames yet skip the oldest
+        '''
+        self.latest = frame
+        for frames in self.clients:
+            if frames.full():
+                frames.get_nowait()
+            frames.put_nowait(frame)
+
+    # ------------------------------ Commands ------------------------------ #
+
+    def command(self, name: str, body: dict) -> tuple:
+        '''
+        Run a command. Returns tuple of HTTP status and JSON serializable answer
+        '''
+        if name == "start":
+            return self.start(body.get("config", {}))
+        if name == "stop":
+            return self.stop()
+        if name == "retune":
+            return self.retune(body.get("frequency"))
+        if name == "status":
+            return 200, self.getStatus()
+        return 404, {"error": f"Unknown command {name}"}
+
+    def start(self, overrides: dict = None) -> tuple:
+        if self.status["running"]:
+            return 409, {"error": "An observation is already running"}
+        error = self.applyConfig(overrides or {})
+        if error is not None:
+            return 400, {"error": error}
+
+        self.stop_event.clear()
+        self.commands.put("run")
+        self.status.update(running=True, progress=0.0, eta=0.0, dropped=0)
+        return 200, self.getStatus()
+
+    def stop(self) -> tuple:
+        if not self.status["running"]:
+            return 409, {"error": "No observation is running"}
+        self.restart = False
+        self.stop_event.set()
+        return 200, self.getStatus()
+
+    def retune(self, frequency) -> tuple:
+        if not isinstance(frequency, (int, float)) or isinstance(frequency, bool) or frequency <= 0:
+            return 400, {"error": "Please give the frequency in Hz as a positive number"}
+        error = self.applyConfig({"SDR": {"frequency": int(frequency)}})
+        if error is not None:
+            return 400, {"error": error}
+
+        # The worker keeps the SDR open, so the next observation only retunes it
+        if self.status["running"]:
+            self.restart = True
+            self.stop_event.set()
+        return 200, self.getStatus()
+
+    def getStatus(self) -> dict:
+        config = configparser.ConfigParser(comment_prefixes='#', allow_no_value=True)
+        config.read("config.ini")
+        return dict(self.status, frequency=config.getint("SDR", "frequency", fallback=0), clients=len(self.clients))
+
+    def applyConfig(self, overrides: dict) -> "str | None":
+        '''
+        Write {section: {key: value}} to config.ini. Returns an error message if a section or key does not exist,
+        or a value does not parse as the type in CONFIG_TYPES, in which case nothing is written
+        '''
+        if not isinstance(overrides, dict) or not all(isinstance(keys, dict) for keys in overrides.values()):
+            return "Config must be given as {section: {key: value}}"
+        if not overrides:
+            return None
+
+        config = configparser.ConfigParser(comment_prefixes='#', allow_no_value=True)
+        if not config.read("config.ini"):
+            return "Could not load config.ini"
+        for section, keys in overrides.items():
+            for key, value in keys.items():
+                value_type = CONFIG_TYPES.get(section, {}).get(key)
+                if value_type is None or not config.has_section(section):
+                    return f"Unknown config key {key} in section {section}"
+                value = str(value).strip()
+                if not parsesAs(value, value_type):
+                    return f"Config key {key} in section {section} must be of type {value_type}, not {value!r}"
+                if key == "restfreqs":
+                    from spectral_line import parseRestFrequencies
+                    if parseRestFrequencies(value) is None:
+                        return f"Config key {key} in section {section} must be a comma separated list of frequencies in MHz, not {value!r}"
+                config.set(section, key, value)
+        with open("config.ini", "w") as configfile:
+            config.write(configfile)
+        return None
+
+    # ------------------------------- Clients ------------------------------ #
+
+    async def handleConnection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        '''
+        Answer one HTTP request, or stream to a WebSocket client until it disconnects
+        '''
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+            lines = head.decode("latin-1").split("\r\n")
+            method, path, _ = lines[0].split(" ", 2)
+            headers = {key.strip().lower(): value.strip() for key, value in (line.split(":", 1) for line in lines[1:] if ":" in line)}
+            length = int(headers.get("content-length", 0))
+            if length > MAX_REQUEST_SIZE:
+                await self.respond(writer, 413, {"error": "Request too large"})
+                return
+            body = await reader.readexactly(length) if length > 0 else b""
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError, ConnectionError):
+            writer.close()
+            return
+
+        path = path.split("?", 1)[0]
+        try:
+            if path == "/ws" and headers.get("upgrade", "").lower() == "websocket":
+                await self.streamWebsocket(reader, writer, headers)
+            elif method == "GET" and path == "/status":
+                await self.respond(writer, 200, self.getStatus())
+            elif method == "GET" and path == "/spectrum":
+                await self.respond(writer, 200 if self.latest is not None else 204, self.latest or b"")
+            elif method == "POST" and path in ("/start", "/stop", "/retune"):
+                try:
+                    request = json.loads(body or b"{}")
+                except ValueError:
+                    request = None
+                if not isinstance(request, dict):
+                    await self.respond(writer, 400, {"error": "Body must be a JSON object"})
+                else:
+                    await self.respond(writer, *self.command(path[1:], request))
+            else:
+                await self.respond(writer, 404, {"error": f"No endpoint {method} {path}"})
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, writer: asyncio.StreamWriter, status: int, payload) -> None:
+        '''
+        Send an HTTP response with a JSON (dict) or binary (bytes) payload, and close the connection
+        '''
+        if isinstance(payload, dict):
+            content, content_type = json.dumps(payload).encode(), "application/json"
+        else:
+            content, content_type = payload, "application/octet-stream"
+        writer.write((f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}\r\nContent-Type: {content_type}\r\n"
+                      f"Content-Length: {len(content)}\r\nConnection: close\r\n\r\n").encode() + content)
+        await writer.drain()
+
+    async def streamWebsocket(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, headers: dict) -> None:
+        '''
+        Complete the WebSocket handshake, then send every spectrum frame and answer commands until the client closes
+        '''
+        key = headers.get("sec-websocket-key")
+        if key is None:
+            await self.respond(writer, 400, {"error": "Missing Sec-WebSocket-Key"})
+            return
+        writer.write(("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                      f"Sec-WebSocket-Accept: {websocketAccept(key)}\r\n\r\n").encode())
+
+        frames = asyncio.Queue(maxsize=CLIENT_QUEUE_SIZE)
+        if self.latest is not None:
+            frames.put_nowait(self.latest)
+        self.clients.add(frames)
+        sender = asyncio.create_task(self.sendFrames(writer, frames))
+        try:
+            while True:
+                opcode, payload = await readWebsocketFrame(reader)
+                if opcode == WS_CLOSE:
+                    writer.write(websocketFrame(payload[:2], WS_CLOSE))
+                    break
+                if opcode == WS_PING:
+                    writer.write(websocketFrame(payload, WS_PONG))
+                elif opcode == WS_TEXT:
+                    try:
+                        request = json.loads(payload)
+                        status, answer = self.command(str(request.get("command")), request)
+                    except (ValueError, AttributeError):
+                        status, answer = 400, {"error": "Messages must be JSON objects with a command"}
+                    writer.write(websocketFrame(json.dumps(dict(answer, code=status)).encode(), WS_TEXT))
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            self.clients.discard(frames)
+            sender.cancel()
+
+    async def sendFrames(self, writer: asyncio.StreamWriter, frames: asyncio.Queue) -> None:
+        try:
+            while True:
+                frame = await frames.get()
+                writer.write(websocketFrame(frame))
+                await writer.drain()
+        except ConnectionError:
+            pass
+
+    async def serve(self) -> None:
+        '''
+        Start the worker and serve until cancelled
+        '''
+        self.startWorker()
+        server = await asyncio.start_server(self.handleConnection, self.host, self.port, limit=MAX_REQUEST_SIZE)
+        pump = asyncio.create_task(self.pumpUpdates())
+        print(f"Serving on http://{self.host}:{self.port} (WebSocket stream at /ws)")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            pump.cancel()
+            self.stopWorker()
+
+
+def runServer(host: str = SERVER_HOST, port: int = SERVER_PORT) -> None:
+    '''
+    Run the control and streaming server until interrupted
+    '''
+    try:
+        asyncio.run(ObservationServer(host, port).serve())
+    except KeyboardInterrupt:
+        print("Server stopped")
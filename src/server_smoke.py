@@ -0,0 +1,114 @@
+'''
+Smoke check of the control and streaming server against the simulated SDR.
+
+The server is started in a temporary directory with a copy of config.ini, a
+spectral line observation with the driver "sim" is started over the WebSocket,
+and the first spectrum frame is decoded. Needs no SDR hardware and no Soapy
+bindings.
+'''
+import os
+import sys
+import json
+import shutil
+import socket
+import asyncio
+import tempfile
+
+from server import ObservationServer, decodeSpectrum, readWebsocketFrame, websocketFrame, WS_TEXT, WS_BINARY
+
+# Seconds to wait for the first spectrum, including the start of the worker
+SMOKE_TIMEOUT = 120
+
+# Short observation with the simulated device, saving nothing
+SMOKE_CONFIG = {
+    "SDR": {"driver": "sim", "sample_rate": 2400000, "bins": 1024, "stream_format": "cf32"},
+    "Spectral line": {"fft_num": 2000, "save_data": False, "zoom_decimation": 1, "adaptive": False, "bandpass_cal": False}
+}
+
+
+def freePort(host: str) -> int:
+    '''
+    Return a port that is free on host
+    '''
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+async def readFirstSpectrum(host: str, port: int) -> dict:
+    '''
+    Connect to the WebSocket stream, start an observation and return the first spectrum frame decoded
+    '''
+    # The server starts listening once its worker is started
+    for _ in range(100):
+        try:
+            reader, writer = await asyncio.open_connection(host, port)
+            break
+        except ConnectionError:
+            await asyncio.sleep(0.1)
+    else:
+        raise ConnectionError(f"Server did not start listening on {host}:{port}")
+
+    writer.write((f"GET /ws HTTP/1.1\r\nHost: {host}:{port}\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                  "Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\nSec-WebSocket-Version: 13\r\n\r\n").encode())
+    head = await reader.readuntil(b"\r\n\r\n")
+    if not head.startswith(b"HTTP/1.1 101"):
+        raise ConnectionError(f"WebSocket handshake failed: {head.decode(errors='replace').splitlines()[0]}")
+
+    writer.write(websocketFrame(json.dumps({"command": "start", "config": SMOKE_CONFIG}).encode(), WS_TEXT))
+    try:
+        while True:
+            opcode, payload = await readWebsocketFrame(reader)
+            if opcode == WS_TEXT:
+                answer = json.loads(payload)
+                if answer.get("code") != 200:
+                    raise RuntimeError(f"Observation did not start: {answer.get('error')}")
+            elif opcode == WS_BINARY:
+                return decodeSpectrum(payload)
+    finally:
+        writer.close()
+
+
+async def runSmokeCheck(host: str, port: int) -> dict:
+    server = ObservationServer(host, port)
+    serving = asyncio.create_task(server.serve())
+    try:
+        return await asyncio.wait_for(readFirstSpectrum(host, port), SMOKE_TIMEOUT)
+    finally:
+        # Cancelling the server stops the worker
+        serving.cancel()
+        await asyncio.gather(serving, return_exceptions=True)
+
+
+def checkServerSmoke(host: str = "127.0.0.1") -> bool:
+    '''
+    Start the server on the simulated SDR and read one spectrum frame from /ws
+
+    Returns True if a frame with the configured number of channels arrived
+    '''
+    # The worker is spawned in the temporary directory, so it has to find the source by its absolute path
+    src = os.path.dirname(os.path.abspath(__file__))
+    if src not in sys.path:
+        sys.path.insert(0, src)
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        shutil.copyfile("config.ini", os.path.join(tmp_dir, "config.ini"))
+        os.chdir(tmp_dir)
+        try:
+            spectrum = asyncio.run(runSmokeCheck(host, freePort(host)))
+        except asyncio.TimeoutError:
+            print(f"Server smoke check failed: no spectrum within {SMOKE_TIMEOUT} s")
+            return False
+        except Exception as error:
+            print(f"Server smoke check failed: {error}")
+            return False
+        finally:
+            os.chdir(cwd)
+
+    channels = SMOKE_CONFIG["SDR"]["bins"]
+    if spectrum["data"].size != channels:
+        print(f"Server smoke check failed: spectrum of {spectrum['data'].size} channels instead of {channels}")
+        return False
+    print(f"Server smoke check passed: spectrum of {spectrum['data'].size} channels at {round(spectrum['progress']*100, 1)} % progress")
+    return True
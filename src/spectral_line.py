@@ -1,16 +1,25 @@
 import os
+import time
+import queue
 import shutil
 from datetime import datetime
-import pandas as pd
 import numpy as np
 
 import ui.config_callbacks as CB
 from core.ground_station import Antenna, GroundStation
-from core.soapy import SDR
+from core.soapy import SDR, SDRError, SDRStreamError
+from core.session import getSession
 import core.dsp as DSP
+from core.rfi import SpectralKurtosis
+from core.doppler import DopplerTracker
+from core.bandpass import bandpassKey, loadBandpass, saveBandpass
+from core.adaptive import AdaptiveIntegration
 from core.observation import Observation
 
-def runObservation():
+# Maximum rate of live spectrum updates sent to the UI
+LIVE_UPDATE_RATE = 20
+
+def runObservation(live_queue = None, stop = None):
     # Load config
     config = CB.loadConfig()
     print("Running observation...")
@@ -43,18 +52,75 @@ def runObservation():
     n_bins = config.getint("SDR", "bins")
     center_freq = config.getint("SDR", "frequency")
     
+    dropout_repair = config.get("SDR", "dropout_repair", fallback="interpolate")
+    stream_format = config.get("SDR", "stream_format", fallback="cf32")
+    
     fft_num = config.getint("Spectral line", "fft_num")
     smoothing = config.getint("Spectral line", "smoothing")
+    smoothing_method = config.get("Spectral line", "smoothing_method", fallback="boxcar")
+    rfi_flagging = config.getboolean("Spectral line", "rfi_flagging", fallback=False)
+    rfi_subint = config.getint("Spectral line", "rfi_subint", fallback=64)
+    rfi_threshold = config.getfloat("Spectral line", "rfi_threshold", fallback=4.0)
+    doppler_tracking = config.getboolean("Spectral line", "doppler_tracking", fallback=False)
+    doppler_interval = config.getfloat("Spectral line", "doppler_interval", fallback=60.0)
+    zoom_decimation = config.getint("Spectral line", "zoom_decimation", fallback=1)
+    zoom_freq = config.getfloat("Spectral line", "zoom_freq", fallback=0.0)*10**6
+    line_freqs = parseRestFrequencies(config.get("Spectral line", "restfreqs", fallback=""))
+    if line_freqs is None:
+        return
+    line_window = config.getfloat("Spectral line", "line_window", fallback=250.0)
+    bandpass_cal = config.getboolean("Spectral line", "bandpass_cal", fallback=False)
+    adaptive_integration = config.getboolean("Spectral line", "adaptive", fallback=False)
+    target_rms = config.getfloat("Spectral line", "target_rms", fallback=0.0)
+    rms_unit = config.get("Spectral line", "rms_unit", fallback="dB")
+    tsys = config.getfloat("Spectral line", "tsys", fallback=0.0)
+    target_snr = config.getfloat("Spectral line", "target_snr", fallback=0.0)
     restfreq = center_freq if config.getfloat("Spectral line", "restfreq") == 0.0 else config.getfloat("Spectral line", "restfreq")*10**6
 
     # Determine tuning frequency
     sdr_freq = center_freq - LO_freq
-    sdr = SDR(driver = driver, freq = sdr_freq, sample_rate = sample_rate, ppm_offset = PPM_offset, bins = n_bins)
+    # Zoom in on a window around zoom_freq (or the rest frequency), reading decimation times more samples per spectrum
+    zoom = None
+    read_bins = n_bins
+    if zoom_decimation > 1:
+        zoom_offset = (restfreq if zoom_freq == 0.0 else zoom_freq) - center_freq
+        zoom = DSP.ZoomFFT(sample_rate = sample_rate, offset = zoom_offset, decimation = zoom_decimation, n_bins = n_bins)
+        if not zoom.isInBand():
+            print(f"Zoom window at {round(zoom_offset/10**6, 4)} MHz from the center frequency is outside the sampled band... "
+                  f"Please zoom within {round((sample_rate - sample_rate/zoom_decimation)/2/10**6, 4)} MHz of the center frequency")
+            return
+        read_bins = n_bins*zoom_decimation
+    dropouts = DSP.DropoutRepair(n_samples = read_bins, mode = dropout_repair, min_run = DSP.minDropoutRun(stream_format))
+    doppler = DopplerTracker(n_bins = n_bins, ground_station = gs, antenna = antenna, rest_freq = restfreq, interval = doppler_interval) if doppler_tracking else None
+    rfi = SpectralKurtosis(n_bins = n_bins, sub_length = rfi_subint, threshold = rfi_threshold, doppler = doppler) if rfi_flagging else None
+    try:
+        # The device stays open between observations, and is only retuned
+        sdr = getSession(driver).configure(freq = sdr_freq, sample_rate = sample_rate, ppm_offset = PPM_offset, bins = read_bins,
+                                           stream_format = stream_format)
+
+        bandpass = None
+        if bandpass_cal:
+            key = bandpassKey(driver = driver, serial = sdr.getSerial(), sample_rate = sample_rate, bins = n_bins, gain = sdr.getGain(), zoom = zoom)
+            bandpass = loadBandpass(key)
+            if bandpass is None:
+                print(f"No bandpass measured for {key}... Please measure one with radiopy.py -b first. Continuing without")
+
+        # With adaptive integration fft_num is the longest integration. The line SNR is measured within line_window of restfreq
+        adaptive = None
+        if adaptive_integration:
+            line_range = (gs.velToFreq(rest_freq = restfreq, radial_vel = -line_window), gs.velToFreq(rest_freq = restfreq, radial_vel = line_window))
+            adaptive = AdaptiveIntegration(n_bins = n_bins, target_rms = target_rms, rms_unit = rms_unit, tsys = tsys, target_snr = target_snr,
+                                           line_range = line_range, bandpass = bandpass)
+
+        # Collect data
+        obs_freqs, data = collectData(sdr = sdr, fft_num = fft_num, n_bins = n_bins, live_queue = live_queue, dropouts = dropouts, rfi = rfi, doppler = doppler,
+                                      zoom = zoom, bandpass = bandpass, adaptive = adaptive, stop = stop)
+    except SDRError as error:
+        print(f"Observation failed: {error}")
+        return
 
-    # Collect data
-    obs_freqs, data = collectData(sdr = sdr, fft_num = fft_num, n_bins = n_bins)
     if smoothing > 0:
-        data = DSP.applySmoothing(bins = data, num = smoothing)
+        data = DSP.applySmoothing(bins = data, num = smoothing, method = smoothing_method)
 
     background_cal = config.getboolean("Spectral line", "background_cal")
     if background_cal:
@@ -65,10 +131,17 @@ def runObservation():
     eq_coords = antenna.getEquatorialCoordinates(gs)
     gal_coords = antenna.getGalacticCoordinates(gs)
 
-    # Calculate radial velocities and correct for LSR if desired
-    lsr_correction = gs.getLSRCorrection(ra = eq_coords[0], dec = eq_coords[1])
+    # Calculate radial velocities and correct for LSR if desired. Doppler tracked data is on the grid of the mean correction
+    if doppler is not None:
+        lsr_correction = doppler.reference_correction
+    else:
+        lsr_correction = gs.getLSRCorrection(ra = eq_coords[0], dec = eq_coords[1])
     radial_velocities = np.subtract([gs.freqToVel(rest_freq = restfreq, freq = freq) for freq in obs_freqs], lsr_correction)
 
+    # Send final spectrum with velocity axis to live view
+    if live_queue is not None:
+        live_queue.put({"freqs": obs_freqs, "data": data, "vel": radial_velocities, "sub": None, "progress": 1.0, "eta": 0.0, "dropped": dropouts.stats.dropped_samples})
+
     # Save data
     y_limits = (config.getfloat("Spectral line", "y_min"), config.getfloat("Spectral line", "y_max"))
     out_dir = "Observations/" if config.get("Spectral line", "output_dir") == "" else config.get("Spectral line", "output_dir")
@@ -77,46 +150,258 @@ def runObservation():
     # TODO - maybe remove option of disabling saving data
     if config.getboolean("Spectral line", "save_data"):
         obs_name = f"{center_freq}_{formatted_time}"
+        archive = {
+            "archive": config.getboolean("Spectral line", "archive", fallback=False),
+            "precision": config.getfloat("Spectral line", "archive_precision", fallback=0.001),
+            "codec": config.get("Spectral line", "archive_codec", fallback="zlib")
+        }
 
         # Create observation
         obs = Observation(dir = out_dir+obs_name+"/")
-        obs.writeInfo(ground_station=gs, antenna=antenna, sdr=sdr)
-        obs.writeData(frequency=obs_freqs, radial_velocity=radial_velocities, data=data)
+        obs.writeInfo(ground_station=gs, antenna=antenna, sdr=sdr, dropouts=dropouts.stats, lsr_correction=lsr_correction)
+        obs.writeData(frequency=obs_freqs, radial_velocity=radial_velocities, data=data, **archive)
+        if rfi is not None:
+            obs.writeFlags(flags=rfi.getFlags())
         obs.plotData(plot_limits = y_limits)
 
         # Copy config to observation folder
         shutil.copyfile("config.ini", out_dir+obs_name+"/"+"observation_config.ini")
 
+        # Every line in the band is saved as an observation of its own, cut from the same spectrum
+        for line_freq in line_freqs:
+            line = extractLine(gs = gs, freqs = obs_freqs, data = data, rest_freq = line_freq, lsr_correction = lsr_correction, window = line_window)
+            if line is None:
+                print(f"Line at {line_freq/10**6} MHz is outside the observed band... skipping")
+                continue
+            line_freqs_obs, line_velocities, line_data, mask = line
+
+            line_name = f"{obs_name}_line_{int(line_freq)}"
+            line_obs = Observation(dir = out_dir+line_name+"/")
+            line_obs.writeInfo(ground_station=gs, antenna=antenna, sdr=sdr, dropouts=dropouts.stats, lsr_correction=lsr_correction)
+            line_obs.writeData(frequency=line_freqs_obs, radial_velocity=line_velocities, data=line_data, **archive)
+            if rfi is not None:
+                line_obs.writeFlags(flags=rfi.getFlags()[:, mask])
+            line_obs.plotData(plot_limits = y_limits)
+            shutil.copyfile("config.ini", out_dir+line_name+"/"+"observation_config.ini")
+
+
+def measureBandpass(n_ffts: int) -> None:
+    '''
+    Measure the bandpass of the SDR in the config from an average of n_ffts spectra, and cache it
+
+    The antenna should point at a region without line emission, or be replaced by a terminator, as everything
+    in the spectrum is taken as part of the bandpass. RFI is left out if RFI flagging is enabled
+    '''
+    config = CB.loadConfig()
+    if config.get("SDR", "driver") == "none" or config.getint("SDR", "sample_rate") == 0:
+        print("Please select a driver and sample rate first!")
+        return
+
+    driver = config.get("SDR", "driver")
+    sample_rate = config.getint("SDR", "sample_rate")
+    PPM_offset = config.getint("SDR", "ppm_offset")
+    n_bins = config.getint("SDR", "bins")
+    center_freq = config.getint("SDR", "frequency")
+    LO_freq = config.getfloat("Ground station", "lo_freq")
+    dropout_repair = config.get("SDR", "dropout_repair", fallback="interpolate")
+    stream_format = config.get("SDR", "stream_format", fallback="cf32")
+    rfi_flagging = config.getboolean("Spectral line", "rfi_flagging", fallback=False)
+    rfi_subint = config.getint("Spectral line", "rfi_subint", fallback=64)
+    rfi_threshold = config.getfloat("Spectral line", "rfi_threshold", fallback=4.0)
+    zoom_decimation = config.getint("Spectral line", "zoom_decimation", fallback=1)
+    zoom_freq = config.getfloat("Spectral line", "zoom_freq", fallback=0.0)*10**6
+    restfreq = center_freq if config.getfloat("Spectral line", "restfreq") == 0.0 else config.getfloat("Spectral line", "restfreq")*10**6
+
+    zoom = None
+    read_bins = n_bins
+    if zoom_decimation > 1:
+        zoom_offset = (restfreq if zoom_freq == 0.0 else zoom_freq) - center_freq
+        zoom = DSP.ZoomFFT(sample_rate = sample_rate, offset = zoom_offset, decimation = zoom_decimation, n_bins = n_bins)
+        if not zoom.isInBand():
+            print(f"Zoom window at {round(zoom_offset/10**6, 4)} MHz from the center frequency is outside the sampled band... "
+                  f"Please zoom within {round((sample_rate - sample_rate/zoom_decimation)/2/10**6, 4)} MHz of the center frequency")
+            return
+        read_bins = n_bins*zoom_decimation
+    dropouts = DSP.DropoutRepair(n_samples = read_bins, mode = dropout_repair, min_run = DSP.minDropoutRun(stream_format))
+    rfi = SpectralKurtosis(n_bins = n_bins, sub_length = rfi_subint, threshold = rfi_threshold) if rfi_flagging else None
 
-def collectData(sdr: SDR, fft_num: int, n_bins: int) -> tuple:
+    print(f"Measuring bandpass from {n_ffts} FFTs ({round(n_ffts*read_bins/sample_rate, 1)} s)...")
+    try:
+        sdr = getSession(driver).configure(freq = center_freq - LO_freq, sample_rate = sample_rate, ppm_offset = PPM_offset, bins = read_bins,
+                                           stream_format = stream_format)
+        _, spectrum = collectData(sdr = sdr, fft_num = n_ffts, n_bins = n_bins, dropouts = dropouts, rfi = rfi, zoom = zoom, log_scale = False)
+    except SDRError as error:
+        print(f"Bandpass measurement failed: {error}")
+        return
+
+    key = bandpassKey(driver = driver, serial = sdr.getSerial(), sample_rate = sample_rate, bins = n_bins, gain = sdr.getGain(), zoom = zoom)
+    bandpass = saveBandpass(key, spectrum, n_ffts)
+    print(f"Saved bandpass for {key} (peak to peak {round(10*np.log10(bandpass.max()/bandpass.min()), 2)} dB)")
+
+
+def parseRestFrequencies(value: str) -> list:
+    '''
+    Parse a comma separated list of rest frequencies in MHz, returned in Hz. Empty entries are skipped
+
+    Returns None if an entry is not a positive number
+    '''
+    freqs = []
+    for entry in value.split(","):
+        entry = entry.strip()
+        if entry == "":
+            continue
+        try:
+            freq = float(entry)
+        except ValueError:
+            freq = 0.0
+        if not (np.isfinite(freq) and freq > 0):
+            print(f"Invalid rest frequency {entry!r} in restfreqs... Please give a comma separated list of frequencies in MHz")
+            return None
+        freqs.append(freq*10**6)
+    return freqs
+
+
+def extractLine(gs: GroundStation, freqs: np.ndarray, data: np.ndarray, rest_freq: float, lsr_correction: float, window: float) -> tuple:
+    '''
+    Cut the channels within window km/s of a line at rest_freq from a spectrum
+
+    Returns tuple of the frequencies, LSR radial velocities with respect to rest_freq, data and the channel mask,
+    or None if no channel of the spectrum is within the window
+    '''
+    velocities = gs.freqToVel(rest_freq = rest_freq, freq = freqs) - lsr_correction
+    mask = np.abs(velocities) <= window
+    if not np.any(mask):
+        return None
+    return freqs[mask], velocities[mask], data[mask], mask
+
+
+def collectData(sdr: SDR, fft_num: int, n_bins: int, live_queue = None, dropouts: DSP.DropoutRepair = None, rfi: SpectralKurtosis = None,
+                doppler: DopplerTracker = None, zoom: DSP.ZoomFFT = None, bandpass: np.ndarray = None, adaptive: AdaptiveIntegration = None,
+                log_scale: bool = True, stop = None) -> tuple:
     '''
-    Collects and processes data from a given sdr (instance of SDR)
+    Collects and processes data from a given sdr (instance of SDR or SDRSession)
     Returns tuple of two arrays:
 
     freqs   - ndarray with frequency values
 
     data    - ndarray with collected data
+
+    Dropped samples are repaired by dropouts (instance of DropoutRepair) before the FFT, and blocks
+    where all samples were dropped are left out of the average.
+    If rfi (instance of SpectralKurtosis) is given, contaminated channels of each sub-integration are left out of the average.
+    If doppler (instance of DopplerTracker) is given, the spectra are shifted onto a fixed LSR velocity grid before averaging,
+    and rfi has to be created with the same tracker.
+    If zoom (instance of ZoomFFT) is given, every read is downconverted and decimated into one spectrum of n_bins
+    channels over the zoom window, so the sdr has to read n_bins*zoom.decimation samples.
+    If a bandpass (normalized linear power per channel) is given, it is divided out of the spectrum.
+    If adaptive (instance of AdaptiveIntegration) is given, the integration stops as soon as its targets are reached,
+    and fft_num is the longest integration.
+    The spectrum is returned in dB, or as linear power if log_scale is False
+    If a live_queue is given, the running average and the average of the spectra since the previous update (for the waterfall)
+    are sent to it at most LIVE_UPDATE_RATE times per second
+    If stop (a threading or multiprocessing Event) is set, the integration ends early with the spectra integrated so far
+    Raises SDRError if reading from the SDR fails
     '''
+    dropouts = DSP.DropoutRepair(n_samples = n_bins*(zoom.decimation if zoom is not None else 1)) if dropouts is None else dropouts
+
     # Generate list with frequencies
-    freqs = np.linspace(sdr.getFrequency()-sdr.getSampleRate()/2, sdr.getFrequency()+sdr.getSampleRate()/2, n_bins)
-    data = np.zeros(n_bins, dtype = np.float16)
+    if zoom is None:
+        freqs = np.linspace(sdr.getFrequency()-sdr.getSampleRate()/2, sdr.getFrequency()+sdr.getSampleRate()/2, n_bins)
+    else:
+        freqs = zoom.getFrequencies(sdr.getFrequency())
+    if adaptive is not None:
+        adaptive.setFrequencies(freqs, dc_freq = sdr.getFrequency())
+    data = np.zeros(n_bins, dtype = np.float64)
+    n_integrated = 0
+    # Sum and number of the spectra since the previous live update, for the waterfall
+    sub_sum = np.zeros(n_bins, dtype = np.float64)
+    sub_n = 0
+    start_time = last_update = time.perf_counter()
     sdr.startStream()
     try:
         for i in range(fft_num):
-            data = data+DSP.doFFT(bins = sdr.readFromStream(), n_bins = n_bins)
-            
-        data = 10*np.log10(data/fft_num)
-    except:
-        print("Issue when reading bins... Please try again")
-        quit()
-    
-    sdr.stopStream()
+            samples = sdr.readFromStream()
+            if not dropouts(samples):
+                continue
+            psd = DSP.doFFT(bins = samples, n_bins = n_bins) if zoom is None else zoom.process(samples)[0]
+            if rfi is None:
+                data += psd
+                if doppler is not None:
+                    doppler.add(psd)
+            else:
+                rfi.add(psd)
+            n_integrated += 1
+            if live_queue is not None:
+                sub_sum += psd
+                sub_n += 1
+
+            # Targets are only checked when a batch of running statistics is complete
+            if adaptive is not None and adaptive.add(psd) and adaptive.done():
+                break
+            if stop is not None and stop.is_set():
+                print(f"Integration stopped after {n_integrated} FFTs")
+                break
+
+            now = time.perf_counter()
+            if live_queue is not None and now - last_update > 1/LIVE_UPDATE_RATE:
+                last_update = now
+                running = data/n_integrated if rfi is None else rfi.getRunningAverage()
+                running = running if bandpass is None else running/bandpass
+                total = fft_num if adaptive is None else adaptive.estimateTotal(fft_num)
+                sub = None if sub_n == 0 else sub_sum/sub_n if bandpass is None else sub_sum/sub_n/bandpass
+                # Spectra of updates the UI had no room for are kept, so the next row covers them
+                if sendLiveUpdate(live_queue, freqs, running, i+1, total, now-start_time, dropouts.stats.dropped_samples, sub):
+                    sub_sum[:] = 0
+                    sub_n = 0
+    finally:
+        sdr.stopStream()
+
+    if adaptive is not None:
+        print(f"Integrated {n_integrated} FFTs ({'target reached' if adaptive.done() else 'target not reached'})")
+        print(f"Noise {round(adaptive.getRMS(), 4)} {adaptive.rms_unit}, relative rms {round(adaptive.getRelativeNoise(), 5)} "
+              f"(radiometer equation {round(adaptive.getExpectedNoise(), 5)}), line SNR {round(adaptive.getSNR(), 1)}")
 
-    # Replace bad samples lost from sample drops etc.
-    idx = np.where(data==-np.inf)
-    if np.size(idx) > 0:
-        data[idx] = np.interp(freqs[idx], freqs, data)
-        print("Bad samples replaced at:")
-        print(idx[0])
+    if n_integrated == 0:
+        raise SDRStreamError("Every sample was dropped... Please check the connection to the SDR and try again")
+    if rfi is None:
+        data = data/n_integrated
+    else:
+        # Also flushes the last sub-integration to doppler
+        data = rfi.getSpectrum()
+        print(f"RFI flagged {round(100*rfi.getFlags().mean(), 2)}% of the data")
+    if doppler is not None:
+        data = doppler.getSpectrum(freqs, bandpass = bandpass)
+        print(f"LSR velocity changed by {round(doppler.getMaxShift(), 4)} km/s over the integration")
+    elif bandpass is not None:
+        data = data/bandpass
+    if log_scale:
+        data = 10*np.log10(data)
+
+    if dropouts.stats.dropped_samples > 0:
+        print(f"Repaired {dropouts.stats.dropped_samples} dropped samples in {dropouts.stats.runs} runs (longest {dropouts.stats.longest_run})")
+        print(f"Skipped {dropouts.stats.empty_blocks} blocks with only dropped samples")
 
     return freqs, data
+
+
+def sendLiveUpdate(live_queue, freqs: np.ndarray, data: np.ndarray, done: int, total: int, elapsed: float, dropped: int, sub: np.ndarray = None) -> bool:
+    '''
+    Send running average spectrum, newest sub-integration (both in dB), progress, ETA and dropped samples to a live view
+
+    Updates are skipped rather than waited for if the UI has not yet consumed the previous ones
+    Returns True if the update was queued
+    '''
+    update = {
+        "freqs": freqs,
+        "data": 10*np.log10(data),
+        "sub": None if sub is None else 10*np.log10(np.maximum(sub, np.finfo(np.float64).tiny)),
+        "vel": None,
+        "progress": min(done/total, 1.0),
+        "eta": max(elapsed/done*(total-done), 0.0),
+        "dropped": dropped
+    }
+    try:
+        live_queue.put_nowait(update)
+    except queue.Full:
+        return False
+    return True
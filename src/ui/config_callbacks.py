@@ -1,5 +1,7 @@
 import configparser
-import dearpygui.dearpygui as dpg
+
+# NOTE - DearPyGui is imported in the functions using it, so observations run
+# without the UI can load the config without importing the UI toolkit
 
 
 # Default parameters
@@ -19,14 +21,35 @@ DEFAULT_PARAM = {
     "ppm_offset": 0,
     "bins": 1024,
     "frequency": 1420405752,
+    "dropout_repair": "interpolate",
+    "stream_format": "cf32",
     "fft_num": 1000,
     "smoothing": 0,
+    "smoothing_method": "boxcar",
     "restfreq": 0.0,
     "y_min": 0.0,
     "y_max": 0.0,
     "save_data": True,
     "output_dir": "Observations/",
     "background_cal": False,
+    "rfi_flagging": False,
+    "rfi_subint": 64,
+    "rfi_threshold": 4.0,
+    "doppler_tracking": False,
+    "doppler_interval": 60.0,
+    "zoom_decimation": 1,
+    "zoom_freq": 0.0,
+    "restfreqs": "",
+    "line_window": 250.0,
+    "bandpass_cal": False,
+    "adaptive": False,
+    "target_rms": 0.0,
+    "rms_unit": "dB",
+    "tsys": 0.0,
+    "target_snr": 0.0,
+    "archive": False,
+    "archive_precision": 0.001,
+    "archive_codec": "zlib",
 }
 
 
@@ -53,6 +76,7 @@ def applyDefaultParameters():
     '''
     Applies default settings to all parameters
     '''
+    import dearpygui.dearpygui as dpg
     print("Applying default parameters...")
 
     dpg.set_value("lat", DEFAULT_PARAM["lat"])
@@ -71,21 +95,43 @@ def applyDefaultParameters():
     dpg.set_value("ppm_offset", DEFAULT_PARAM["ppm_offset"])
     dpg.set_value("bins", DEFAULT_PARAM["bins"])
     dpg.set_value("frequency", DEFAULT_PARAM["frequency"])
+    dpg.set_value("dropout_repair", DEFAULT_PARAM["dropout_repair"])
+    dpg.set_value("stream_format", DEFAULT_PARAM["stream_format"])
 
     dpg.set_value("fft_num", DEFAULT_PARAM["fft_num"])
     dpg.set_value("smoothing", DEFAULT_PARAM["smoothing"])
+    dpg.set_value("smoothing_method", DEFAULT_PARAM["smoothing_method"])
     dpg.set_value("restfreq", DEFAULT_PARAM["restfreq"])
     dpg.set_value("y_min", DEFAULT_PARAM["y_min"])
     dpg.set_value("y_max", DEFAULT_PARAM["y_max"])
     dpg.set_value("save_data", DEFAULT_PARAM["save_data"])
     dpg.set_value("output_dir", DEFAULT_PARAM["output_dir"])
     dpg.set_value("calibrate_background", DEFAULT_PARAM["background_cal"])
+    dpg.set_value("rfi_flagging", DEFAULT_PARAM["rfi_flagging"])
+    dpg.set_value("rfi_subint", DEFAULT_PARAM["rfi_subint"])
+    dpg.set_value("rfi_threshold", DEFAULT_PARAM["rfi_threshold"])
+    dpg.set_value("doppler_tracking", DEFAULT_PARAM["doppler_tracking"])
+    dpg.set_value("doppler_interval", DEFAULT_PARAM["doppler_interval"])
+    dpg.set_value("zoom_decimation", DEFAULT_PARAM["zoom_decimation"])
+    dpg.set_value("zoom_freq", DEFAULT_PARAM["zoom_freq"])
+    dpg.set_value("restfreqs", DEFAULT_PARAM["restfreqs"])
+    dpg.set_value("line_window", DEFAULT_PARAM["line_window"])
+    dpg.set_value("bandpass_cal", DEFAULT_PARAM["bandpass_cal"])
+    dpg.set_value("adaptive", DEFAULT_PARAM["adaptive"])
+    dpg.set_value("target_rms", DEFAULT_PARAM["target_rms"])
+    dpg.set_value("rms_unit", DEFAULT_PARAM["rms_unit"])
+    dpg.set_value("tsys", DEFAULT_PARAM["tsys"])
+    dpg.set_value("target_snr", DEFAULT_PARAM["target_snr"])
+    dpg.set_value("archive", DEFAULT_PARAM["archive"])
+    dpg.set_value("archive_precision", DEFAULT_PARAM["archive_precision"])
+    dpg.set_value("archive_codec", DEFAULT_PARAM["archive_codec"])
 
 
 def updateParameters():
     '''
     Loads parameters from config file and updates UI
     '''
+    import dearpygui.dearpygui as dpg
     print("Applying parameters from config...")
     config = loadConfig()
     
@@ -99,16 +145,19 @@ def updateParameters():
     dpg.set_value("ra", config.getfloat("Ground station", "ra"))
     dpg.set_value("dec", config.getfloat("Ground station", "dec"))
     dpg.set_value("use_eq_coords", config.getboolean("Ground station", "use_eq_coords"))
-    dpg.set_value("lo_freq", config.getint("Ground station", "lo_freq"))
+    dpg.set_value("lo_freq", int(config.getfloat("Ground station", "lo_freq")))
 
     dpg.set_value("driver", config.get("SDR", "driver"))
     dpg.set_value("sample_rate", config.getint("SDR", "sample_rate"))
     dpg.set_value("ppm_offset", config.getint("SDR", "ppm_offset"))
     dpg.set_value("bins", config.getint("SDR", "bins"))
     dpg.set_value("frequency", config.getint("SDR", "frequency"))
+    dpg.set_value("dropout_repair", config.get("SDR", "dropout_repair", fallback=DEFAULT_PARAM["dropout_repair"]))
+    dpg.set_value("stream_format", config.get("SDR", "stream_format", fallback=DEFAULT_PARAM["stream_format"]))
 
     dpg.set_value("fft_num", config.getint("Spectral line", "fft_num"))
     dpg.set_value("smoothing", config.getint("Spectral line", "smoothing"))
+    dpg.set_value("smoothing_method", config.get("Spectral line", "smoothing_method", fallback=DEFAULT_PARAM["smoothing_method"]))
     dpg.set_value("restfreq", config.getfloat("Spectral line", "restfreq"))
 
     dpg.set_value("y_min", config.getfloat("Spectral line", "y_min"))
@@ -116,12 +165,31 @@ def updateParameters():
     dpg.set_value("save_data", config.getboolean("Spectral line", "save_data"))
     dpg.set_value("output_dir", config.get("Spectral line", "output_dir"))
     dpg.set_value("calibrate_background", config.getboolean("Spectral line", "background_cal"))
+    dpg.set_value("rfi_flagging", config.getboolean("Spectral line", "rfi_flagging", fallback=DEFAULT_PARAM["rfi_flagging"]))
+    dpg.set_value("rfi_subint", config.getint("Spectral line", "rfi_subint", fallback=DEFAULT_PARAM["rfi_subint"]))
+    dpg.set_value("rfi_threshold", config.getfloat("Spectral line", "rfi_threshold", fallback=DEFAULT_PARAM["rfi_threshold"]))
+    dpg.set_value("doppler_tracking", config.getboolean("Spectral line", "doppler_tracking", fallback=DEFAULT_PARAM["doppler_tracking"]))
+    dpg.set_value("doppler_interval", config.getfloat("Spectral line", "doppler_interval", fallback=DEFAULT_PARAM["doppler_interval"]))
+    dpg.set_value("zoom_decimation", config.getint("Spectral line", "zoom_decimation", fallback=DEFAULT_PARAM["zoom_decimation"]))
+    dpg.set_value("zoom_freq", config.getfloat("Spectral line", "zoom_freq", fallback=DEFAULT_PARAM["zoom_freq"]))
+    dpg.set_value("restfreqs", config.get("Spectral line", "restfreqs", fallback=DEFAULT_PARAM["restfreqs"]))
+    dpg.set_value("line_window", config.getfloat("Spectral line", "line_window", fallback=DEFAULT_PARAM["line_window"]))
+    dpg.set_value("bandpass_cal", config.getboolean("Spectral line", "bandpass_cal", fallback=DEFAULT_PARAM["bandpass_cal"]))
+    dpg.set_value("adaptive", config.getboolean("Spectral line", "adaptive", fallback=DEFAULT_PARAM["adaptive"]))
+    dpg.set_value("target_rms", config.getfloat("Spectral line", "target_rms", fallback=DEFAULT_PARAM["target_rms"]))
+    dpg.set_value("rms_unit", config.get("Spectral line", "rms_unit", fallback=DEFAULT_PARAM["rms_unit"]))
+    dpg.set_value("tsys", config.getfloat("Spectral line", "tsys", fallback=DEFAULT_PARAM["tsys"]))
+    dpg.set_value("target_snr", config.getfloat("Spectral line", "target_snr", fallback=DEFAULT_PARAM["target_snr"]))
+    dpg.set_value("archive", config.getboolean("Spectral line", "archive", fallback=DEFAULT_PARAM["archive"]))
+    dpg.set_value("archive_precision", config.getfloat("Spectral line", "archive_precision", fallback=DEFAULT_PARAM["archive_precision"]))
+    dpg.set_value("archive_codec", config.get("Spectral line", "archive_codec", fallback=DEFAULT_PARAM["archive_codec"]))
 
 
 def applyParameters():
     '''
     Applies current parameters to config file
     '''
+    import dearpygui.dearpygui as dpg
     print("Applying parameters to config...")
     config = loadConfig()
     
@@ -142,15 +210,36 @@ def applyParameters():
     config.set("SDR", "ppm_offset", str(dpg.get_value("ppm_offset")))
     config.set("SDR", "bins", str(dpg.get_value("bins")))
     config.set("SDR", "frequency", str(dpg.get_value("frequency")))
+    config.set("SDR", "dropout_repair", str(dpg.get_value("dropout_repair")))
+    config.set("SDR", "stream_format", str(dpg.get_value("stream_format")))
 
     config.set("Spectral line", "fft_num", str(dpg.get_value("fft_num")))
     config.set("Spectral line", "smoothing", str(dpg.get_value("smoothing")))
+    config.set("Spectral line", "smoothing_method", str(dpg.get_value("smoothing_method")))
     config.set("Spectral line", "restfreq", str(dpg.get_value("restfreq")))
     config.set("Spectral line", "y_min", str(round(dpg.get_value("y_min"), 9)))
     config.set("Spectral line", "y_max", str(round(dpg.get_value("y_max"), 9)))
     config.set("Spectral line", "save_data", str(dpg.get_value("save_data")))
     config.set("Spectral line", "output_dir", str(dpg.get_value("output_dir")))
     config.set("Spectral line", "background_cal", str(dpg.get_value("calibrate_background")))
+    config.set("Spectral line", "rfi_flagging", str(dpg.get_value("rfi_flagging")))
+    config.set("Spectral line", "rfi_subint", str(dpg.get_value("rfi_subint")))
+    config.set("Spectral line", "rfi_threshold", str(round(dpg.get_value("rfi_threshold"), 3)))
+    config.set("Spectral line", "doppler_tracking", str(dpg.get_value("doppler_tracking")))
+    config.set("Spectral line", "doppler_interval", str(round(dpg.get_value("doppler_interval"), 3)))
+    config.set("Spectral line", "zoom_decimation", str(dpg.get_value("zoom_decimation")))
+    config.set("Spectral line", "zoom_freq", str(round(dpg.get_value("zoom_freq"), 6)))
+    config.set("Spectral line", "restfreqs", str(dpg.get_value("restfreqs")))
+    config.set("Spectral line", "line_window", str(round(dpg.get_value("line_window"), 3)))
+    config.set("Spectral line", "bandpass_cal", str(dpg.get_value("bandpass_cal")))
+    config.set("Spectral line", "adaptive", str(dpg.get_value("adaptive")))
+    config.set("Spectral line", "target_rms", str(round(dpg.get_value("target_rms"), 6)))
+    config.set("Spectral line", "rms_unit", str(dpg.get_value("rms_unit")))
+    config.set("Spectral line", "tsys", str(round(dpg.get_value("tsys"), 3)))
+    config.set("Spectral line", "target_snr", str(round(dpg.get_value("target_snr"), 3)))
+    config.set("Spectral line", "archive", str(dpg.get_value("archive")))
+    config.set("Spectral line", "archive_precision", str(round(dpg.get_value("archive_precision"), 6)))
+    config.set("Spectral line", "archive_codec", str(dpg.get_value("archive_codec")))
     
     with open('config.ini', 'w') as configfile:
         config.write(configfile)
@@ -3,26 +3,353 @@ import numpy as np
 
 # TODO - Maybe remake into class
 
+# Maximum number of points handed to the plot at once, roughly twice the width of a plot in pixels
+MAX_DISPLAY_POINTS = 4096
+
+# Sub-integrations shown in the waterfall, its largest width in channels (wider spectra are averaged down) and its height in pixels
+WATERFALL_ROWS = 192
+# Rows per texture of the waterfall. Only the texture with the newest row is uploaded, as DearPyGui copies textures value by value
+WATERFALL_TILE_ROWS = 16
+WATERFALL_MAX_CHANNELS = 4096
+WATERFALL_HEIGHT = 280
+# Weight of the newest row in the smoothed color scale limits, and the percentiles of a row the limits follow
+WATERFALL_LEVEL_SMOOTHING = 0.1
+WATERFALL_LEVEL_PERCENTILES = (1, 99.5)
+
+# Viridis at 11 evenly spaced points, interpolated into the colormap lookup table
+VIRIDIS = np.array([
+    [0.267, 0.005, 0.329], [0.283, 0.141, 0.458], [0.254, 0.265, 0.530], [0.207, 0.372, 0.553],
+    [0.164, 0.471, 0.558], [0.128, 0.567, 0.551], [0.135, 0.659, 0.518], [0.267, 0.749, 0.441],
+    [0.478, 0.821, 0.318], [0.741, 0.873, 0.150], [0.993, 0.906, 0.144]
+])
+
+
+def colormapLUT(points: np.ndarray = VIRIDIS, size: int = 256) -> np.ndarray:
+    '''
+    Opaque float32 RGBA lookup table of size colors, linearly interpolated between the RGB points
+    '''
+    lut = np.ones((size, 4), dtype=np.float32)
+    steps = np.linspace(0, 1, points.shape[0])
+    for c in range(3):
+        lut[:, c] = np.interp(np.linspace(0, 1, size), steps, points[:, c])
+    return lut
+
+
+COLORMAP_LUT = colormapLUT()
+
+
+class DecimatedSeries:
+    '''
+    Level of detail pyramid of a line series
+
+    Each level halves the resolution of the previous one by keeping the minimum and maximum of every pair of blocks,
+    so peaks and narrow features survive any amount of decimation.
+    Level 0 is the full resolution series. The pyramid is built once, and slicing a level is cheap.
+    '''
+    def __init__(self, xdata: np.ndarray, ydata: np.ndarray, vel: np.ndarray) -> None:
+        xdata, ydata, vel = np.asarray(xdata, dtype=np.float64), np.asarray(ydata, dtype=np.float64), np.asarray(vel)
+        # Levels are searched by x, so make sure it is increasing
+        if xdata.size > 1 and xdata[0] > xdata[-1]:
+            xdata, ydata, vel = xdata[::-1], ydata[::-1], vel[::-1]
+
+        self.XDATA = xdata
+        self.YDATA = ydata
+        self.VEL = vel
+        self.levels = [(xdata, ydata)]
+
+        # Positions and values of the block minima and maxima of the current level
+        x_min, y_min, x_max, y_max = xdata, ydata, xdata, ydata
+        while 2*x_min.size > MAX_DISPLAY_POINTS and x_min.size > 1:
+            x_min, y_min = self.reduceBlocks(x_min, y_min, np.argmin)
+            x_max, y_max = self.reduceBlocks(x_max, y_max, np.argmax)
+
+            # Interleave minimum and maximum of each block in the order they appear along x
+            min_first = x_min <= x_max
+            x_level = np.empty(2*x_min.size)
+            y_level = np.empty(2*x_min.size)
+            x_level[0::2] = np.where(min_first, x_min, x_max)
+            x_level[1::2] = np.where(min_first, x_max, x_min)
+            y_level[0::2] = np.where(min_first, y_min, y_max)
+            y_level[1::2] = np.where(min_first, y_max, y_min)
+            self.levels.append((x_level, y_level))
+
+    @staticmethod
+    def reduceBlocks(x: np.ndarray, y: np.ndarray, arg_func) -> tuple:
+        '''
+        Merge pairs of neighbouring blocks, keeping the point selected by arg_func (np.argmin or np.argmax)
+        '''
+        if x.size % 2:
+            x, y = np.append(x, x[-1]), np.append(y, y[-1])
+        pairs = y.reshape(-1, 2)
+        idx = arg_func(pairs, axis=1)
+        rows = np.arange(pairs.shape[0])
+        return x.reshape(-1, 2)[rows, idx], pairs[rows, idx]
+
+    def getVisible(self, x_lim: tuple) -> tuple:
+        '''
+        Return the finest level of the series within x_lim that does not exceed MAX_DISPLAY_POINTS
+        '''
+        for x_level, y_level in self.levels:
+            start = max(np.searchsorted(x_level, x_lim[0]) - 1, 0)
+            stop = min(np.searchsorted(x_level, x_lim[1]) + 1, x_level.size)
+            if stop - start <= MAX_DISPLAY_POINTS:
+                break
+        return x_level[start:stop], y_level[start:stop]
+
+
+class WaterfallBuffer:
+    '''
+    Ring buffer of colored spectra, laid out as the float32 RGBA pixels of dynamic textures of tile_rows rows each
+
+    Adding a spectrum only colors its row through the lookup table and writes it over the oldest row, so the
+    buffer is never shifted or rebuilt, and only the tile holding the row has to be uploaded again.
+    Rows are written upwards (decreasing index), which makes the newest row followed by the rest of the buffer,
+    wrapping around, newest to oldest from top to bottom.
+    The color scale follows the percentiles of the newest rows, so it adapts to gain and bandpass.
+    '''
+    def __init__(self, n_channels: int, rows: int = WATERFALL_ROWS, tile_rows: int = WATERFALL_TILE_ROWS) -> None:
+        self.n_channels = n_channels
+        self.factor = -(-n_channels//WATERFALL_MAX_CHANNELS)
+        self.width = -(-n_channels//self.factor)
+        self.rows = rows
+        self.tile_rows = tile_rows
+        self.tiles = -(-rows//tile_rows)
+        self.pixels = np.zeros((rows, self.width, 4), dtype=np.float32)
+        self.newest = 0
+        self.levels = None
+        self.dirty = set()
+
+    def clear(self) -> None:
+        self.pixels[:] = 0
+        self.newest = 0
+        self.levels = None
+        self.dirty = set(range(self.tiles))
+
+    def getTile(self, tile: int) -> np.ndarray:
+        '''
+        Pixels of a tile, as a view of the buffer
+        '''
+        return self.pixels[tile*self.tile_rows:(tile + 1)*self.tile_rows]
+
+    def binChannels(self, row: np.ndarray) -> np.ndarray:
+        '''
+        Average blocks of channels down to the width of the buffer
+        '''
+        if self.factor == 1:
+            return row
+        padded = np.pad(row, (0, self.width*self.factor - row.size), mode="edge")
+        return padded.reshape(self.width, self.factor).mean(axis=1)
+
+    def addRow(self, row: np.ndarray) -> None:
+        '''
+        Color a spectrum (in dB) and write it as the newest row
+        '''
+        row = self.binChannels(np.asarray(row, dtype=np.float32))
+        finite = np.isfinite(row)
+        if finite.any():
+            low, high = np.percentile(row[finite], WATERFALL_LEVEL_PERCENTILES)
+            if self.levels is None:
+                self.levels = np.array([low, high])
+            else:
+                self.levels += WATERFALL_LEVEL_SMOOTHING*(np.array([low, high]) - self.levels)
+        if self.levels is None:
+            return
+
+        low, high = self.levels
+        scale = (COLORMAP_LUT.shape[0] - 1)/max(high - low, 1e-6)
+        idx = np.clip((np.where(finite, row, low) - low)*scale, 0, COLORMAP_LUT.shape[0] - 1).astype(np.intp)
+        self.newest = (self.newest - 1) % self.rows
+        np.take(COLORMAP_LUT, idx, axis=0, out=self.pixels[self.newest])
+        self.dirty.add(self.newest//self.tile_rows)
+
+    def getSegments(self) -> list:
+        '''
+        Pieces of the tiles as drawn with the newest row on top, as tuples of tile, rows (bottom, top) in the plot and
+        texture coordinates (v at top, v at bottom). The tile holding the newest row is split in two, which gives tiles + 1 pieces
+        '''
+        segments = []
+        for tile in range(self.tiles):
+            start, stop = tile*self.tile_rows, min((tile + 1)*self.tile_rows, self.rows)
+            size = stop - start
+            for first, last in ((start, self.newest), (self.newest, stop)) if start < self.newest < stop else ((start, stop),):
+                # Age (in rows) of the first row of the piece sets its position from the top
+                top = self.rows - (first - self.newest) % self.rows
+                segments.append((tile, (top - (last - first), top), ((first - start)/size, (last - start)/size)))
+        return segments
+
+
+# Currently displayed series by line series tag, and the axis limits they were last served for
+displayed_series = {}
+displayed_limits = None
+
+# Waterfall of the live sub-integrations, its frequency range (MHz), and whether it has rows not yet uploaded to its textures
+waterfall = None
+waterfall_range = None
+waterfall_dirty = False
+
+
 def dataViewerWindow():
     '''
     Window of data viewer
     '''
     with dpg.child_window(width=-1):
-        dpg.add_text("Data viewer")
+        with dpg.group(horizontal=True):
+            dpg.add_text("Data viewer")
+            dpg.add_checkbox(label="Waterfall", default_value=True, tag="show_waterfall", callback=lambda: showWaterfall(dpg.get_value("show_waterfall")))
 
-        with dpg.plot(width=-1,height=-1, tag = "spectrum_plot", anti_aliased=True):
+        with dpg.plot(width=-1,height=-WATERFALL_HEIGHT, tag = "spectrum_plot", anti_aliased=True):
             dpg.add_plot_axis(dpg.mvXAxis, label = "Frequency (MHz)", tag="x_axis")
             dpg.add_plot_axis(dpg.mvYAxis, label = "Intensity", tag="y_axis")
             dpg.add_plot_legend()
-            
+
             # And then add data to plot
             dpg.add_line_series(np.linspace(0, 1, 100), np.zeros(100), label="Data", parent="y_axis", tag="spectrum_line_series")
+            dpg.add_line_series([], [], label="Model", parent="y_axis", tag="model_line_series", show=False)
+
+        # Live sub-integrations, newest on top. The texture and image series are made for the first spectrum
+        dpg.add_texture_registry(tag="waterfall_textures")
+        with dpg.plot(width=-1, height=-1, tag="waterfall_plot"):
+            dpg.add_plot_axis(dpg.mvXAxis, label = "Frequency (MHz)", tag="waterfall_x_axis")
+            dpg.add_plot_axis(dpg.mvYAxis, label = "Time", tag="waterfall_y_axis", no_tick_labels=True)
 
 
-def updateLineSeries(xdata: np.ndarray, ydata: np.ndarray, vel: np.ndarray) -> None:
+def updateLineSeries(xdata: np.ndarray, ydata: np.ndarray, vel: np.ndarray = None) -> None:
     '''
     Update currently displayed line series
+
+    Velocities may be omitted for live spectra where they are not yet computed
     '''
-    dpg.set_value("spectrum_line_series", [xdata, ydata, vel])
+    global displayed_limits
+    vel = np.zeros_like(xdata) if vel is None else vel
+    series = DecimatedSeries(xdata, ydata, vel)
+    displayed_series["spectrum_line_series"] = series
+    displayed_limits = (series.XDATA[0], series.XDATA[-1])
+
+    for tag, shown in displayed_series.items():
+        dpg.set_value(tag, list(shown.getVisible(displayed_limits)))
     dpg.fit_axis_data('x_axis')
     dpg.fit_axis_data('y_axis')
+
+
+def updateModelSeries(xdata: np.ndarray, ydata: np.ndarray) -> None:
+    '''
+    Update the displayed model fit
+    '''
+    series = DecimatedSeries(xdata, ydata, np.zeros_like(xdata))
+    displayed_series["model_line_series"] = series
+    if displayed_limits is not None:
+        dpg.set_value("model_line_series", list(series.getVisible(displayed_limits)))
+
+
+def showModelSeries(show: bool) -> None:
+    '''
+    Show or hide the model fit
+    '''
+    dpg.configure_item("model_line_series", show=show)
+
+
+def refreshLineSeries() -> None:
+    '''
+    Serve the points of the displayed series that are visible in the current zoom
+
+    Called every frame, but only touches the plot when the x-axis limits have changed
+    '''
+    global displayed_limits
+    if not displayed_series:
+        return
+
+    x_lim = tuple(dpg.get_axis_limits("x_axis"))
+    if x_lim == displayed_limits:
+        return
+
+    displayed_limits = x_lim
+    for tag, series in displayed_series.items():
+        dpg.set_value(tag, list(series.getVisible(x_lim)))
+
+
+def getLineSeries() -> tuple:
+    '''
+    Return the full resolution frequencies, data and velocities of the displayed series
+    '''
+    if "spectrum_line_series" not in displayed_series:
+        return None
+    series = displayed_series["spectrum_line_series"]
+    return series.XDATA, series.YDATA, series.VEL
+
+
+def showWaterfall(show: bool) -> None:
+    '''
+    Show or hide the waterfall, giving its space to the spectrum
+    '''
+    dpg.configure_item("waterfall_plot", show=show)
+    dpg.configure_item("spectrum_plot", height=-WATERFALL_HEIGHT if show else -1)
+
+
+def addWaterfallRow(xdata: np.ndarray, row: np.ndarray) -> None:
+    '''
+    Add a sub-integration (in dB) to the waterfall. Its textures are updated once per frame by refreshWaterfall
+    '''
+    global waterfall_dirty
+    x_range = (float(xdata[0]), float(xdata[-1]))
+    if waterfall is None or waterfall.n_channels != row.size or waterfall_range != x_range:
+        createWaterfall(row.size, x_range)
+    waterfall.addRow(row)
+    waterfall_dirty = True
+
+
+def createWaterfall(n_channels: int, x_range: tuple) -> None:
+    '''
+    (Re)create the waterfall textures and their image series for spectra of n_channels over x_range
+    '''
+    global waterfall, waterfall_range
+    if waterfall is not None:
+        for piece in range(waterfall.tiles + 1):
+            dpg.delete_item(f"waterfall_series_{piece}")
+        for tile in range(waterfall.tiles):
+            dpg.delete_item(f"waterfall_texture_{tile}")
+    waterfall = WaterfallBuffer(n_channels)
+    waterfall_range = x_range
+
+    for tile in range(waterfall.tiles):
+        tile_pixels = waterfall.getTile(tile)
+        dpg.add_dynamic_texture(waterfall.width, tile_pixels.shape[0], tile_pixels, parent="waterfall_textures", tag=f"waterfall_texture_{tile}")
+    for piece in range(waterfall.tiles + 1):
+        dpg.add_image_series("waterfall_texture_0", (x_range[0], 0), (x_range[1], 0), parent="waterfall_y_axis", tag=f"waterfall_series_{piece}")
+    dpg.set_axis_limits("waterfall_y_axis", 0, waterfall.rows)
+    dpg.fit_axis_data("waterfall_x_axis")
+
+
+def clearWaterfall() -> None:
+    '''
+    Clear the waterfall, e.g. when a new observation starts
+    '''
+    global waterfall_dirty
+    if waterfall is not None:
+        waterfall.clear()
+        waterfall_dirty = True
+
+
+def refreshWaterfall() -> None:
+    '''
+    Upload the tiles of the waterfall with new rows to their textures, and move the image series along
+
+    Called every frame, but only touches the textures when rows were added. Tiles are handed over as float32 arrays,
+    so no Python lists are made, however many rows were added since the last frame
+    '''
+    global waterfall_dirty
+    if not waterfall_dirty:
+        return
+
+    waterfall_dirty = False
+    for tile in waterfall.dirty:
+        dpg.set_value(f"waterfall_texture_{tile}", waterfall.getTile(tile))
+    waterfall.dirty.clear()
+
+    segments = waterfall.getSegments()
+    for piece, (tile, (bottom, top), (v_top, v_bottom)) in enumerate(segments):
+        dpg.configure_item(f"waterfall_series_{piece}", texture_tag=f"waterfall_texture_{tile}", show=True,
+                           bounds_min=(waterfall_range[0], bottom), bounds_max=(waterfall_range[1], top),
+                           uv_min=(0.0, v_top), uv_max=(1.0, v_bottom))
+    # Without a split tile there is a piece less
+    for piece in range(len(segments), waterfall.tiles + 1):
+        dpg.configure_item(f"waterfall_series_{piece}", show=False)
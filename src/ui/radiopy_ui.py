@@ -27,10 +27,10 @@ def runUI():
                     ParameterTab()
                     
                     # Spectral line
-                    SpectralLineTab()
+                    line_tab = SpectralLineTab()
 
                     # Analysis
-                    AnalysisTab()
+                    analysis_tab = AnalysisTab()
 
                     # Info
                     INFO.infoTab()
@@ -48,7 +48,14 @@ def runUI():
     dpg.set_exit_callback(cleanupProcess)
     dpg.setup_dearpygui()
     dpg.show_viewport()
-    dpg.start_dearpygui()
+    # Render loop polls the background observation for live spectra, serves the zoomed in data and uploads new waterfall rows
+    while dpg.is_dearpygui_running():
+        line_tab.pollObservation()
+        analysis_tab.pollUpdate()
+        DATAVIEWER.refreshLineSeries()
+        DATAVIEWER.refreshWaterfall()
+        dpg.render_dearpygui_frame()
+    line_tab.stopWorker()
     dpg.destroy_context()
 
 def cleanupProcess() -> None:
@@ -1,15 +1,16 @@
 import os
+import time
+import threading
 import numpy as np
-import pandas as pd
 import dearpygui.dearpygui as dpg
-import matplotlib.pyplot as plt
 
 import ui.ui_constants as UI_CONSTS
-from src.core.observation import Observation
-import src.core.dsp as DSP
-from src.ui.dataviewer import updateLineSeries #, Add Gaussian fit etc...
-
-# from scipy.optimize import curve_fit
+from core.observation import Observation
+import core.dsp as DSP
+from core.pipeline import Pipeline
+from core.fitting import GaussianModel, fitGaussians
+from core.detection import detectLines
+from ui.dataviewer import updateLineSeries, getLineSeries, updateModelSeries, showModelSeries
 
 row_names = [
     "Observation time",
@@ -26,6 +27,9 @@ obs_kw_names = [
     "lsr_cor"
 ]
 
+# Time to wait after the last edit before recomputing, so bursts of UI events only trigger one update
+DEBOUNCE_TIME = 0.15
+
 class AnalysisTab:
     def __init__(self) -> None:
         self.observation = None
@@ -37,6 +41,19 @@ class AnalysisTab:
         self.gauss_mu = []
         self.gauss_std = []
 
+        # Processing of the loaded observation. Only stages after a changed parameter are recomputed
+        self.pipeline = Pipeline()
+        self.pipeline.addStage("load", self.loadStage, path="")
+        self.pipeline.addStage("smooth", self.smoothStage, width=1, method="boxcar")
+        self.pipeline.addStage("scale", self.scaleStage, log=False)
+        self.pipeline.addStage("baseline", self.baselineStage, remove=False)
+        self.pipeline.addStage("display", self.displayStage)
+        self.update_deadline = None
+
+        # Model fit finished by the fitting thread, waiting to be shown
+        self.fit_thread = None
+        self.fitted_model = None
+
         with dpg.tab(label="Analysis"):
             with dpg.collapsing_header(label="Observation", default_open=True):
                 dpg.add_spacer(height=UI_CONSTS.H_COLL_HEAD_SPACER)
@@ -49,12 +66,12 @@ class AnalysisTab:
                 with dpg.file_dialog(label = "Browse", directory_selector=True, show = False, 
                                     tag = "analysis_file_dialog", width=600, 
                                     height=400, default_path=os.getcwd(), 
-                                    callback=lambda s, a, u: dpg.set_value("observation_directory", UI_CONSTS.fileBrowserCallback(s, a, u)),
+                                    callback=lambda s, a, u: (dpg.set_value("observation_directory", UI_CONSTS.fileBrowserCallback(s, a, u)), self.scheduleUpdate()),
                                     cancel_callback=UI_CONSTS.fileBrowserCancelled):
                     pass
 
-                dpg.add_input_text(hint="Directory", width=UI_CONSTS.W_TXT_INP, tag="observation_directory", callback=self.updateObservation)
-                dpg.add_button(label="Refresh", callback=self.updateObservation)
+                dpg.add_input_text(hint="Directory", width=UI_CONSTS.W_TXT_INP, tag="observation_directory", callback=self.scheduleUpdate)
+                dpg.add_button(label="Refresh", callback=self.refreshObservation)
                 dpg.bind_item_theme(dpg.last_item(), "button_theme")
 
 
@@ -77,7 +94,7 @@ class AnalysisTab:
             dpg.add_spacer(height=UI_CONSTS.H_COLL_HEAD_SPACER)
             with dpg.collapsing_header(label="Fitting", default_open=True):
                 dpg.add_text("Fit model to data")
-                dpg.add_checkbox(label="Toggle model", tag="include_fitting")
+                dpg.add_checkbox(label="Toggle model", tag="include_fitting", callback=lambda: showModelSeries(dpg.get_value("include_fitting")))
 
                 dpg.add_input_float(label="Continuum level", tag="continuum_level", width=UI_CONSTS.W_NUM_INP_SING_COL)
                 dpg.add_text("Modify Gaussian profiles")
@@ -92,15 +109,19 @@ class AnalysisTab:
                     dpg.add_button(label = "Delete", callback=self.removeGaussian)
                     dpg.bind_item_theme(dpg.last_item(), "button_theme")
 
+                dpg.add_text("Find initial guess automatically")
+                dpg.add_button(label = "Detect lines", callback=self.detectModel)
+                dpg.bind_item_theme(dpg.last_item(), "button_theme")
+
                 dpg.add_text("Attempt to fit model")
-                dpg.add_button(label = "Fit") # TODO fit callback
+                dpg.add_button(label = "Fit", callback=self.fitModel)
                 dpg.bind_item_theme(dpg.last_item(), "button_theme")
 
                 # SAVING
                 dpg.add_spacer(height=UI_CONSTS.H_COLL_HEAD_SPACER)
                 dpg.add_text("Save model fit")
                 dpg.add_input_text(hint="Model name", width=UI_CONSTS.W_TXT_INP, tag="model_fit_name")
-                dpg.add_button(label = "Save") # TODO export callback
+                dpg.add_button(label = "Save", callback=self.saveModel)
                 dpg.bind_item_theme(dpg.last_item(), "button_theme")
             
             
@@ -108,9 +129,11 @@ class AnalysisTab:
             dpg.add_spacer(height=UI_CONSTS.H_COLL_HEAD_SPACER)
             with dpg.collapsing_header(label="Edit", default_open=True):
                 dpg.add_text("Edit current observation")
-                dpg.add_input_int(label="Smoothing", min_clamped=True, min_value=1, default_value=1, step=2, tag="editing_smoothing", width=UI_CONSTS.W_NUM_INP_SING_COL, callback=self.updateObservation)
+                dpg.add_input_int(label="Smoothing", min_clamped=True, min_value=1, default_value=1, tag="editing_smoothing", width=UI_CONSTS.W_NUM_INP_SING_COL, callback=self.scheduleUpdate)
+                dpg.add_combo(DSP.SMOOTHING_METHODS, label="Method", default_value="boxcar", tag="editing_smoothing_method", width=UI_CONSTS.W_NUM_INP_SING_COL, callback=self.scheduleUpdate)
             
-                dpg.add_checkbox(label="Toggle linear/log scale", callback=self.updateObservation, tag="toggle_lin_log")
+                dpg.add_checkbox(label="Toggle linear/log scale", callback=self.scheduleUpdate, tag="toggle_lin_log")
+                dpg.add_checkbox(label="Remove linear baseline", callback=self.scheduleUpdate, tag="remove_baseline")
 
 
                 # SAVING
@@ -182,19 +205,117 @@ class AnalysisTab:
         dpg.set_value("gauss_mu", self.gauss_mu[gauss_idx])
         dpg.set_value("gauss_std", self.gauss_std[gauss_idx])
 
-    def updateObservation(self) -> None:
+    def fitModel(self) -> None:
+        '''
+        Fit continuum plus Gaussians to the displayed spectrum in a background thread
+        '''
+        spectrum = self.pipeline.getOutput("display")
+        if spectrum is None or len(self.gauss_A) == 0:
+            print("Load an observation and add at least one Gaussian first!")
+            return
+        if self.fit_thread is not None and self.fit_thread.is_alive():
+            print("Already fitting model...")
+            return
+
+        _, radial_vel, data = spectrum
+        guess = GaussianModel(C=float(dpg.get_value("continuum_level")), A=self.gauss_A, MU=self.gauss_mu, STD=self.gauss_std)
+        
+        def fit():
+            self.fitted_model = fitGaussians(radial_vel, data, guess)
+
+        self.fit_thread = threading.Thread(target=fit, daemon=True)
+        self.fit_thread.start()
+
+    def detectModel(self) -> None:
+        '''
+        Replace the Gaussians of the model with lines detected in the displayed spectrum
+        '''
+        spectrum = self.pipeline.getOutput("display")
+        if spectrum is None:
+            print("Load an observation first!")
+            return
+
+        _, radial_vel, data = spectrum
+        model = detectLines(radial_vel, data)
+        print(f"Detected {model.A.size} line(s)")
+        self.showModel(model)
+
+    def showModel(self, model: GaussianModel) -> None:
+        '''
+        Show model in data viewer and its parameters in the fitting fields
+        '''
+        freqs, radial_vel, _ = self.pipeline.getOutput("display")
+        self.gauss_A, self.gauss_mu, self.gauss_std = list(model.A), list(model.MU), list(model.STD)
+        dpg.set_value("continuum_level", model.C)
+        self.updateGaussianDropdown()
+
+        updateModelSeries(xdata=freqs/10**6, ydata=model.evaluate(radial_vel))
+        dpg.set_value("include_fitting", True)
+        showModelSeries(True)
+
+    def saveModel(self) -> None:
+        '''
+        Save the current model next to the loaded observation
+        '''
+        if self.observation is None:
+            print("No observation loaded!")
+            return
+        name = dpg.get_value("model_fit_name")
+        if name == "":
+            print("Please give the model a name!")
+            return
+
+        model = GaussianModel(C=float(dpg.get_value("continuum_level")), A=self.gauss_A, MU=self.gauss_mu, STD=self.gauss_std)
+        # Keep the uncertainties of the fit unless it was edited. Parameters shown in the UI are rounded to float32
+        params = model.getParameters()
+        if self.fitted_model is not None and params.size == self.fitted_model.getParameters().size \
+                and np.allclose(params, self.fitted_model.getParameters(), rtol=1e-6):
+            model = self.fitted_model
+        self.observation.writeModel(name, model)
+        print(f"Model saved as {name}")
+
+    def scheduleUpdate(self) -> None:
+        '''
+        Read editing parameters from the UI and schedule an update of the observation
+        '''
+        self.pipeline.setParams("load", path=dpg.get_value("observation_directory"))
+        self.pipeline.setParams("smooth", width=int(dpg.get_value("editing_smoothing")), method=dpg.get_value("editing_smoothing_method"))
+        self.pipeline.setParams("scale", log=dpg.get_value("toggle_lin_log"))
+        self.pipeline.setParams("baseline", remove=dpg.get_value("remove_baseline"))
+        self.update_deadline = time.perf_counter() + DEBOUNCE_TIME
+
+    def refreshObservation(self) -> None:
+        '''
+        Reload the observation from disk
+        '''
+        self.pipeline.invalidate("load")
+        self.scheduleUpdate()
+
+    def pollUpdate(self) -> None:
         '''
-        Update observation info fields and spectrum plot
+        Run the scheduled update once no edits have happened for DEBOUNCE_TIME. Called once per frame
+
+        Also shows the result of a finished model fit
         '''
+        if self.fit_thread is not None and not self.fit_thread.is_alive():
+            self.fit_thread = None
+            self.showModel(self.fitted_model)
 
-        obs_path = dpg.get_value("observation_directory")
+        if self.update_deadline is None or time.perf_counter() < self.update_deadline:
+            return
+        self.update_deadline = None
+        self.pipeline.run()
 
+    def loadStage(self, _, path: str) -> tuple:
+        '''
+        Load observation from disk and update observation info fields
+        '''
         # Some initial checking of the validation of the file
-        if not os.path.isdir(obs_path):
+        if not os.path.isdir(path):
             print("Not a valid file path!!")
-            return
+            return None
         
-        self.observation = Observation(dir=obs_path)
+        self.observation = Observation(dir=path)
         freqs, radial_vel, data = self.observation.readData()
         info = self.observation.readInfo()
 
@@ -205,17 +326,43 @@ class AnalysisTab:
             else:
                 dat = str(info[k])
             dpg.set_value(row_names[i]+"_value", dat)
-        
 
-        # Finally, update line series
-        conv = int(dpg.get_value("editing_smoothing"))
-        if conv > 1:
-            data = DSP.applySmoothing(data, conv)
-        
-        if dpg.get_value("toggle_lin_log"):
+        return freqs, radial_vel, data
+
+    def smoothStage(self, spectrum: tuple, width: int, method: str) -> tuple:
+        '''
+        Smooth data of the loaded spectrum
+        '''
+        freqs, radial_vel, data = spectrum
+        if width > 1:
+            data = DSP.applySmoothing(data, width, method)
+        return freqs, radial_vel, data
+
+    def scaleStage(self, spectrum: tuple, log: bool) -> tuple:
+        '''
+        Convert data between linear and logarithmic scale
+        '''
+        freqs, radial_vel, data = spectrum
+        if log:
             data = 10**(data/10) if np.mean(data) < 0 else 10*np.log10(data)
-        
+        return freqs, radial_vel, data
+
+    def baselineStage(self, spectrum: tuple, remove: bool) -> tuple:
+        '''
+        Remove linear baseline from data
+        '''
+        freqs, radial_vel, data = spectrum
+        if remove:
+            data = DSP.correctSlant(data)
+        return freqs, radial_vel, data
+
+    def displayStage(self, spectrum: tuple) -> tuple:
+        '''
+        Show the processed spectrum in the data viewer
+        '''
+        freqs, radial_vel, data = spectrum
         updateLineSeries(xdata=freqs/10**6, ydata=data, vel=radial_vel)
+        return spectrum
 
 
     def saveToFile(self) -> None:
@@ -223,7 +370,7 @@ class AnalysisTab:
         Save edited data to new file
         '''
         # Get current edited data and write to new observation file
-        xdata, ydata, vel = dpg.get_value("spectrum_line_series")[:3]
+        xdata, ydata, vel = getLineSeries()
         obs_time = dpg.get_value(row_names[0]+"_value")
         obs_coord_azel = np.array(dpg.get_value(row_names[1]+"_value").split(", "), dtype=float)
         obs_coord_eq = np.array(dpg.get_value(row_names[2]+"_value").split(", "), dtype=float)
@@ -1,5 +1,4 @@
 import dearpygui.dearpygui as dpg
-import pandas as pd
 import os
 
 import ui.ui_constants as UI_CONSTS
@@ -60,6 +59,7 @@ def updateObservationInfo():
     '''
     Update table with info from loaded observation
     '''
+    import pandas as pd
     path = dpg.get_value("main_path")
     data = pd.read_csv(path)
 
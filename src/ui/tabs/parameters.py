@@ -2,7 +2,7 @@ import dearpygui.dearpygui as dpg
 
 # Handle devices
 import core.soapy as soapy
-from core.soapy import SDR
+from core.device_cache import invalidateDeviceCache
 
 # Update spectral line observation time estimate
 # from ui.tabs.spectral_line_ui import updateTimeEstimate
@@ -45,7 +45,7 @@ class ParameterTab:
                     dpg.add_button(label = "Refresh", width=UI_CONSTS.W_TXT_INP, callback=self.updateDrivers)
                     dpg.bind_item_theme(dpg.last_item(), "button_theme")
 
-                # Determine available soapy devices
+                # Determine available soapy devices, from the device cache once they have been enumerated
                 available_drives = soapy.listDrivers()
                 dpg.add_combo(available_drives, default_value="none" , label = "Driver", tag="driver", width = UI_CONSTS.W_NUM_INP_SING_COL, callback=self.selectedSDR)
                 
@@ -54,6 +54,8 @@ class ParameterTab:
                 dpg.add_input_int(label = "PPM offset", default_value = 0, tag = "ppm_offset", width = UI_CONSTS.W_NUM_INP_SING_COL)
                 dpg.add_input_int(label="Center freq. (Hz)", width=UI_CONSTS.W_NUM_INP_SING_COL, default_value=1420405752, tag="frequency")
                 dpg.add_combo(label="Frequency presets", items=self.updateFrequency(), width=UI_CONSTS.W_TXT_INP, callback=self.updateFrequency, tag="freq_preset")
+                dpg.add_combo(["interpolate", "blank"], default_value="interpolate", label="Dropout repair", tag="dropout_repair", width=UI_CONSTS.W_NUM_INP_SING_COL)
+                dpg.add_combo(["cf32", "native"], default_value="cf32", label="Stream format", tag="stream_format", width=UI_CONSTS.W_NUM_INP_SING_COL)
                 
 
                 dpg.add_spacer(height=5)
@@ -72,9 +74,12 @@ class ParameterTab:
         '''
         Updates the driver dropdown with discovered drivers.
         Proceeds to also refresh sample rates if device is already chosen.
+
+        The device cache is invalidated, so devices are enumerated and probed again
         '''
+        invalidateDeviceCache()
         current_driver = dpg.get_value("driver")
-        available_drivers = soapy.listDrivers()
+        available_drivers = soapy.listDrivers(refresh = True)
         dpg.configure_item("driver", items = available_drivers)
         if current_driver != "none" and current_driver in available_drivers:
             self.selectedSDR()
@@ -87,14 +92,12 @@ class ParameterTab:
     def selectedSDR(self) -> None:
         '''
         Gets the selected SDR from dropdown menu.
-        Proceeds to update sample rate dropdown with specific SDR sample rates
+        Proceeds to update sample rate dropdown with specific SDR sample rates, from the device cache if the SDR is known
         '''
         driver = dpg.get_value("driver")
-        sdr = SDR(driver)
-        sample_rates = sdr.getAvailableSampleRates()
+        sample_rates = soapy.getCapabilities(driver).sample_rates
         dpg.set_value("sample_rate", sample_rates[0])
         dpg.configure_item("sample_rate", items = sample_rates)
-        del sdr
 
 
     def updateFrequency(self) -> list:
@@ -106,7 +109,7 @@ class ParameterTab:
             "H1, 1420MHz": 1420405752,
             "OH, 1612MHz": 1612230900,
             "OH, 1665MHz": 1665402000,
-            "OH, 1667MHz": 1665401800,
+            "OH, 1667MHz": 1667359000,
             "OH, 1720MHz": 1720529900,
         }
 
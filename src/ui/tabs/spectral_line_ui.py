@@ -1,17 +1,33 @@
 import os
+import queue
+import multiprocessing
 import dearpygui.dearpygui as dpg
 
 import ui.config_callbacks as CB
 import ui.ui_constants as UI_CONSTS
+from core.dsp import SMOOTHING_METHODS
+from core.adaptive import RMS_UNITS, expectedSpectra
+from core.archive import ARCHIVE_CODECS
+from ui.dataviewer import updateLineSeries, addWaterfallRow, clearWaterfall
+from observation_worker import observationWorker
 
 class SpectralLineTab:
     def __init__(self) -> None:
+        # Persistent background worker, its command queue, its queue of live updates and the event ending an integration early
+        self.worker_process = None
+        self.commands = None
+        self.live_queue = None
+        self.stop_event = None
+        self.running = False
+        self.startWorker()
+
         with dpg.tab(label= "Spectral line"):
             with dpg.collapsing_header(label = "Data collection", default_open=True):
                 dpg.add_text("Configure data collection parameters")
                 dpg.add_input_int(label = "Bins", default_value=1024, tag = "bins", width = UI_CONSTS.W_NUM_INP_SING_COL, callback = self.updateTimeEstimate)
                 dpg.add_input_int(label = "FFT average", default_value=1000, tag = "fft_num", width = UI_CONSTS.W_NUM_INP_SING_COL, callback = self.updateTimeEstimate)
                 dpg.add_input_int(label = "Smoothing", default_value=0, tag = "smoothing", width = UI_CONSTS.W_NUM_INP_SING_COL, callback = self.updateTimeEstimate)
+                dpg.add_combo(SMOOTHING_METHODS, label = "Smoothing method", default_value="boxcar", tag = "smoothing_method", width = UI_CONSTS.W_NUM_INP_SING_COL)
 
                 with dpg.group(horizontal=True):
                     dpg.add_input_float(label="Rest freq (MHz)", default_value=0, min_value=0, min_clamped=True, width=UI_CONSTS.W_NUM_INP_SING_COL, tag="restfreq")
@@ -19,6 +35,25 @@ class SpectralLineTab:
 
                 with dpg.tooltip("restfreq_tooltip"):
                     dpg.add_text("Rest frequency to determine radial velocites from.\nIf left at 0, default will be SDR center frequency")
+
+                with dpg.group(horizontal=True):
+                    dpg.add_input_text(label="Line freqs (MHz)", default_value="", width=UI_CONSTS.W_NUM_INP_SING_COL, tag="restfreqs")
+                    dpg.add_text("(?)", color=(0,0,255,255), tag = "restfreqs_tooltip")
+
+                with dpg.tooltip("restfreqs_tooltip"):
+                    dpg.add_text("Comma separated rest frequencies of further lines in the band, e.g. 1665.402, 1667.359.\nEach line is saved as its own observation, within the velocity window")
+                dpg.add_input_float(label="Line window (km/s)", default_value=250.0, min_value=0, min_clamped=True, width=UI_CONSTS.W_NUM_INP_SING_COL, tag="line_window")
+
+                with dpg.group(horizontal=True):
+                    dpg.add_checkbox(label = "Adaptive integration", tag="adaptive", default_value=False, callback = self.updateTimeEstimate)
+                    dpg.add_text("(?)", color=(0,0,255,255), tag = "adaptive_tooltip")
+
+                with dpg.tooltip("adaptive_tooltip"):
+                    dpg.add_text("Stop once the spectrum reaches the target rms or the line the target SNR (0 is off).\nFFT average is then the longest integration. The line SNR needs a bandpass calibration")
+                dpg.add_input_float(label = "Target rms", default_value=0.0, min_value=0, min_clamped=True, format="%.5f", tag = "target_rms", width = UI_CONSTS.W_NUM_INP_SING_COL, callback = self.updateTimeEstimate)
+                dpg.add_combo(RMS_UNITS, label = "rms unit", default_value="dB", tag = "rms_unit", width = UI_CONSTS.W_NUM_INP_SING_COL, callback = self.updateTimeEstimate)
+                dpg.add_input_float(label = "Tsys (K)", default_value=0.0, min_value=0, min_clamped=True, tag = "tsys", width = UI_CONSTS.W_NUM_INP_SING_COL, callback = self.updateTimeEstimate)
+                dpg.add_input_float(label = "Target line SNR", default_value=0.0, min_value=0, min_clamped=True, tag = "target_snr", width = UI_CONSTS.W_NUM_INP_SING_COL)
                 
                 with dpg.group(horizontal=True):
                     dpg.add_checkbox(label = "Correct for LSR", tag="lsr_correct", default_value=True)
@@ -27,6 +62,31 @@ class SpectralLineTab:
                 with dpg.tooltip("lsr_tooltip"):
                     dpg.add_text("Correct radial velocity to the local standard of rest")
 
+                with dpg.group(horizontal=True):
+                    dpg.add_checkbox(label = "Doppler tracking", tag="doppler_tracking", default_value=False)
+                    dpg.add_text("(?)", color=(0,0,255,255), tag = "doppler_tooltip")
+
+                with dpg.tooltip("doppler_tooltip"):
+                    dpg.add_text("Shift sub-integrations onto a fixed LSR velocity grid before averaging,\nso long integrations are not smeared by the motion of the Earth")
+                dpg.add_input_float(label = "Doppler interval (s)", default_value=60.0, min_value=1, min_clamped=True, tag = "doppler_interval", width = UI_CONSTS.W_NUM_INP_SING_COL)
+
+                with dpg.group(horizontal=True):
+                    dpg.add_input_int(label = "Zoom decimation", default_value=1, min_value=1, min_clamped=True, tag = "zoom_decimation", width = UI_CONSTS.W_NUM_INP_SING_COL, callback = self.updateTimeEstimate)
+                    dpg.add_text("(?)", color=(0,0,255,255), tag = "zoom_tooltip")
+
+                with dpg.tooltip("zoom_tooltip"):
+                    dpg.add_text("Spread the bins over 1/decimation of the band around the zoom frequency,\nfor a higher resolution than a full band FFT of the same size. 1 is off")
+                dpg.add_input_float(label = "Zoom freq (MHz)", default_value=0, min_value=0, min_clamped=True, tag = "zoom_freq", width = UI_CONSTS.W_NUM_INP_SING_COL)
+
+                with dpg.group(horizontal=True):
+                    dpg.add_checkbox(label = "Flag RFI", tag="rfi_flagging", default_value=False)
+                    dpg.add_text("(?)", color=(0,0,255,255), tag = "rfi_tooltip")
+
+                with dpg.tooltip("rfi_tooltip"):
+                    dpg.add_text("Leave out channels and sub-integrations contaminated by RFI, found by spectral kurtosis")
+                dpg.add_input_int(label = "RFI sub-integration", default_value=64, min_value=2, min_clamped=True, tag = "rfi_subint", width = UI_CONSTS.W_NUM_INP_SING_COL)
+                dpg.add_input_float(label = "RFI threshold", default_value=4.0, min_value=0, min_clamped=True, tag = "rfi_threshold", width = UI_CONSTS.W_NUM_INP_SING_COL)
+
 
             dpg.add_spacer(height=UI_CONSTS.H_COLL_HEAD_SPACER)
             with dpg.collapsing_header(label = "Data visualization and -saving", default_open=True):
@@ -42,12 +102,27 @@ class SpectralLineTab:
                     dpg.add_text("Y-axis plot limits. If left to 0,0 axis will be autoscaled")
 
                 dpg.add_checkbox(label = "Save data", default_value=True, tag="save_data")
+                with dpg.group(horizontal=True):
+                    dpg.add_checkbox(label = "Compressed archive", default_value=False, tag="archive")
+                    dpg.add_text("(?)", color=(0,0,255,255), tag = "archive_tooltip")
+
+                with dpg.tooltip("archive_tooltip"):
+                    dpg.add_text("Save data to a compressed archive instead of csv, with at most the given error in dB (0 is lossless).\nExisting observations are converted with radiopy.py -m")
+                with dpg.group(horizontal=True):
+                    dpg.add_input_float(label="Precision (dB)", width = UI_CONSTS.W_NUM_INP_DOUB_COL, default_value=0.001, min_value=0, min_clamped=True, tag="archive_precision", format="%.4f")
+                    dpg.add_combo(ARCHIVE_CODECS, label = "Codec", default_value="zlib", tag = "archive_codec", width = UI_CONSTS.W_NUM_INP_DOUB_COL)
                 with dpg.group(horizontal=True):
                     dpg.add_input_text(hint = "Output directory", width = UI_CONSTS.W_TXT_INP, tag = "output_dir", callback=self.updateDataViewer)
                     dpg.add_button(label = "Browse", callback=lambda: dpg.show_item("output_dir_file_dialog"))
                 with dpg.file_dialog(label = "Browse", show = False, tag = "output_dir_file_dialog", width=600, height=400, default_path=os.getcwd(), callback=self.fileDialogCallBack, cancel_callback=self.fileDialogCancelledCallBack, user_data="output", directory_selector=True):
                     pass
                 
+                with dpg.group(horizontal=True):
+                    dpg.add_checkbox(label="Divide out cached bandpass", tag="bandpass_cal", default_value=False)
+                    dpg.add_text("(?)", color=(0,0,255,255), tag = "bandpass_tooltip")
+
+                with dpg.tooltip("bandpass_tooltip"):
+                    dpg.add_text("Divide out the bandpass measured for this SDR, sample rate, bins and gain.\nMeasure it from an off-source integration with radiopy.py -b")
                 dpg.add_checkbox(label="Calibrate observation from file", tag="calibrate_background")
                 with dpg.group(horizontal=True):
                     dpg.add_input_text(hint = "Background observation file", width = UI_CONSTS.W_TXT_INP, tag = "calibration_path", callback=self.updateDataViewer)
@@ -58,11 +133,22 @@ class SpectralLineTab:
             
             # Run observation section
             dpg.add_spacer(height=10)
-            dpg.add_button(label = "Run observation", callback=self.beginObservation)
+            with dpg.group(horizontal=True):
+                dpg.add_button(label = "Run observation", callback=self.beginObservation)
+                dpg.add_button(label = "Stop observation", callback=self.stopObservation)
             with dpg.group(horizontal=True):
                 dpg.add_text("Estimated observation time: ")
                 dpg.add_text("NaN", tag = "estimated_time")
                 dpg.add_text("seconds")
+            
+            dpg.add_progress_bar(default_value=0, width=UI_CONSTS.W_TXT_INP, tag="observation_progress")
+            with dpg.group(horizontal=True):
+                dpg.add_text("Time remaining: ")
+                dpg.add_text("NaN", tag = "observation_eta")
+                dpg.add_text("seconds")
+            with dpg.group(horizontal=True):
+                dpg.add_text("Dropped samples: ")
+                dpg.add_text("0", tag = "observation_dropped")
 
 
     def updateTimeEstimate(self):
@@ -75,17 +161,117 @@ class SpectralLineTab:
         sample_rate = float(dpg.get_value("sample_rate"))
         bins = float(dpg.get_value("bins"))
         ffts = float(dpg.get_value("fft_num"))
+        decimation = max(dpg.get_value("zoom_decimation"), 1)
 
-        time_estimate = round(bins*ffts/sample_rate, 2)
+        # Adaptive integrations stop about where the radiometer equation reaches the target rms
+        if dpg.get_value("adaptive"):
+            expected = expectedSpectra(dpg.get_value("target_rms"), dpg.get_value("rms_unit"), dpg.get_value("tsys"))
+            ffts = min(ffts, expected) if expected > 0 else ffts
+
+        time_estimate = round(bins*decimation*ffts/sample_rate, 2)
         dpg.set_value("estimated_time", time_estimate)
 
 
+    def startWorker(self):
+        '''
+        Start the background worker, which imports the acquisition code while the UI is idle
+        '''
+        # Spawn, so the child only imports the acquisition code and never a copy of the running UI
+        ctx = multiprocessing.get_context("spawn")
+        self.commands = ctx.Queue()
+        self.live_queue = ctx.Queue(maxsize=2)
+        self.stop_event = ctx.Event()
+        self.worker_process = ctx.Process(target=observationWorker, args=(self.commands, self.live_queue, self.stop_event), daemon=True)
+        self.worker_process.start()
+
+
+    def stopWorker(self):
+        '''
+        Stop the background worker, ending any running observation first so the SDR is closed
+        '''
+        if self.worker_process is None:
+            return
+
+        self.stop_event.set()
+        self.commands.put(None)
+        self.worker_process.join(timeout=10)
+        if self.worker_process.is_alive():
+            self.worker_process.terminate()
+            self.worker_process.join()
+        self.worker_process = None
+        self.commands = None
+        self.live_queue = None
+        self.stop_event = None
+        self.running = False
+
+
     def beginObservation(self):
         '''
-        Starts an observation in another process
+        Starts an observation in the background worker
         '''
+        if self.running:
+            print("An observation is already running!")
+            return
+
         CB.applyParameters()
-        os.system('py radiopy.py -s' if os.name =='nt' else 'python3 radiopy.py -s')
+        if self.worker_process is None or not self.worker_process.is_alive():
+            self.stopWorker()
+            self.startWorker()
+        self.stop_event.clear()
+        self.commands.put("run")
+        self.running = True
+
+        dpg.set_value("observation_progress", 0)
+        dpg.set_value("observation_eta", "NaN")
+        dpg.set_value("observation_dropped", "0")
+        clearWaterfall()
+
+
+    def stopObservation(self):
+        '''
+        End the running integration early
+
+        The observation is saved with the spectra integrated so far, and the worker keeps the SDR open for the next run
+        '''
+        if not self.running:
+            return
+
+        print("Stopping observation...")
+        self.stop_event.set()
+
+
+    def pollObservation(self):
+        '''
+        Show the newest live update from the running observation, if any, and add every sub-integration to the waterfall
+
+        Called once per frame, so it never blocks
+        '''
+        if not self.running:
+            return
+
+        latest = None
+        try:
+            while True:
+                update = self.live_queue.get_nowait()
+                if update.get("finished"):
+                    self.running = False
+                    break
+                if update.get("sub") is not None:
+                    addWaterfallRow(update["freqs"]/10**6, update["sub"])
+                latest = update
+        except queue.Empty:
+            # Worker died without finishing, e.g. killed by the system
+            if self.running and not self.worker_process.is_alive():
+                self.running = False
+
+        if latest is None:
+            return
+        
+        dpg.set_value("observation_progress", latest["progress"])
+        dpg.set_value("observation_eta", round(latest["eta"], 1))
+        if latest["dropped"] is not None:
+            dpg.set_value("observation_dropped", str(latest["dropped"]))
+        updateLineSeries(xdata=latest["freqs"]/10**6, ydata=latest["data"], vel=latest["vel"])
 
 
     def fileDialogCallBack(sender: dict, app_data: str, user_data: str) -> None: